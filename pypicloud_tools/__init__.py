@@ -1,18 +1,19 @@
-"""Contstants and helpers common to multiple operations."""
+"""Contstants and helpers common to multiple operations.
+
+pip, pkg_resources, boto and requests take a while to import, so they are
+only imported inside the functions using them, keeping startup quick.
+"""
 
 
 from __future__ import print_function
 
 import os
 import sys
-import boto
 import argparse
 import datetime
 import operator
-import pkg_resources
+import threading
 from collections import namedtuple
-from pip.utils import SUPPORTED_EXTENSIONS
-from boto.exception import NoAuthHandlerFound
 
 try:
     from configparser import RawConfigParser  # python 3+
@@ -29,8 +30,11 @@ S3Config = namedtuple(
 )
 
 # Supported Extensions for uploading, downloading, listing, rehosting..
-SUPPORTED_EXTENSIONS = tuple(list(SUPPORTED_EXTENSIONS) +
-                             [".egg", ".exe", ".msi"])
+# the archive extensions are pip's, listed here as pip is slow to import
+SUPPORTED_EXTENSIONS = (
+    ".zip", ".whl", ".tar.gz", ".tgz", ".tar", ".tar.bz2", ".tbz", ".tar.xz",
+    ".txz", ".tlz", ".tar.lz", ".tar.lzma", ".egg", ".exe", ".msi",
+)
 
 # used to preform version comparisons
 OPERATORS = {
@@ -42,6 +46,32 @@ OPERATORS = {
     "<": operator.lt,
 }
 
+# where local state, like the bucket index, is kept between runs
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or
+    os.path.join(os.path.expanduser("~"), ".cache"),
+    "pypicloud-tools",
+)
+
+# endpoints of the S3 regions connected to, see connect_s3()
+REGION_HOSTS = {}
+
+# tunable options as (type, default), settable as config keys or --flags
+TUNABLES = {
+    "cache_dir": (str, CACHE_DIR),
+    "download_cache_size": (int, 1073741824),  # 1GB, 0 to disable
+    "index_ttl": (int, 60),
+    "jobs": (int, 4),
+    "manifest_prefix": (str, None),
+    "manifest_ttl": (int, 3600),
+    "max_requests": (int, 16),
+    "multipart_threshold": (int, 8388608),  # 8MB
+    "part_workers": (int, 4),
+    "range_size": (int, 8388608),  # 8MB
+    "range_threshold": (int, 16777216),  # 16MB
+    "upstream_url": (str, "https://pypi.org/pypi"),
+}
+
 # used as a callback to show some progress to stdout
 print_dot = lambda x, y: print(".", end="")
 
@@ -68,6 +98,15 @@ Note:
     and `secret` values filled in. The ACL defined here is your default, you
     can override per file via the --acl flag, which takes precendence.
 
+    Listings are kept in a local index under `cache_dir` and trusted for
+    `index_ttl` seconds, both of which can be set in the section above. Use
+    the --refresh flag to update the index before using it.
+
+    Setting `manifest_prefix` makes upload and rehost keep a JSON manifest
+    per package under that key prefix, which list and download read instead
+    of listing the package's keys, for up to `manifest_ttl` seconds after
+    it was written.
+
     AWS Access_Key and Secret_Key can also optionally be read from your
     credentials file at ~/.aws/credentials.
 """.format(
@@ -76,35 +115,134 @@ Note:
 )
 
 
-def get_bucket_conn(s3_config):
-    """Uses a S3Config and boto to return a bucket connection object."""
+def get_bucket_conn(s3_config, validate=True):
+    """Uses a S3Config and boto to return a bucket connection object.
+
+    Args:
+        s3_config: S3Config object
+        validate: boolean to check the bucket exists before returning it,
+                  which costs a request. Without it, a missing bucket is
+                  found by the first request made
+
+    Returns:
+        a ThreadLocalBucket object, used like a boto Bucket
+    """
+
+    from boto.exception import NoAuthHandlerFound
 
     no_auth_error = ("Could not authenticate with S3. Check your "
                      "~/.aws/credentials or pass --access and --secret flags.")
 
-    if s3_config.region is None:
-        func = boto.connect_s3
-        args = (s3_config.access, s3_config.secret)
-    else:
-        func = boto.s3.connect_to_region
-        args = (s3_config.region,)
-
     try:
-        s3_conn = func(*args)
+        return ThreadLocalBucket(s3_config, validate)
     except NoAuthHandlerFound:
         raise SystemExit(no_auth_error)
 
-    return s3_conn.get_bucket(s3_config.bucket)
 
+def connect_s3(s3_config):
+    """Opens a new boto S3 connection for the S3Config.
 
-def settings_from_config(options):
-    """Try to read config file and parse settings.
+    The endpoint of a region is only looked up for the first connection to
+    it, later connections are made to the same host directly.
+    """
+
+    import boto
+    import boto.s3
+
+    if s3_config.region is None:
+        return boto.connect_s3(s3_config.access, s3_config.secret)
+
+    host = REGION_HOSTS.get(s3_config.region)
+    if host is not None:
+        return boto.s3.connect_to_region(s3_config.region, host=host)
+
+    s3_conn = boto.s3.connect_to_region(s3_config.region)
+    if s3_conn is None:
+        raise SystemExit("Unknown S3 region: {}".format(s3_config.region))
+    REGION_HOSTS[s3_config.region] = s3_conn.host
+    return s3_conn
+
+
+class ThreadLocalBucket(object):
+    """Bucket stand in which gives each thread its own S3 connection.
+
+    A thread's connection is made on its first request, then kept for the
+    rest of the run so its HTTP connections are kept alive and reused.
+    Keys and multipart uploads handed out refer back to this object, so
+    their requests also use the connection of the thread making them.
+    """
+
+    def __init__(self, s3_config, validate=True):
+        self.s3_config = s3_config
+        self.name = s3_config.bucket
+        self._local = threading.local()
+        self._local.bucket = connect_s3(s3_config).get_bucket(
+            self.name,
+            validate=validate,
+        )
+
+    def __getattr__(self, attr):
+        return getattr(self.local(), attr)
+
+    def local(self):
+        """Returns the boto Bucket object for the current thread."""
+
+        bucket = getattr(self._local, "bucket", None)
+        if bucket is None:
+            bucket = connect_s3(self.s3_config).get_bucket(
+                self.name,
+                validate=False,
+            )
+            self._local.bucket = bucket
+        return bucket
+
+    def new_key(self, key_name=None):
+        """Bucket.new_key() stand in."""
+
+        from boto.s3.key import Key
+
+        return Key(self, key_name)
+
+    def get_key(self, key_name, *args, **kwargs):
+        """Bucket.get_key() stand in."""
+
+        key = self.local().get_key(key_name, *args, **kwargs)
+        if key is not None:
+            key.bucket = self
+        return key
+
+    def list(self, prefix="", delimiter="", marker="", *args, **kwargs):
+        """Bucket.list() stand in."""
+
+        for key in self.local().list(prefix, delimiter, marker, *args,
+                                     **kwargs):
+            key.bucket = self
+            yield key
+
+    def get_all_keys(self, *args, **kwargs):
+        """Bucket.get_all_keys() stand in."""
+
+        page = self.local().get_all_keys(*args, **kwargs)
+        for key in page:
+            key.bucket = self
+        return page
+
+    def initiate_multipart_upload(self, key_name, *args, **kwargs):
+        """Bucket.initiate_multipart_upload() stand in."""
+
+        mp = self.local().initiate_multipart_upload(key_name, *args, **kwargs)
+        mp.bucket = self
+        return mp
+
+
+def read_config(options):
+    """Reads the config file named in options.
 
     Args:
-        options: parsed NameSpace, with `config` and maybe `acl` values
+        options: parsed NameSpace, with a `config` value
 
     Returns:
-        tuple of S3Config and PyPIConfig objects, or Nones when missing values
+        RawConfigParser object, empty if the file could not be read
     """
 
     parser = RawConfigParser()
@@ -119,6 +257,49 @@ def settings_from_config(options):
     except Exception as error:
         print(error, file=sys.stderr)
 
+    return parser
+
+
+def options_from_config(options):
+    """Fills in the tunable options not given on the command line.
+
+    Values are taken from the config file if set there, otherwise the
+    default from TUNABLES is used.
+
+    Args:
+        options: parsed NameSpace, with a `config` value
+
+    Returns:
+        the same options NameSpace, with every tunable set
+    """
+
+    parser = read_config(options)
+    key = "pypicloud"
+
+    for name, (type_, default) in TUNABLES.items():
+        if getattr(options, name, None) is not None:
+            continue
+        if parser.has_section(key) and parser.has_option(key, name):
+            value = type_(parser.get(key, name))
+        else:
+            value = default
+        setattr(options, name, value)
+
+    return options
+
+
+def settings_from_config(options):
+    """Try to read config file and parse settings.
+
+    Args:
+        options: parsed NameSpace, with `config` and maybe `acl` values
+
+    Returns:
+        tuple of S3Config and PyPIConfig objects, or Nones when missing values
+    """
+
+    parser = read_config(options)
+
     key = "pypicloud"  # config section key
     if key not in parser.sections():
         return None, None
@@ -162,6 +343,39 @@ def settings_from_config(options):
     return s3_conf, pypi_conf
 
 
+class VersionAction(argparse.Action):
+    """Prints the version and exits, like argparse's "version" action.
+
+    The installed version is only looked up when the flag is used, finding
+    it with pkg_resources is slower than everything else parse_args does.
+    """
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings,
+            dest=dest,
+            default=default,
+            nargs=0,
+            help=help,
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        import pkg_resources
+
+        print((
+            "pypicloud-tools {} v{}\n"
+            "Copyright (c) {} CCP hf.\n"
+            "Released for use under the MIT license."
+        ).format(
+            parser.prog,
+            pkg_resources.get_distribution("pypicloud-tools").version,
+            datetime.datetime.now().year,
+        ))
+        parser.exit()
+
+
 def parse_args(upload=False, download=False, listing=False, rehost=False):
     """Builds an argparse ArgumentParser.
 
@@ -224,24 +438,119 @@ def parse_args(upload=False, download=False, listing=False, rehost=False):
         help="Specify a config file (default: %(default)s)",
     )
 
+    if download or listing:
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            help="Refresh the local bucket index before using it",
+        )
+        parser.add_argument(
+            "--index-ttl",
+            metavar="SECONDS",
+            type=int,
+            default=None,
+            help="Seconds to trust the local bucket index for "
+                 "(default: {})".format(TUNABLES["index_ttl"][1]),
+        )
+
+    if listing:
+        parser.add_argument(
+            "--match",
+            metavar="PATTERN",
+            type=str,
+            default=None,
+            help="Only list the package names matching this glob, when "
+                 "listing all packages",
+        )
+        parser.add_argument(
+            "--regex",
+            action="store_true",
+            help="Search package names with the --match pattern as a regex",
+        )
+        parser.add_argument(
+            "--format",
+            choices=("text", "json", "ndjson", "csv"),
+            default="text",
+            help="Output format, json, ndjson and csv include each key's "
+                 "size, last modified time and ETag (default: %(default)s)",
+        )
+        parser.add_argument(
+            "--unsorted",
+            action="store_true",
+            help="Write releases as they are listed, rather than newest "
+                 "version first",
+        )
+        parser.add_argument(
+            "--latest",
+            metavar="N",
+            type=int,
+            default=None,
+            help="Only list the newest N versions, of every package when "
+                 "none are given",
+        )
+
+    if download or upload or rehost:
+        if rehost:
+            jobs_help = "Number of packages to fetch, and files to upload, " \
+                        "at once (default: {})"
+        else:
+            jobs_help = "Number of files to {} at once (default: {{}})".format(
+                verb,
+            )
+        parser.add_argument(
+            "--jobs",
+            metavar="N",
+            type=int,
+            default=None,
+            help=jobs_help.format(TUNABLES["jobs"][1]),
+        )
+        if upload or rehost:
+            workers_help = "Number of parts or files to upload at once, " \
+                           "shared by all files (default: {})"
+        else:
+            workers_help = "Number of parts of each large file to download " \
+                           "at once (default: {})"
+        parser.add_argument(
+            "--part-workers",
+            metavar="N",
+            type=int,
+            default=None,
+            help=workers_help.format(TUNABLES["part_workers"][1]),
+        )
+
+    if upload:
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Upload files even if an identical key already exists",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Keep failed uploads of large files to continue them later",
+        )
+
     if rehost:
         parser.add_argument(
             "--deps", "--with-deps",
             action="store_true",
             help="Rehost the package(s) dependencies as well",
         )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Fetch and upload releases already in the bucket",
+        )
+        parser.add_argument(
+            "--stream",
+            action="store_true",
+            help="Copy releases from PyPI straight into S3, without "
+                 "downloading them to disk first",
+        )
 
     parser.add_argument(
         "-v", "--version",
-        action="version",
-        version=(
-            "pypicloud-tools %(prog)s v{}\n"
-            "Copyright (c) {} CCP hf.\n"
-            "Released for use under the MIT license."
-        ).format(
-            pkg_resources.get_distribution("pypicloud-tools").version,
-            datetime.datetime.now().year,
-        ),
+        action=VersionAction,
     )
 
     parser.add_argument(
@@ -319,4 +628,6 @@ def get_settings(upload=False, download=False, listing=False, rehost=False):
         print("ERROR: Could not determine S3 settings.", file=sys.stderr)
         raise SystemExit(parser.print_help())
 
+    options_from_config(args)
+
     return Settings(s3_config, pypi_config, remainders, args)
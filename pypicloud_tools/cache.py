@@ -0,0 +1,167 @@
+"""Local cache of downloaded release files, keyed by their S3 ETag."""
+
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+from .retry import get_executor
+
+
+class DownloadCache(object):
+    """Content addressed store of downloaded keys with LRU eviction.
+
+    Entries are named by a hash of the bucket, key name and ETag, so a key
+    which is replaced in the bucket never matches an older entry. Every hit
+    is confirmed with a conditional GET, which returns no body when the key
+    still has the same ETag.
+    """
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def entry(self, key):
+        """Returns the string path a key is cached at."""
+
+        return os.path.join(self.path, hashlib.sha1("{}/{}/{}".format(
+            key.bucket.name,
+            key.name,
+            key.etag,
+        ).encode("utf-8")).hexdigest())
+
+    def fetch(self, key):
+        """Looks up a fresh cached copy of key.
+
+        If the key has changed in the bucket, its etag and size are updated
+        from the conditional request made.
+
+        Args:
+            key: boto Key object, with its etag set
+
+        Returns:
+            string path of the cached file, or None on a cache miss. A key
+            which can't be confirmed, because it was removed or can't be
+            read anymore, is a miss
+        """
+
+        from boto.exception import S3ResponseError
+
+        entry = self.entry(key)
+        if not os.path.isfile(entry):
+            return None
+
+        try:
+            fresh = self.is_fresh(key)
+        except S3ResponseError:
+            return None
+
+        if not fresh:
+            entry = self.entry(key)  # the newer ETag may be cached already
+            if not os.path.isfile(entry):
+                return None
+
+        os.utime(entry, None)  # mark as recently used
+        return entry
+
+    def is_fresh(self, key):
+        """Checks if key still has the same ETag with a conditional GET.
+
+        Only the first byte is requested, in case the key has changed.
+
+        Raises:
+            S3ResponseError for any error response but 304 Not Modified
+        """
+
+        from boto.exception import S3ResponseError
+
+        check_key = key.bucket.new_key(key.name)
+        headers = {"If-None-Match": key.etag, "Range": "bytes=0-0"}
+        try:
+            get_executor().call(
+                check_key.get_contents_as_string,
+                headers=headers,
+            )
+        except S3ResponseError as error:
+            if error.status != 304:
+                raise
+            return True
+
+        key.etag = check_key.etag
+        key.size = check_key.size
+        return False
+
+    def store(self, key, filename):
+        """Adds the downloaded filename as the cached copy of key."""
+
+        if key.size is not None and key.size > self.max_size:
+            return
+
+        handle, temp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        os.close(handle)
+        place(filename, temp_path)
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            os.remove(entry)
+        os.rename(temp_path, entry)
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries over max_size bytes."""
+
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # evicted by another download
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def place(source, destination):
+    """Hardlinks source to destination, copying when links can't be used."""
+
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except (OSError, AttributeError):  # no os.link on python 2 windows
+        shutil.copyfile(source, destination)
+
+
+def open_cache(options):
+    """Opens the download cache in the configured cache_dir.
+
+    Args:
+        options: parsed NameSpace, with the tunable options filled in
+
+    Returns:
+        a DownloadCache, or None if it is disabled or can't be created
+    """
+
+    if not options or not options.download_cache_size:
+        return None
+
+    try:
+        return DownloadCache(
+            os.path.join(options.cache_dir, "downloads"),
+            options.download_cache_size,
+        )
+    except OSError:
+        return None
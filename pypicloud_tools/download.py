@@ -3,22 +3,34 @@
 
 from __future__ import print_function
 
+import os
 import sys
+import json
+import shutil
+import threading
 from collections import defaultdict
-from pkg_resources import safe_name
+from concurrent.futures import ThreadPoolExecutor
 
 from . import get_settings
 from . import get_bucket_conn
+from .cache import place
+from .cache import open_cache
+from .index import open_index
+from .index import BucketIndex
+from .index import find_releases
+from .retry import get_executor
+from .retry import print_summary
+from .utils import write_json
 from .utils import parse_package
-from .utils import parse_package_file
+from .utils import ReleaseVersions
 
 
 def prefer_wheels(package_releases, package):
-    """Given a list of packages, prefer a single wheel if not overridden.
+    """Given a list of releases, prefer a single wheel if not overridden.
 
     Args::
 
-        package_releases: a list of S3 keys for package releases
+        package_releases: a list of Release objects for the package
         package: parsed package object requested
 
     Returns:
@@ -26,10 +38,8 @@ def prefer_wheels(package_releases, package):
     """
 
     versioned = defaultdict(list)
-    for package_release in package_releases:
-        package_version = parse_package_file(package_release, package)
-        if package_version:
-            versioned[package_version].append(package_release)
+    for release in package_releases:
+        versioned[release.version].append(release)
 
     # compare versions with pkg_resources.parse_version, find newest
     ver_order = sorted(versioned)
@@ -39,12 +49,12 @@ def prefer_wheels(package_releases, package):
     eggs = []
     sources = []
     for pkg in packages:
-        if pkg.name.endswith(".whl"):
-            wheels.append(pkg)
-        elif pkg.name.endswith(".egg"):
-            eggs.append(pkg)
+        if pkg.type == "wheel":
+            wheels.append(pkg.key)
+        elif pkg.type == "egg":
+            eggs.append(pkg.key)
         else:
-            sources.append(pkg)
+            sources.append(pkg.key)
 
     if "--src" in sys.argv and len(sources) == 1:
         return sources[0]
@@ -56,79 +66,291 @@ def prefer_wheels(package_releases, package):
         raise SystemExit("Found too many results for {}{}:\n  {}".format(
             package.project_name,
             package.specifier,
-            "\n  ".join([key.name for key in packages]),
+            "\n  ".join([pkg.key.name for pkg in packages]),
         ))
 
 
-def download_package(bucket, package):
-    """Gets the download URL for a package, optionally package+release.
+def find_package_key(bucket, package):
+    """Finds the key of the release to download for a package.
 
     Args:
-        bucket: a connected S3 bucket object to look for package in
+        bucket: a connected S3 bucket object or index to look for package in
         package: parsed package object
 
     Returns:
-        string URL to download the package at release or latest
+        the boto Key object of the release at the version requested or latest
     """
 
     # figure out key name from package and release requested and what's
     # available in the bucket...
-    package_releases = []
-    for key in bucket.get_all_keys():
-        key_base, _, key_name = key.name.partition("/")
-        if not key_name or safe_name(key_base) != package.project_name:
-            continue
-        key_pkg = parse_package_file(key_name, package)
-        if package.project_name == key_pkg.project_name:
-            for spec in package.specs:
-                if not spec[0](key_pkg.specs[0][1], spec[1]):
-                    break
-            else:
-                package_releases.append(key)
+    package_releases = ReleaseVersions(
+        find_releases(bucket, package),
+    ).latest(package.specs)
+
+    # the index may have been made before the release was uploaded
+    if not package_releases and isinstance(bucket, BucketIndex) and \
+            bucket.recheck("{}/".format(package.project_name)):
+        package_releases = ReleaseVersions(
+            find_releases(bucket, package),
+        ).latest(package.specs)
 
     if len(package_releases) == 1:
-        package_key = package_releases[0]
+        return package_releases[0].key
     elif package_releases:
-        package_key = prefer_wheels(package_releases, package)
+        return prefer_wheels(package_releases, package)
     else:
         raise SystemExit("Package {}{} not found".format(
             package.project_name,
             package.specifier,
         ))
 
-    write_key(package_key)
 
+def download_package(bucket, package):
+    """Downloads a package, optionally package+release.
+
+    Args:
+        bucket: a connected S3 bucket object or index to look for package in
+        package: parsed package object
+    """
+
+    write_key(find_package_key(bucket, package))
+
+
+def download_packages(bucket, packages, options):
+    """Downloads multiple packages, writing up to `options.jobs` at once.
 
-def write_key(key):
+    Every package is resolved against the bucket before any are downloaded.
+    Errors are reported per package without stopping the others.
+
+    Args:
+        bucket: a connected S3 bucket object or index to look for packages in
+        packages: list of package strings, maybe with version specifications
+        options: parsed NameSpace, with the tunable options filled in
+
+    Returns:
+        integer number of packages which failed to download
+    """
+
+    errors = 0
+    resolved = []
+    for package in packages:
+        try:
+            resolved.append((package, find_package_key(
+                bucket,
+                parse_package(package),
+            )))
+        except (Exception, SystemExit) as error:
+            print("Error downloading {}: {}".format(package, error),
+                  file=sys.stderr)
+            errors += 1
+
+    # URLs and piped contents are written to stdout in the order requested
+    jobs = options.jobs
+    if "--url-only" in sys.argv or "--url" in sys.argv or \
+            not sys.stdout.isatty():
+        jobs = 1
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as pool:
+        downloads = [
+            (package, pool.submit(write_key, key, options))
+            for package, key in resolved
+        ]
+
+    for package, download in downloads:
+        error = download.exception()
+        if error is not None:
+            print("Error downloading {}: {}".format(package, error),
+                  file=sys.stderr)
+            errors += 1
+
+    return errors
+
+
+def write_key(key, options=None):
     """Writes the key to file or sys.stdout.
 
-    If it can write to a file, it will print the filename to stdout.
+    If it can write to a file, it will print the filename to stdout. Files are
+    written to a .part file first, which is renamed once complete. Files of
+    at least `options.range_threshold` bytes are downloaded in ranges.
+
+    When the download cache is enabled, fresh cached copies are linked into
+    place or written to stdout instead of downloading them again.
     """
 
     if "--url-only" in sys.argv or "--url" in sys.argv:
         print(key.generate_url(300))  # good for 5 minutes
+        return
+
+    cache = open_cache(options)
+    cached = cache.fetch(key) if cache else None
+
+    if sys.stdout.isatty():
+        # open a file and stream the content into it
+        filename = key.name.split("/")[1]
+        if cached:
+            place(cached, filename)
+        elif options and key.size and key.size >= options.range_threshold:
+            write_ranges(key, filename, options.range_size,
+                         options.part_workers)
+        else:
+            part = PartialDownload(filename)
+            get_executor().call(_write_whole, key, part)
+            part.finish()
+
+        if cache and not cached:
+            cache.store(key, filename)
+        print(filename)
+    elif cached:
+        with open(cached, "rb") as opencached:
+            shutil.copyfileobj(opencached, getattr(sys.stdout, "buffer",
+                                                   sys.stdout))
     else:
-        if sys.stdout.isatty():
-            # open a file and stream the content into it
-            filename = key.name.split("/")[1]
-            with open(filename, "wb") as openpackage:
-                key.get_contents_to_file(openpackage)
-            print(filename)
+        # stdout is being piped/redirected somewhere, write to it directly.
+        # this is not retried, as the output can't be taken back
+        key.get_contents_to_file(sys.stdout)
+
+
+class PartialDownload(object):
+    """A download in progress, written to `<filename>.part`.
+
+    For ranged downloads, the completed ranges are journaled in a JSON
+    sidecar next to the .part file along with the key's ETag and the range
+    size. A later attempt continues with the missing ranges if both still
+    match, otherwise it starts over.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.part = "{}.part".format(filename)
+        self.journal = "{}.json".format(self.part)
+        self.completed = set()
+        self._lock = threading.Lock()
+        self._state = None
+
+    def resume(self, key, range_size):
+        """Loads the journal for key, or starts a new one.
+
+        Args:
+            key: boto Key object being downloaded, with its size and etag
+            range_size: integer number of bytes requested at a time
+
+        Returns:
+            set of (start, end) tuples of the ranges already written
+        """
+
+        state = {"etag": key.etag, "size": key.size, "range_size": range_size}
+        try:
+            with open(self.journal, "r") as openjournal:
+                journal = json.load(openjournal)
+            if os.path.getsize(self.part) != key.size:
+                raise ValueError("part file is the wrong size")
+        except (IOError, OSError, ValueError):
+            journal = {}
+
+        self._state = state
+        if all(journal.get(attr) == state[attr] for attr in state):
+            self.completed = set(tuple(range_) for range_ in journal["ranges"])
         else:
-            # stdout is being piped/redirected somewhere, write to it directly
-            key.get_contents_to_file(sys.stdout)
+            # preallocate the file so each range can be written at its offset
+            self.completed = set()
+            with open(self.part, "wb") as openpackage:
+                openpackage.truncate(key.size)
+            self._write_journal()
+
+        return self.completed
+
+    def done(self, start, end):
+        """Records the range start to end (inclusive) as written."""
+
+        with self._lock:
+            self.completed.add((start, end))
+            self._write_journal()
+
+    def finish(self):
+        """Moves the completed .part file into place and drops the journal."""
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(self.part, self.filename)
+        if os.path.exists(self.journal):
+            os.remove(self.journal)
+
+    def _write_journal(self):
+        """Atomically replaces the journal with the current state."""
+
+        write_json(self.journal, dict(self._state,
+                                      ranges=sorted(self.completed)))
+
+
+def write_ranges(key, filename, range_size, workers):
+    """Downloads a key into filename as byte ranges fetched in parallel.
+
+    Ranges written by an earlier, interrupted attempt are not requested again
+    as long as the key's ETag has not changed since.
+
+    Args:
+        key: boto Key object to download, with its size set
+        filename: string path of the file to write
+        range_size: integer number of bytes to request at a time
+        workers: integer number of ranges to request at once
+    """
+
+    part = PartialDownload(filename)
+    completed = part.resume(key, range_size)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        ranges = []
+        for offset in range(0, key.size, range_size):
+            range_ = (offset, min(offset + range_size, key.size) - 1)
+            if range_ not in completed:
+                ranges.append(pool.submit(_write_range, key, part, *range_))
+
+    for range_ in ranges:
+        range_.result()  # raises the first error encountered
+
+    part.finish()
+
+
+def _write_whole(key, part):
+    """Writes all of key into the part file, truncating it first."""
+
+    with open(part.part, "wb") as openpackage:
+        key.get_contents_to_file(openpackage)
+
+
+def _write_range(key, part, start, end):
+    """Writes bytes start to end (inclusive) of key into the part file."""
+
+    get_executor().call(_fetch_range, key, part, start, end)
+    part.done(start, end)
+
+
+def _fetch_range(key, part, start, end):
+    """Makes a single attempt at writing a range into the part file."""
+
+    # boto keys hold their response while reading, so use one per thread
+    range_key = key.bucket.new_key(key.name)
+    headers = {"Range": "bytes={}-{}".format(start, end)}
+    if key.etag:
+        headers["If-Match"] = key.etag  # fail if the key has been replaced
+
+    with open(part.part, "r+b") as openpackage:
+        openpackage.seek(start)
+        range_key.get_contents_to_file(openpackage, headers=headers)
+        openpackage.flush()
+        os.fsync(openpackage.fileno())
 
 
 def main():
     """Main command line entry point for downloading."""
 
     settings = get_settings(download=True)
-    bucket = get_bucket_conn(settings.s3)
-
-    for package in settings.items:
-        try:
-            download_package(bucket, parse_package(package))
-        except Exception as error:
-            print("Error downloading {}: {}".format(package, error),
-                  file=sys.stderr)
-            break
+    get_executor(settings.parsed)
+    bucket = open_index(
+        get_bucket_conn(settings.s3, validate=False),
+        settings,
+    )
+    errors = download_packages(bucket, settings.items, settings.parsed)
+    print_summary()
+    if errors:
+        raise SystemExit(1)
@@ -0,0 +1,431 @@
+"""Local on-disk index of the release keys in a bucket."""
+
+
+import os
+import time
+import sqlite3
+import contextlib
+import threading
+
+from .utils import Release
+from .retry import get_executor
+from .manifest import ManifestBucket
+from .utils import list_keys
+from .utils import parse_package
+from .utils import parse_release
+
+
+# how many listed keys update() writes to the index per transaction
+UPDATE_BATCH = 500
+
+# bump this when the table layout changes, older indexes are rebuilt
+SCHEMA_VERSION = 1
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS keys (
+        name TEXT PRIMARY KEY,
+        base TEXT NOT NULL,
+        size INTEGER,
+        etag TEXT,
+        last_modified TEXT,
+        project TEXT,
+        version TEXT,
+        type TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS keys_base ON keys (base)",
+    """CREATE TABLE IF NOT EXISTS prefixes (
+        prefix TEXT PRIMARY KEY,
+        refreshed REAL NOT NULL
+    )""",
+)
+
+
+class BucketIndex(object):
+    """SQLite backed index of a bucket's release keys.
+
+    Each package prefix is refreshed from S3 at most once every `ttl`
+    seconds. Refreshing is incremental, only keys whose ETag or last
+    modified time changed are parsed again and removed keys are dropped.
+
+    The index can be used from any thread, each thread opens a connection of
+    its own to the database.
+    """
+
+    def __init__(self, bucket, path, ttl, refresh=False):
+        self.bucket = bucket
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self._refreshed = set()  # prefixes already refreshed by this run
+        self._local = threading.local()
+
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        with self.db:
+            if version != SCHEMA_VERSION:
+                self.db.execute("DROP TABLE IF EXISTS keys")
+                self.db.execute("DROP TABLE IF EXISTS prefixes")
+                self.db.execute("PRAGMA user_version = {}".format(
+                    SCHEMA_VERSION
+                ))
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    @property
+    def db(self):
+        """The calling thread's sqlite3 connection to the index.
+
+        sqlite3 connections can only be used by the thread which opened them.
+        """
+
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+        return db
+
+    def is_fresh(self, prefix):
+        """Checks if prefix, or the whole bucket, was refreshed recently."""
+
+        if prefix in self._refreshed or "" in self._refreshed:
+            return True
+        if self.refresh:
+            return False
+
+        row = self.db.execute(
+            "SELECT MAX(refreshed) FROM prefixes WHERE prefix IN (?, '')",
+            (prefix,),
+        ).fetchone()
+        return row[0] is not None and time.time() - row[0] < self.ttl
+
+    def update(self, prefix=""):
+        """Incrementally updates the index for prefix from S3.
+
+        Keys are compared with the index as they are listed, and written in
+        batches of UPDATE_BATCH. The names listed are kept in a temporary
+        table to find the removed keys, so memory use doesn't grow with the
+        number of keys.
+
+        Args:
+            prefix: string key prefix, either "" or "<package>/"
+        """
+
+        started = time.time()
+        with self._writing() as db:
+            db.execute("CREATE TEMP TABLE IF NOT EXISTS listed "
+                       "(name TEXT PRIMARY KEY)")
+            db.execute("DELETE FROM listed")
+
+        package = [None, None]  # the last base seen, and its parsed package
+        batch = []
+        for key in get_executor().listing(self.bucket, prefix):
+            if key.name.partition("/")[2]:
+                batch.append(key)
+            if len(batch) == UPDATE_BATCH:
+                with self._writing() as db:
+                    self._write_keys(db, batch, package)
+                batch = []
+
+        with self._writing() as db:
+            self._write_keys(db, batch, package)
+            if prefix:
+                db.execute(
+                    "DELETE FROM keys WHERE base = ? AND name NOT IN "
+                    "(SELECT name FROM listed)",
+                    (prefix.rstrip("/"),),
+                )
+            else:
+                db.execute("DELETE FROM keys WHERE name NOT IN "
+                           "(SELECT name FROM listed)")
+            db.execute("DELETE FROM listed")
+            db.execute(
+                "INSERT OR REPLACE INTO prefixes VALUES (?, ?)",
+                (prefix, started),
+            )
+        self._refreshed.add(prefix)
+
+    def recheck(self, prefix):
+        """Updates prefix from S3, unless this run did already.
+
+        Returns:
+            boolean, True if prefix was updated
+        """
+
+        if prefix in self._refreshed:
+            return False
+        self.update(prefix)
+        return True
+
+    def forget(self, prefixes):
+        """Marks prefixes, and the whole bucket, as needing a refresh.
+
+        Args:
+            prefixes: iterable of string "<package>/" key prefixes
+        """
+
+        with self._writing() as db:
+            db.executemany(
+                "DELETE FROM prefixes WHERE prefix = ?",
+                [(prefix,) for prefix in set(prefixes) | set([""])],
+            )
+        self._refreshed.clear()
+
+    def _write_keys(self, db, keys, package):
+        """Writes the listed keys which changed to the index.
+
+        Args:
+            db: sqlite3 connection, in a transaction
+            keys: list of boto Key objects listed
+            package: list of the last base seen and its parsed package,
+                     updated as keys of another package are seen
+        """
+
+        for key in keys:
+            db.execute("INSERT OR IGNORE INTO listed VALUES (?)", (key.name,))
+            known = db.execute(
+                "SELECT etag, last_modified FROM keys WHERE name = ?",
+                (key.name,),
+            ).fetchone()
+            if known and tuple(known) == (key.etag, key.last_modified):
+                continue
+
+            base = key.name.partition("/")[0]
+            if package[0] != base:  # keys are listed by package
+                package[0] = base
+                try:
+                    package[1] = parse_package(base)
+                except Exception:
+                    package[1] = None
+
+            release = None
+            if package[1] is not None:
+                release = parse_release(key, package[1])
+
+            db.execute(
+                "INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    key.name,
+                    base,
+                    key.size,
+                    key.etag,
+                    key.last_modified,
+                    release.project if release else None,
+                    str(release.version) if release else None,
+                    release.type if release else None,
+                ),
+            )
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """Runs a block in a transaction holding the write lock throughout.
+
+        Taking the lock up front makes concurrent writers wait their turn,
+        instead of one failing when both try to upgrade a read lock.
+        """
+
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            yield self.db
+
+    def list(self, prefix="", delimiter="", marker=""):
+        """Bucket.list() stand in, answering from the index.
+
+        Listing package names with a "/" delimiter is only answered from an
+        index of the whole bucket, refreshing one would list every key.
+
+        Returns:
+            list of boto Key objects, with size, etag and last_modified set,
+            or boto Prefix objects for each package when using a delimiter
+        """
+
+        if delimiter == "/" and "/" not in prefix:
+            return self._prefixes(prefix, marker)
+
+        if not self.is_fresh(prefix):
+            self.update(prefix)
+        return [self._key(row) for row in self._rows(prefix)
+                if row["name"] > marker]
+
+    def releases(self, package=None):
+        """Lists the releases of package, using the parsed values stored.
+
+        Args:
+            package: parsed package object, or None for every package
+
+        Returns:
+            iterable of Release objects, read from the index as they are
+            used
+        """
+
+        from pkg_resources import SetuptoolsVersion
+
+        prefix = "" if package is None else "{}/".format(package.project_name)
+        if not self.is_fresh(prefix):
+            self.update(prefix)
+
+        return (
+            Release(
+                self._key(row),
+                row["project"],
+                SetuptoolsVersion(row["version"]),
+                row["type"],
+            ) for row in self._rows(prefix) if row["version"] is not None
+        )
+
+    def _prefixes(self, prefix, marker):
+        """Lists the package prefixes starting with prefix after marker."""
+
+        if not self.is_fresh(""):
+            return get_executor().listing(self.bucket, prefix, "/", marker)
+
+        from boto.s3.prefix import Prefix
+
+        rows = self.db.execute("SELECT DISTINCT base FROM keys ORDER BY base")
+        names = ("{}/".format(row["base"]) for row in rows)
+        return [
+            Prefix(self.bucket, name) for name in names
+            if name.startswith(prefix) and name > marker
+        ]
+
+    def _rows(self, prefix):
+        """Selects all indexed rows for keys starting with prefix."""
+
+        if prefix:
+            return self.db.execute(
+                "SELECT * FROM keys WHERE base = ? ORDER BY name",
+                (prefix.rstrip("/"),),
+            )
+        return self.db.execute("SELECT * FROM keys ORDER BY name")
+
+    def _key(self, row):
+        """Builds a boto Key object for an indexed row."""
+
+        from boto.s3.key import Key
+
+        key = Key(self.bucket, row["name"])
+        key.size = row["size"]
+        key.etag = row["etag"]
+        key.last_modified = row["last_modified"]
+        return key
+
+
+def open_index(bucket, settings):
+    """Opens the local index for bucket in the configured cache_dir.
+
+    When a manifest_prefix is configured, the index is refreshed from the
+    package manifests instead of listing the bucket, unless --refresh is used.
+
+    Args:
+        bucket: a connected S3 bucket object
+        settings: Settings object, with tunables filled in on `parsed`
+
+    Returns:
+        a BucketIndex, or the bucket itself if no index could be opened
+    """
+
+    options = settings.parsed
+    if options.manifest_prefix:
+        bucket = ManifestBucket(bucket, options.manifest_prefix,
+                                read=not getattr(options, "refresh", False),
+                                max_age=options.manifest_ttl)
+
+    try:
+        if not os.path.isdir(options.cache_dir):
+            os.makedirs(options.cache_dir)
+        return BucketIndex(
+            bucket,
+            index_path(bucket, options),
+            options.index_ttl,
+            getattr(options, "refresh", False),
+        )
+    except (OSError, sqlite3.Error):
+        return bucket
+
+
+def index_path(bucket, options):
+    """Returns the string path of bucket's index file in the cache_dir."""
+
+    return os.path.join(options.cache_dir, "{}.sqlite".format(bucket.name))
+
+
+def forget_uploads(bucket, options, key_names):
+    """Marks the packages of key_names as needing a refresh in the index.
+
+    Called after uploading, so the next run doesn't answer from a listing
+    made before the upload. Nothing is done when there is no index yet.
+
+    Args:
+        bucket: a connected S3 bucket object
+        options: parsed NameSpace, with the tunable options filled in
+        key_names: iterable of string key names which were just uploaded
+    """
+
+    path = index_path(bucket, options)
+    if not os.path.isfile(path):
+        return
+
+    try:
+        BucketIndex(bucket, path, options.index_ttl).forget(
+            "{}/".format(name.partition("/")[0]) for name in key_names
+        )
+    except sqlite3.Error:
+        pass
+
+
+def find_releases(bucket, package):
+    """Lists the releases of package from the index or straight from S3.
+
+    Args:
+        bucket: a connected S3 bucket object or BucketIndex
+        package: parsed package object
+
+    Returns:
+        iterable of Release objects for package
+    """
+
+    if isinstance(bucket, BucketIndex):
+        releases = bucket.releases(package)
+    else:
+        releases = (
+            parse_release(key, package) for key in list_keys(bucket, package)
+        )
+
+    return (
+        release for release in releases
+        if release and release.project == package.project_name
+    )
+
+
+def find_all_releases(bucket):
+    """Lists the releases of every package, reading the bucket only once.
+
+    Args:
+        bucket: a connected S3 bucket object or BucketIndex
+
+    Yields:
+        Release objects, grouped by package
+    """
+
+    if isinstance(bucket, BucketIndex):
+        releases = bucket.releases()
+    else:
+        releases = _parse_releases(list_keys(bucket))
+
+    for release in releases:
+        if release and release.project == release.key.name.partition("/")[0]:
+            yield release
+
+
+def _parse_releases(keys):
+    """Parses release keys of any package into Release objects."""
+
+    packages = {}
+    for key in keys:
+        base = key.name.partition("/")[0]
+        if base not in packages:
+            try:
+                packages[base] = parse_package(base)
+            except Exception:
+                packages[base] = None
+
+        if packages[base] is not None:
+            yield parse_release(key, packages[base])
@@ -3,86 +3,275 @@
 
 from __future__ import print_function
 
+import re
 import sys
+import csv
+import json
+import heapq
+import fnmatch
+from collections import OrderedDict
 from collections import defaultdict
-from pkg_resources import safe_name
 
 from . import get_settings
 from . import get_bucket_conn
+from .index import open_index
+from .index import find_releases
+from .index import find_all_releases
+from .retry import get_executor
+from .retry import print_summary
+from .utils import list_packages
+from .utils import matches_specs
 from .utils import parse_package
-from .utils import parse_package_file
+from .utils import ReleaseVersions
 
 
-def list_package(bucket, package):
+# output formats, besides the default human readable text
+FORMATS = ("text", "json", "ndjson", "csv")
+
+# what is written of each release, or package name, in the other formats
+RELEASE_FIELDS = (
+    "key", "project", "version", "type", "size", "last_modified", "etag",
+)
+NAME_FIELDS = ("name",)
+
+
+class RecordWriter(object):
+    """Writes items to stdout in one of FORMATS as they are given.
+
+    Each item is flushed once written, so a pipe can start on it right
+    away. A json array is opened by the first item and closed by close().
+    """
+
+    def __init__(self, format_, fields, record, text):
+        """Args:
+            format_: string output format, one of FORMATS
+            fields: tuple of string field names
+            record: function returning the tuple of field values of an item
+            text: function returning the text line of an item
+        """
+
+        self.format = format_
+        self.fields = fields
+        self.record = record
+        self.text = text
+        self.count = 0
+        self.stream = sys.stdout
+        if format_ == "csv":
+            self.csv = csv.writer(self.stream, lineterminator="\n")
+            self.csv.writerow(fields)
+
+    def write(self, item):
+        """Writes a single item."""
+
+        if self.format == "csv":
+            self.csv.writerow(self.record(item))
+        elif self.format in ("json", "ndjson"):
+            line = json.dumps(OrderedDict(zip(
+                self.fields,
+                self.record(item),
+            )))
+            if self.format == "json":
+                line = "{}{}".format(",\n" if self.count else "[\n", line)
+            else:
+                line += "\n"
+            self.stream.write(line)
+        else:
+            self.stream.write("{}\n".format(self.text(item)))
+
+        self.count += 1
+        self.stream.flush()
+
+    def close(self):
+        """Finishes the output, after the last record."""
+
+        if self.format == "json":
+            self.stream.write("\n]\n" if self.count else "[]\n")
+            self.stream.flush()
+
+
+def release_record(release):
+    """Returns the RELEASE_FIELDS values of a Release object."""
+
+    key = release.key
+    return (
+        key.name,
+        release.project,
+        str(release.version),
+        release.type,
+        key.size,
+        key.last_modified,
+        key.etag.strip('"') if key.etag else key.etag,
+    )
+
+
+def release_text(release):
+    """Returns the human readable line for a Release object."""
+
+    return "{}=={} : {}".format(
+        release.project,
+        release.version,
+        release.key.name.partition("/")[2],
+    )
+
+
+def release_writer(format_="text"):
+    """Returns a RecordWriter for Release objects."""
+
+    return RecordWriter(format_, RELEASE_FIELDS, release_record, release_text)
+
+
+def name_writer(format_="text"):
+    """Returns a RecordWriter for string package names."""
+
+    return RecordWriter(format_, NAME_FIELDS, lambda name: (name,),
+                        lambda name: name)
+
+
+def list_package(bucket, package, writer=None, unsorted=False, latest=None):
     """List the available releases a package, optionally package+release.
 
     Args::
 
-        bucket: a connected S3 bucket object to look for package in
+        bucket: a connected S3 bucket object or index to look for package in
         package: parsed package object requested
-
-    Returns:
-        string URL to download the package at release or latest
+        writer: RecordWriter to write releases to, defaults to text
+        unsorted: boolean to write releases as they are listed, rather
+                  than newest version first
+        latest: integer number of the newest versions to write, or None
+                for all of them. Not used when unsorted
     """
 
-    # figure out key name from package and release requested and what's
-    # available in the bucket...
-    pkg_name = None if package is None else package.project_name
-    package_releases = []
-    for key in bucket.get_all_keys():
-        if package is None or key.name.startswith("{}/".format(pkg_name)):
-            package_base, _, pkg_full_name = key.name.partition("/")
-            if not pkg_full_name:
-                continue
-            if package is None:
-                if package_base not in package_releases:
-                    package_releases.append(package_base)
-            elif pkg_name == safe_name(package_base):
-                key_pkg = parse_package_file(pkg_full_name, package)
-                for spec in package.specs:
-                    if not spec[0](key_pkg.specs[0][1], spec[1]):
-                        break
-                else:
-                    package_releases.append(pkg_full_name)
-
     if package is None:
-        package_releases.sort()
-        print("\n".join(package_releases))
+        list_names(bucket)
+    elif unsorted:
+        writer = writer or release_writer()
+        for release in find_releases(bucket, package):
+            if matches_specs(release.version, package.specs):
+                writer.write(release)
     else:
-        print_versioned(package_releases, package)
+        print_versioned(ReleaseVersions(
+            find_releases(bucket, package),
+        ).select(package.specs), writer, latest)
 
 
-def print_versioned(package_releases, package):
-    """Prints package releases to stdout in order of version number."""
+def list_latest(bucket, count, writer=None):
+    """Writes the newest count versions of every package in the bucket.
+
+    The bucket, or index, is read once. Only the newest count versions seen
+    of each package are kept, in a min-heap per package, so memory grows
+    with the number of packages rather than the number of keys.
+
+    Args::
+
+        bucket: a connected S3 bucket object or index to list
+        count: integer number of versions to write per package
+        writer: RecordWriter to write releases to, defaults to text
+    """
+
+    writer = writer or release_writer()
+
+    heaps = defaultdict(list)  # the versions kept of each project
+    kept = defaultdict(dict)  # {project: {version: [Release, ...]}}
+    for release in find_all_releases(bucket):
+        versions = kept[release.project]
+        if release.version in versions:
+            versions[release.version].append(release)
+            continue
+
+        heap = heaps[release.project]
+        if len(heap) < count:
+            heapq.heappush(heap, release.version)
+        elif heap and release.version > heap[0]:
+            del versions[heapq.heapreplace(heap, release.version)]
+        else:
+            continue
+        versions[release.version] = [release]
+
+    for project in sorted(kept):
+        print_versioned([
+            release for releases in kept[project].values()
+            for release in releases
+        ], writer)
+
+
+def list_names(bucket, pattern=None, regex=False, writer=None):
+    """Writes the package names in the bucket as they are listed.
+
+    Args::
+
+        bucket: a connected S3 bucket object or index to list
+        pattern: string glob package names must match, or None for all
+        regex: boolean to search names with pattern as a regex instead
+        writer: RecordWriter to write names to, defaults to text
+    """
+
+    writer = writer or name_writer()
+
+    prefix = ""
+    matcher = None
+    if pattern and regex:
+        matcher = re.compile(pattern).search
+    elif pattern:
+        # only the names starting with the glob's literal start are listed
+        prefix = re.split(r"[*?[]", pattern)[0]
+        matcher = re.compile(fnmatch.translate(pattern)).match
+
+    for name in list_packages(bucket, prefix):
+        if matcher is None or matcher(name):
+            writer.write(name)
+
+
+def print_versioned(package_releases, writer=None, latest=None):
+    """Writes package releases in order of version number, newest first.
+
+    Args:
+        package_releases: list of Release objects
+        writer: RecordWriter to write releases to, defaults to text
+        latest: integer number of the newest versions to write, or None
+    """
+
+    writer = writer or release_writer()
 
     # sort them via pkg_resources' version sorting
     versioned = defaultdict(list)
-    for package_file in package_releases:
-        package_release = parse_package_file(package_file, package)
-
-        versioned[package_release.specs[0][1]].append(("{}=={} : {}".format(
-            package_release.project_name,
-            package_release.specs[0][1],
-            package_file,
-        )))
+    for release in package_releases:
+        versioned[release.version].append(release)
 
-    # finally print them to stdout in order of newest first
-    ver_order = sorted(versioned)
-    for version_releases in reversed(ver_order):
-        for version_release in versioned[version_releases]:
-            print(version_release)
+    # finally write them out in order of newest first
+    for version in sorted(versioned, reverse=True)[:latest]:
+        for release in versioned[version]:
+            writer.write(release)
 
 
 def main():
     """Main command line entry point for listing."""
 
     settings = get_settings(listing=True)
-    bucket = get_bucket_conn(settings.s3)
+    get_executor(settings.parsed)
+    bucket = open_index(
+        get_bucket_conn(settings.s3, validate=False),
+        settings,
+    )
+
+    options = settings.parsed
+    if settings.items or options.latest:
+        writer = release_writer(options.format)
+    else:
+        writer = name_writer(options.format)
 
     for package in settings.items or [None]:
         try:
-            list_package(bucket, parse_package(package))
+            if package is None and options.latest:
+                list_latest(bucket, options.latest, writer)
+            elif package is None:
+                list_names(bucket, options.match, options.regex, writer)
+            else:
+                list_package(bucket, parse_package(package), writer,
+                             options.unsorted, options.latest)
         except Exception as err:
             print("Error listing {}: {}".format(package, err),
                   file=sys.stderr)
             break
+
+    writer.close()
+    print_summary()
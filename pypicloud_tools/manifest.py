@@ -0,0 +1,190 @@
+"""Per-package manifests kept in the bucket alongside the releases."""
+
+
+import json
+import datetime
+
+from .retry import get_executor
+
+
+# bump this when the manifest layout changes, older manifests are ignored
+MANIFEST_FORMAT = 1
+
+# attributes of each release key recorded in the manifest
+KEY_FIELDS = ("size", "etag", "last_modified")
+
+# how the `updated` time of a manifest is written, ignoring microseconds
+UPDATED_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+def manifest_name(manifest_prefix, package_base):
+    """Returns the string key name of a package's manifest."""
+
+    return "{}/{}.json".format(manifest_prefix.rstrip("/"), package_base)
+
+
+def read_manifest(bucket, manifest_prefix, package_base, max_age=None):
+    """Reads a package's manifest from the bucket with a single GET.
+
+    Releases written to the bucket by anything but upload and rehost, or
+    removed from it, are only seen once the manifest is rebuilt. Manifests
+    older than max_age are considered stale for that reason.
+
+    Args:
+        bucket: a connected S3 bucket object
+        manifest_prefix: string key prefix the manifests are stored under
+        package_base: string key prefix of the package, without the "/"
+        max_age: integer seconds since the manifest was written to trust
+                 it for, 0 or None to trust it regardless of age
+
+    Returns:
+        a list of boto Key objects for the package's releases, or None if the
+        manifest is missing, stale or in a format this version does not
+        understand
+    """
+
+    from boto.s3.key import Key
+    from boto.exception import S3ResponseError
+
+    manifest_key = bucket.new_key(manifest_name(manifest_prefix, package_base))
+    try:
+        manifest = json.loads(get_executor().call(
+            manifest_key.get_contents_as_string,
+        ).decode())
+    except (S3ResponseError, ValueError):
+        return None
+
+    if manifest.get("format") != MANIFEST_FORMAT:
+        return None
+    if max_age:
+        age = manifest_age(manifest)
+        if age is None or age > max_age:
+            return None
+
+    keys = []
+    for file_name, attributes in sorted(manifest["files"].items()):
+        key = Key(bucket, "{}/{}".format(package_base, file_name))
+        for field in KEY_FIELDS:
+            setattr(key, field, attributes[field])
+        keys.append(key)
+    return keys
+
+
+def manifest_age(manifest):
+    """Returns the seconds since manifest was written, None if unknown."""
+
+    try:
+        updated = datetime.datetime.strptime(
+            manifest["updated"][:19],
+            UPDATED_FORMAT,
+        )
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    return (datetime.datetime.utcnow() - updated).total_seconds()
+
+
+def write_manifest(bucket, manifest_prefix, package_base, keys, acl=None):
+    """Writes the manifest of a package, replacing any previous one.
+
+    Args:
+        bucket: a connected S3 bucket object
+        manifest_prefix: string key prefix the manifests are stored under
+        package_base: string key prefix of the package, without the "/"
+        keys: list of boto Key objects for all of the package's releases
+        acl: optional canned ACL string to apply to the manifest
+    """
+
+    manifest = {
+        "format": MANIFEST_FORMAT,
+        "package": package_base,
+        "updated": datetime.datetime.utcnow().isoformat(),
+        "files": dict((
+            key.name.partition("/")[2],
+            dict((field, getattr(key, field)) for field in KEY_FIELDS),
+        ) for key in keys),
+    }
+
+    manifest_key = bucket.new_key(manifest_name(manifest_prefix, package_base))
+    get_executor().call(
+        manifest_key.set_contents_from_string,
+        json.dumps(manifest, sort_keys=True),
+        headers={"Content-Type": "application/json"},
+        policy=acl,
+    )
+
+
+def update_manifests(bucket, manifest_prefix, key_names, acl=None, retries=3):
+    """Rebuilds the manifests of every package key_names belong to.
+
+    Each manifest is rebuilt from a listing of the package's prefix, then the
+    prefix is listed again to make sure no other upload finished in the mean
+    time. If one did, the manifest is rebuilt to include it.
+
+    Args:
+        bucket: a connected S3 bucket object
+        manifest_prefix: string key prefix the manifests are stored under
+        key_names: iterable of string key names which were just uploaded
+        acl: optional canned ACL string to apply to the manifests
+        retries: number of times to rebuild a manifest that went stale
+    """
+
+    for package_base in sorted(set(
+            name.partition("/")[0] for name in key_names)):
+        prefix = "{}/".format(package_base)
+        keys = _release_keys(bucket, prefix)
+        for _ in range(retries + 1):
+            write_manifest(bucket, manifest_prefix, package_base, keys, acl)
+            relisted = _release_keys(bucket, prefix)
+            if _signature(relisted) == _signature(keys):
+                break
+            keys = relisted
+
+
+def _release_keys(bucket, prefix):
+    """Lists all release keys under prefix."""
+
+    return [key for key in get_executor().listing(bucket, prefix)
+            if key.name.partition("/")[2]]
+
+
+def _signature(keys):
+    """Returns a comparable summary of the listed keys."""
+
+    return set((key.name, key.etag) for key in keys)
+
+
+class ManifestBucket(object):
+    """Bucket stand in which answers package listings from manifests.
+
+    Listing a package's prefix fetches its manifest instead, falling back to
+    listing the bucket when the manifest is missing or older than max_age
+    seconds. The manifests themselves are hidden from listings of the whole
+    bucket.
+    """
+
+    def __init__(self, bucket, manifest_prefix, read=True, max_age=None):
+        self.bucket = bucket
+        self.manifest_prefix = "{}/".format(manifest_prefix.rstrip("/"))
+        self.read = read
+        self.max_age = max_age
+
+    def __getattr__(self, attr):
+        return getattr(self.bucket, attr)
+
+    def list(self, prefix="", delimiter="", marker=""):
+        """Bucket.list() stand in, preferring manifests for packages."""
+
+        package_base, slash, rest = prefix.partition("/")
+        if self.read and package_base and slash and not rest and \
+                prefix != self.manifest_prefix:
+            keys = read_manifest(self.bucket, self.manifest_prefix,
+                                 package_base, self.max_age)
+            if keys is not None:
+                return [key for key in keys if key.name > marker]
+
+        return (
+            key for key in get_executor().listing(self.bucket, prefix,
+                                                  delimiter, marker)
+            if not key.name.startswith(self.manifest_prefix)
+        )
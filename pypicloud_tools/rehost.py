@@ -1,21 +1,51 @@
 """Rehosts packages from PyPI in pypicloud."""
 
 
+from __future__ import print_function
+
 import os
-import pip
+import sys
 import shutil
+import time
 import logging
 import tempfile
-from pip.index import egg_info_matches
-from pkg_resources import SetuptoolsVersion
-from pkg_resources import parse_requirements
+import functools
+import threading
+import subprocess
+from collections import namedtuple
+from collections import OrderedDict
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import queue  # python 3+
+except ImportError:  # pragma: no cover
+    import Queue as queue
 
-from . import Settings
 from . import get_settings
 from . import get_bucket_conn
-from . import OPERATORS
-from . import SUPPORTED_EXTENSIONS
-from .upload import upload_files
+from .index import open_index
+from .retry import get_executor
+from .upload import upload_file
+from .retry import print_summary
+from .upload import upload_stream
+from .upload import finish_uploads
+from .upload import package_key_name
+from .utils import matches_specs
+from .utils import canonical_name
+from .utils import parse_package
+from .utils import parse_filename
+from .utils import ReleaseVersions
+
+
+# ends the items put on a RehostPipeline queue
+_END = object()
+
+# held while moving fetched files into the temporary storage
+_storage_lock = threading.Lock()
+
+# a file fetched into the temporary storage, with its parsed version
+StagedFile = namedtuple("StagedFile", ("file_name", "version"))
 
 
 class TempDir(object):
@@ -30,70 +60,703 @@ class TempDir(object):
         shutil.rmtree(self.dir)
 
 
-def find_downloaded(packages, storage_dir):
+class HostedFiles(object):
+    """The release files already in the bucket, as rehost checks them.
+
+    Each package prefix is listed once, from the bucket or its index. The
+    files, and bytes, skipped as already hosted and transferred are counted
+    for summary().
+    """
+
+    def __init__(self, bucket, force=False):
+        """Args:
+            bucket: a connected S3 bucket object or index
+            force: boolean to consider nothing as already hosted
+        """
+
+        self.bucket = bucket
+        self.force = force
+        self.skipped = [0, 0]  # files, bytes
+        self.transferred = [0, 0]
+        self._listings = {}
+        self._lock = threading.Lock()
+
+    def size(self, filename):
+        """Returns the size of the key filename uploads to, None if absent."""
+
+        key_name = package_key_name(filename)
+        prefix = "{}/".format(key_name.partition("/")[0])
+        with self._lock:
+            listing = self._listings.get(prefix)
+
+        if listing is None:
+            listing = dict(
+                (key.name, key.size)
+                for key in get_executor().listing(self.bucket, prefix)
+            )
+            with self._lock:
+                self._listings[prefix] = listing
+
+        return listing.get(key_name)
+
+    def is_released(self, package, upstream_url):
+        """Checks if the release PyPI has for package is already hosted.
+
+        The newest release matching package is the version pip would pick.
+        Any file of it being in the bucket, with the size PyPI lists for it,
+        counts as that version being hosted, as pip only fetches one of its
+        files. The other files are left to --stream, which checks each one.
+
+        Args:
+            package: string package name, perhaps version specific
+            upstream_url: string URL of PyPI's JSON API
+
+        Returns:
+            boolean, True when package doesn't need fetching
+        """
+
+        if self.force:
+            return False
+
+        hosted = [
+            size for filename, size in upstream_files(package, upstream_url)
+            if parse_filename(filename) and self.size(filename) == size
+        ]
+        if not hosted:
+            return False
+
+        self._count(self.skipped, *hosted)
+        return True
+
+    def is_hosted(self, filename, size):
+        """Checks if filename is in the bucket already, with size bytes.
+
+        The file is counted as skipped if it is, transferred if not.
+        """
+
+        if not self.force and self.size(filename) == size:
+            self._count(self.skipped, size)
+            return True
+
+        self._count(self.transferred, size)
+        return False
+
+    def missing(self, paths):
+        """Returns the paths of the local files not already hosted."""
+
+        return [
+            path for path in paths
+            if not self.is_hosted(path, os.path.getsize(path))
+        ]
+
+    def summary(self):
+        """Returns a string summary of the files skipped and transferred."""
+
+        return ("Skipped {} file(s), {} bytes, already in the bucket. "
+                "Transferred {} file(s), {} bytes.").format(
+                    self.skipped[0],
+                    self.skipped[1],
+                    self.transferred[0],
+                    self.transferred[1],
+                )
+
+    def _count(self, counter, *sizes):
+        """Adds files of sizes to counter."""
+
+        with self._lock:
+            counter[0] += len(sizes)
+            counter[1] += sum(sizes)
+
+
+def upstream_files(package, upstream_url):
+    """Lists the files of the newest release on PyPI matching package.
+
+    Args:
+        package: string package name, perhaps version specific
+        upstream_url: string URL of PyPI's JSON API
+
+    Returns:
+        list of (filename, size) tuples, empty if PyPI couldn't be asked
+    """
+
+    return [
+        (file_["filename"], file_["size"])
+        for file_ in upstream_release(package, upstream_url)
+    ]
+
+
+def upstream_release(package, upstream_url):
+    """Looks up the files of the newest release on PyPI matching package.
+
+    Like pip, pre-releases are only considered when package asks for one.
+
+    Args:
+        package: string package name, perhaps version specific
+        upstream_url: string URL of PyPI's JSON API
+
+    Returns:
+        list of the file dicts of the release from PyPI's JSON API, with
+        `filename`, `size`, `url` and `digests` keys. Empty if PyPI couldn't
+        be asked
+    """
+
+    import requests
+    from pkg_resources import SetuptoolsVersion
+
+    parsed = parse_package(package)
+    try:
+        response = requests.get(
+            "{}/{}/json".format(upstream_url.rstrip("/"), parsed.project_name),
+            timeout=30,
+        )
+        response.raise_for_status()
+        releases = response.json()["releases"]
+    except Exception as error:
+        logging.info("could not look up %s on PyPI: %s", package, error)
+        return []
+
+    pre = any(spec[1].is_prerelease for spec in parsed.specs)
+    newest = None
+    for version, files in releases.items():
+        try:
+            version = SetuptoolsVersion(version)
+        except Exception:
+            continue
+        files = [file_ for file_ in files if not file_.get("yanked")]
+        if files and (pre or not version.is_prerelease) and \
+                matches_specs(version, parsed.specs) and \
+                (newest is None or version > newest[0]):
+            newest = (version, files)
+
+    if newest is None:
+        return []
+    return newest[1]
+
+
+def fetch_package(package, storage_dir):
+    """Downloads package and its dependencies from PyPI into storage_dir.
+
+    pip is run in its own process, as pip.main() can't be called from more
+    than one thread at once. Files are downloaded to a directory of their
+    own, then moved into storage_dir, unless a file of the same name is there
+already, keeping a single copy of each file.
+
+    Args:
+        package: string package name, perhaps version specific
+        storage_dir: full string filepath to the temporary storage
+
+    Returns:
+        list of string filenames fetched for package
+    """
+
+    download_dir = tempfile.mkdtemp(dir=storage_dir)
+    try:
+        process = subprocess.Popen(
+            [sys.executable, "-m", "pip", "install", "--download",
+             download_dir, package],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        output = process.communicate()[0]
+        if process.returncode:
+            raise RuntimeError("pip exited with {}:\n{}".format(
+                process.returncode,
+                output.decode("utf-8", "replace"),
+            ))
+
+        fetched = os.listdir(download_dir)
+        for file_ in fetched:
+            # dependencies shared by packages are fetched by each of them,
+            # the first copy is kept as a later stage may be reading it
+            target = os.path.join(storage_dir, file_)
+            with _storage_lock:
+                if not os.path.exists(target):
+                    os.rename(os.path.join(download_dir, file_), target)
+        return fetched
+    finally:
+        shutil.rmtree(download_dir)
+
+
+def _fetch_missing(package, storage_dir, hosted, upstream_url, deps=False):
+    """Fetches package, unless hosted has it already.
+
+    With deps, package is always fetched, its dependencies may be missing.
+
+    Returns:
+        list of string filenames fetched, or None if skipped
+    """
+
+    if hosted is not None and not deps and \
+            hosted.is_released(package, upstream_url):
+        return None
+    return fetch_package(package, storage_dir)
+
+
+def stream_packages(settings, bucket, hosted):
+    """Copies releases from PyPI straight into the bucket, without disk.
+
+    Every file of the newest release of each package matching its specs is
+    read from PyPI while it is uploaded, verified against the digests PyPI
+    lists for it. Dependencies are not resolved. Up to `jobs` files are
+    copied at once, sending their parts through one pool of `part_workers`
+    threads, with at most `part_workers + jobs` parts held in memory.
+
+    Args:
+        settings: Settings object, with tunables filled in on `parsed`
+        bucket: a connected S3 bucket object
+        hosted: HostedFiles object, to skip the files already in the bucket
+
+    Returns:
+        integer number of packages or files which failed to copy
+    """
+
+    options = settings.parsed
+    packages = list(OrderedDict.fromkeys(settings.items))  # drop repeats
+    jobs = max(options.jobs, 1)
+    part_workers = max(options.part_workers, 1)
+    buffers = threading.BoundedSemaphore(part_workers + jobs)
+
+    errors = 0
+    copies = []
+    with ThreadPoolExecutor(max_workers=part_workers) as pool:
+        with ThreadPoolExecutor(max_workers=jobs) as files_pool:
+            releases = [(package, files_pool.submit(
+                upstream_release,
+                package,
+                options.upstream_url,
+            )) for package in packages]
+
+            for package, release in releases:
+                files = [
+                    file_ for file_ in release.result()
+                    if parse_filename(file_["filename"])
+                ]
+                if not files:
+                    print("Error rehosting {}: no release found on PyPI"
+                          .format(package), file=sys.stderr)
+                    errors += 1
+
+                for file_ in files:
+                    if hosted.is_hosted(file_["filename"], file_["size"]):
+                        print("Skipping {}, it is already in the bucket"
+                              .format(file_["filename"]))
+                        continue
+                    copies.append((file_["filename"], files_pool.submit(
+                        stream_file,
+                        file_,
+                        bucket,
+                        settings.s3,
+                        options,
+                        pool,
+                        buffers,
+                    )))
+
+            uploaded = []
+            for filename, copy in copies:
+                try:
+                    uploaded.append(copy.result())
+                    print("Copied {} from PyPI".format(filename))
+                except Exception as error:
+                    print("Error copying {}: {}".format(filename, error),
+                          file=sys.stderr)
+                    errors += 1
+
+    if uploaded and not errors:
+        finish_uploads(settings, bucket, uploaded)
+    return errors
+
+
+def stream_file(file_, bucket, s3_config, options, pool, buffers):
+    """Copies a single file from PyPI into the bucket.
+
+    Args:
+        file_: dict of the file from PyPI's JSON API
+        bucket: a connected S3 bucket object
+        s3_config: S3Config object, for the ACL to upload with
+        options: parsed NameSpace, with the tunable options filled in
+        pool: ThreadPoolExecutor to send the parts with
+        buffers: threading.Semaphore bounding the parts held in memory
+
+    Returns:
+        the string key name uploaded to
+    """
+
+    import requests
+
+    response = requests.get(file_["url"], stream=True, timeout=30)
+    try:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        return upload_stream(
+            response.raw,
+            package_key_name(file_["filename"]),
+            file_["size"],
+            bucket,
+            s3_config,
+            options,
+            pool,
+            buffers,
+            file_.get("digests"),
+        )
+    finally:
+        response.close()
+
+
+class StageStats(object):
+    """Counts what a pipeline stage handled, and how full its queue was."""
+
+    def __init__(self, name, unit):
+        """Args:
+            name: string name of the stage
+            unit: string plural of what the stage handles, i.e. "files"
+        """
+
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0  # seconds spent working, summed over the workers
+        self.waiting = 0  # items queued, summed over each item taken
+        self.max_waiting = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds, bytes, waiting):
+        """Counts a single item handled.
+
+        Args:
+            seconds: float time spent working on the item
+            bytes: integer size of the item
+            waiting: integer items left queued when it was taken
+        """
+
+        with self._lock:
+            self.items += 1
+            self.bytes += bytes
+            self.busy += seconds
+            self.waiting += waiting
+            self.max_waiting = max(self.max_waiting, waiting)
+
+    def summary(self, elapsed):
+        """Returns a line of the stage's throughput over elapsed seconds."""
+
+        elapsed = max(elapsed, 0.001)
+        return (
+            "{name}: {items} {unit}, {mb:.1f} MB in {elapsed:.1f}s "
+            "({rate:.1f} {unit}/s, {mbps:.2f} MB/s), {busy:.1f}s busy, "
+            "queue depth {avg:.1f} avg, {max} max"
+        ).format(
+            name=self.name,
+            items=self.items,
+            unit=self.unit,
+            mb=self.bytes / 1048576.0,
+            elapsed=elapsed,
+            rate=self.items / elapsed,
+            mbps=self.bytes / 1048576.0 / elapsed,
+            busy=self.busy,
+            avg=float(self.waiting) / self.items if self.items else 0.0,
+            max=self.max_waiting,
+        )
+
+
+class RehostPipeline(object):
+    """Fetches, picks and uploads packages in overlapping stages.
+
+    Up to `jobs` pip processes fetch packages, a single thread picks which
+    of the files fetched to upload, and up to `jobs` threads upload them.
+    The stages are joined by bounded queues, so uploading one package's
+    files overlaps with fetching the next package, and a slow stage holds
+    up the stages feeding it rather than letting work pile up on disk.
+    """
+
+    def __init__(self, settings, bucket, hosted, storage_dir):
+        """Args:
+            settings: Settings object, with tunables filled in on `parsed`
+            bucket: a connected S3 bucket object
+            hosted: HostedFiles object, to skip what is already in the bucket
+            storage_dir: full string filepath to the temporary storage
+        """
+
+        self.settings = settings
+        self.options = settings.parsed
+        self.bucket = bucket
+        self.hosted = hosted
+        self.storage_dir = storage_dir
+        self.jobs = max(self.options.jobs, 1)
+        self.stats = (
+            StageStats("fetch", "packages"),
+            StageStats("filter", "files"),
+            StageStats("upload", "files"),
+        )
+        self.errors = 0
+        self.failed = False  # an upload failed, the rest are skipped
+        self.uploaded = []
+        self._picked = set()
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Rehosts every package, then updates PyPICloud.
+
+        PyPICloud is not updated if an upload failed.
+
+        Returns:
+            integer number of packages or files which failed
+        """
+
+        packages = list(OrderedDict.fromkeys(self.settings.items))
+        pending = queue.Queue()
+        for package in packages:
+            pending.put(package)
+        pending.put(_END)
+
+        fetched = queue.Queue(maxsize=self.jobs)
+        to_upload = queue.Queue(maxsize=self.jobs * 2)
+
+        started = time.time()
+        part_workers = max(self.options.part_workers, 1)
+        with ThreadPoolExecutor(max_workers=part_workers) as pool:
+            threads = (
+                self._stage(self._fetch, pending, fetched,
+                            min(self.jobs, len(packages)) or 1,
+                            self.stats[0]) +
+                self._stage(self._filter, fetched, to_upload, 1,
+                            self.stats[1]) +
+                self._stage(functools.partial(self._upload, pool), to_upload,
+                            None, self.jobs, self.stats[2])
+            )
+            for thread in threads:
+                thread.join()
+        elapsed = time.time() - started
+
+        if self.uploaded and not self.failed:
+            finish_uploads(self.settings, self.bucket, self.uploaded)
+
+        for stats in self.stats:
+            print(stats.summary(elapsed))
+        return self.errors
+
+    def _stage(self, work, inbox, outbox, workers, stats):
+        """Starts threads running work on each item taken from inbox.
+
+        Args:
+            work: function of an item, returning a tuple of the list of
+                  items to put in outbox and the integer bytes handled
+            inbox: Queue to take items from, until _END is taken
+            outbox: Queue for the next stage, ended once every worker is
+                    done, or None for the last stage
+            workers: integer number of threads to start
+            stats: StageStats object to count the items handled in
+
+        Returns:
+            list of the started threads
+        """
+
+        running = [workers]
+
+        def worker():
+            while True:
+                item = inbox.get()
+                if item is _END:
+                    inbox.put(_END)  # for the other workers
+                    break
+                waiting = inbox.qsize()
+                started = time.time()
+                try:
+                    results, size = work(item)
+                except Exception as error:
+                    print("Error in {} stage: {}".format(stats.name, error),
+                          file=sys.stderr)
+                    self._error()
+                    results, size = [], 0
+                stats.record(time.time() - started, size, waiting)
+                for result in results:
+                    outbox.put(result)
+
+            with self._lock:
+                running[0] -= 1
+                last = not running[0]
+            if last and outbox is not None:
+                outbox.put(_END)
+
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def _error(self):
+        with self._lock:
+            self.errors += 1
+
+    def _fetch(self, package):
+        """Fetch stage, puts (package, [path, ...]) for the filter stage."""
+
+        try:
+            fetched = _fetch_missing(package, self.storage_dir, self.hosted,
+                                     self.options.upstream_url,
+                                     self.options.deps)
+        except Exception as error:
+            print("Error fetching {}: {}".format(package, error),
+                  file=sys.stderr)
+            self._error()
+            return [], 0
+
+        if fetched is None:
+            print("Skipping {}, it is already in the bucket".format(package))
+            return [], 0
+
+        print("Fetched {}: {}".format(package, ", ".join(sorted(fetched))))
+        paths = [os.path.join(self.storage_dir, file_) for file_ in fetched]
+        return [(package, paths)], sum(_file_size(path) for path in paths)
+
+    def _filter(self, fetched):
+        """Filter stage, puts the paths of files to upload.
+
+        Without --deps only the files of the package itself are picked.
+        Files are picked once, however many packages fetched them, and
+        must be non-empty release files not in the bucket already.
+        """
+
+        package, paths = fetched
+        if not self.options.deps:
+            paths = find_downloaded(
+                [package],
+                self.storage_dir,
+                [os.path.basename(path) for path in paths],
+            )
+
+        picked = []
+        for path in paths:
+            file_ = os.path.basename(path)
+            if file_ in self._picked:
+                continue
+            self._picked.add(file_)
+            if parse_filename(file_) is None:
+                logging.info("file %s skipped, not a release file", file_)
+            elif not _file_size(path):
+                print("Error uploading {}: the file is empty".format(path),
+                      file=sys.stderr)
+                self._error()
+            else:
+                picked.append(path)
+
+        return self.hosted.missing(picked), sum(map(_file_size, picked))
+
+    def _upload(self, pool, path):
+        """Upload stage, the last, uploading a single file."""
+
+        if self.failed:
+            return [], 0
+
+        try:
+            key_name = upload_file(path, self.bucket, self.settings.s3,
+                                   self.options, pool, False)
+        except Exception as error:
+            print("Error uploading {}: {}".format(path, error),
+                  file=sys.stderr)
+            with self._lock:
+                self.errors += 1
+                self.failed = True
+            return [], 0
+
+        with self._lock:
+            self.uploaded.append(key_name)
+        return [], _file_size(path)
+
+
+def _file_size(path):
+    """Returns the size of the file at path, or 0 if it's gone."""
+
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def find_downloaded(packages, storage_dir, files=None):
     """Filters out the requested packages' dependencies in storage_dir.
 
+    Every file is parsed once into an index of each project's files, by
+    version. Each package is then looked up by its PEP 503 name, picking
+    every file of the newest version matching its specs.
+
     Args::
 
         packages: list of package names, perhaps version specific
         storage_dir: full string filepath to the temporary storage
+        files: list of string filenames to pick from, defaults to every
+               file in storage_dir
 
     Returns:
         a list of string full file paths of package releases to upload
     """
 
+    index = staged_index(os.listdir(storage_dir) if files is None else files)
+
     to_upload = []
-    files_on_disk = os.listdir(storage_dir)
     for package in packages:
-        parsed = list(parse_requirements(package))[0]
-        for file_ in files_on_disk:
-            if parsed.project_name not in file_:
-                continue
-            for ext in SUPPORTED_EXTENSIONS:
-                if file_.endswith(ext):
-                    file_ver = SetuptoolsVersion(egg_info_matches(
-                        file_.split(ext)[0],
-                        parsed.project_name,
-                        file_,
-                    ))
-                    break
-            else:
-                logging.info("file %s skipped, unsupported extension", file_)
-                continue
-            for spec in parsed.specs:
-                req_ver = SetuptoolsVersion(spec[1])
-                if not OPERATORS[spec[0]](file_ver, req_ver):
-                    logging.info("downloaded file %s is not %s %s", file_,
-                                 spec[0], spec[1])
-                    break
-            else:
-                to_upload.append(os.path.join(storage_dir, file_))
-                break
+        parsed = parse_package(package)
+        found = index.get(canonical_name(parsed.project_name))
+        picked = found.latest(parsed.specs) if found else []
+        if not picked:
+            logging.info("no downloaded file matches %s", package)
+        to_upload.extend(
+            os.path.join(storage_dir, staged.file_name) for staged in picked
+        )
 
     return to_upload
 
 
+def staged_index(files):
+    """Indexes the release files fetched by their normalized project name.
+
+    Args:
+        files: list of string filenames
+
+    Returns:
+        dictionary of {canonical project name: ReleaseVersions object of
+        StagedFile objects}
+    """
+
+    from pkg_resources import SetuptoolsVersion
+
+    projects = defaultdict(list)
+    for file_ in sorted(files):
+        parsed = parse_filename(file_)
+        if parsed is None:
+            logging.info("file %s skipped, unsupported extension", file_)
+            continue
+        try:
+            version = SetuptoolsVersion(parsed.version)
+        except Exception:
+            logging.info("file %s skipped, unknown version", file_)
+            continue
+        projects[canonical_name(parsed.name)].append(
+            StagedFile(file_, version),
+        )
+
+    return dict(
+        (name, ReleaseVersions(staged)) for name, staged in projects.items()
+    )
+
+
 def main():
     """Entry point for rehosting PyPI packages on pypicloud."""
 
     settings = get_settings(rehost=True)
-    bucket = get_bucket_conn(settings.s3)
-
-    with TempDir() as storage:
-        for package in settings.items:
-            pip.main(["install", "--download", storage.dir, package])
-
-        if settings.parsed.deps:
-            up_files = [
-                os.path.join(storage.dir, f) for f in os.listdir(storage.dir)
-            ]
-        else:
-            up_files = find_downloaded(settings.items, storage.dir)
-
-        upload_settings = Settings(
-            settings.s3,
-            settings.pypi,
-            up_files,
-            settings.parsed,
-        )
-        upload_files(upload_settings, bucket)
+    options = settings.parsed
+    if options.stream and options.deps:
+        raise SystemExit("--stream can't rehost dependencies, use either "
+                         "--stream or --deps")
+
+    get_executor(options)
+    bucket = get_bucket_conn(settings.s3, validate=False)
+    hosted = HostedFiles(open_index(bucket, settings), options.force)
+
+    if options.stream:
+        stream_packages(settings, bucket, hosted)
+    else:
+        with TempDir() as storage:
+            RehostPipeline(settings, bucket, hosted, storage.dir).run()
+
+    print(hosted.summary())
+    print_summary()
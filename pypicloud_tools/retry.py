@@ -0,0 +1,280 @@
+"""Shared executor for S3 requests, with retries and adaptive concurrency."""
+
+
+from __future__ import print_function
+
+import sys
+import time
+import errno
+import random
+import socket
+import threading
+
+from . import TUNABLES
+
+
+# error codes S3 and other AWS services use to ask clients to slow down
+THROTTLE_CODES = (
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "TooManyRequests",
+)
+
+# other server errors which are worth trying again
+RETRYABLE_CODES = ("RequestTimeout", "InternalError", "ServiceUnavailable")
+RETRYABLE_STATUS = (500, 502, 503, 504)
+
+# socket errors from dropped or refused connections
+NETWORK_ERRNOS = (
+    errno.ECONNABORTED,
+    errno.ECONNREFUSED,
+    errno.ECONNRESET,
+    errno.EHOSTUNREACH,
+    errno.ENETUNREACH,
+    errno.EPIPE,
+    errno.ETIMEDOUT,
+)
+
+# the executor shared by every request made, see get_executor()
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def is_boto_bucket(bucket):
+    """Checks if bucket makes its own S3 requests, rather than standing in.
+
+    A ThreadLocalBucket counts, as its requests are made by the boto Bucket
+    of the calling thread.
+    """
+
+    from boto.s3.bucket import Bucket
+    from . import ThreadLocalBucket
+
+    return isinstance(bucket, (Bucket, ThreadLocalBucket))
+
+
+def is_throttle(error):
+    """Checks if error is S3 asking for fewer requests."""
+
+    from boto.exception import BotoServerError
+
+    return isinstance(error, BotoServerError) and (
+        error.status == 503 or error.error_code in THROTTLE_CODES
+    )
+
+
+def is_retryable(error):
+    """Checks if the request which raised error should be tried again."""
+
+    from boto.exception import BotoServerError
+    try:
+        from http.client import HTTPException  # python 3+
+    except ImportError:  # pragma: no cover
+        from httplib import HTTPException
+
+    if isinstance(error, BotoServerError):
+        return is_throttle(error) or error.status in RETRYABLE_STATUS or \
+            error.error_code in RETRYABLE_CODES
+
+    if isinstance(error, (socket.timeout, HTTPException)):
+        return True
+
+    return isinstance(error, (IOError, OSError)) and \
+        error.errno in NETWORK_ERRNOS
+
+
+class RequestExecutor(object):
+    """Runs S3 requests with retries, sharing one limit of requests in flight.
+
+    Retryable errors are tried again after an exponential backoff with full
+    jitter. The limit starts at max_requests, is halved each time S3
+    throttles a request and grows by one again after as many requests in a
+    row succeed (additive increase, multiplicative decrease).
+
+    The `counters` dict counts the requests made, the retries, the requests
+    throttled and the failures (retryable errors which ran out of retries).
+    """
+
+    def __init__(self, max_requests, retries=5, base_delay=0.1,
+                 max_delay=20.0):
+        self.max_requests = max(max_requests, 1)
+        self.limit = self.max_requests
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = {
+            "requests": 0,
+            "retries": 0,
+            "throttles": 0,
+            "failures": 0,
+        }
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def call(self, func, *args, **kwargs):
+        """Calls func once there is room under the limit, with retries.
+
+        func should make a single request and be safe to call again, for
+        instance by opening any file it reads or writes itself.
+
+        Returns:
+            the return value of func
+
+        Raises:
+            the last error from func, once it is not retryable or the
+            retries have run out
+        """
+
+        for attempt in range(self.retries + 1):
+            self._acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                self._release(error)
+                if not self._should_retry(error, attempt):
+                    raise
+            else:
+                self._release()
+                return result
+
+    def listing(self, bucket, prefix="", delimiter="", marker=""):
+        """Yields the keys of a bucket listing, retrying pages which fail.
+
+        A boto Bucket or ThreadLocalBucket is listed a page of keys at a
+        time, each page being a single request made through call(), so
+        listings are counted and kept under the limit like any other
+        request. A page which fails is requested again from after the last
+        key yielded, so keys are only yielded once.
+
+        Stand ins for a bucket (a ManifestBucket, BucketIndex or a fake) are
+        iterated with their list() as is. They list the bucket they wrap
+        through here themselves, so retrying them as well would multiply
+        the attempts made while S3 is asking for fewer requests.
+
+        Args:
+            bucket: a connected S3 bucket object, or a stand in for one
+            prefix: string key prefix to list
+            delimiter: string delimiter to group keys by
+            marker: string key name to list the keys after
+
+        Yields:
+            boto Key (or Prefix) objects
+        """
+
+        kwargs = {"prefix": prefix}
+        if delimiter:
+            kwargs["delimiter"] = delimiter
+        if marker:
+            kwargs["marker"] = marker
+
+        if is_boto_bucket(bucket):
+            return self._pages(bucket, kwargs)
+        return iter(bucket.list(**kwargs))
+
+    def _pages(self, bucket, kwargs):
+        """Lists a boto Bucket with a request through call() per page."""
+
+        while True:
+            page = self.call(bucket.get_all_keys, **kwargs)
+            for key in page:
+                kwargs["marker"] = key.name
+                yield key
+
+            if not page.is_truncated or not page:
+                return
+            if getattr(page, "next_marker", None):
+                kwargs["marker"] = page.next_marker
+
+    def backoff(self, attempt):
+        """Returns the seconds to wait before retry number attempt + 1."""
+
+        return random.uniform(0, min(
+            self.max_delay,
+            self.base_delay * 2 ** attempt,
+        ))
+
+    def summary(self):
+        """Returns a string summary of the counters and current limit."""
+
+        return ("S3 requests: {requests}, retried: {retries}, throttled: "
+                "{throttles}, failed: {failures}, concurrency: {limit}/{max}"
+                ).format(limit=self.limit, max=self.max_requests,
+                         **self.counters)
+
+    def _should_retry(self, error, attempt):
+        """Counts error, backing off first if it is worth retrying."""
+
+        if not is_retryable(error):
+            return False
+
+        with self._condition:
+            if attempt >= self.retries:
+                self.counters["failures"] += 1
+                return False
+            self.counters["retries"] += 1
+
+        time.sleep(self.backoff(attempt))
+        return True
+
+    def _acquire(self):
+        """Waits until a request can be made under the limit."""
+
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+            self.counters["requests"] += 1
+
+    def _release(self, error=None):
+        """Frees the request's place, adjusting the limit by its outcome."""
+
+        with self._condition:
+            self._in_flight -= 1
+            if error is None:
+                self._successes += 1
+                if self._successes >= self.limit:
+                    self._successes = 0
+                    self.limit = min(self.limit + 1, self.max_requests)
+            elif is_throttle(error):
+                self._throttled()
+            self._condition.notify_all()
+
+    def _throttled(self):
+        """Halves the limit, called with the condition held."""
+
+        self.counters["throttles"] += 1
+        self.limit = max(self.limit // 2, 1)
+        self._successes = 0
+
+
+def get_executor(options=None):
+    """Returns the executor shared by every request this process makes.
+
+    Args:
+        options: parsed NameSpace, with the tunable options filled in. Only
+                 used by the first call, which creates the executor
+
+    Returns:
+        the shared RequestExecutor object
+    """
+
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            max_requests = getattr(options, "max_requests", None)
+            if not isinstance(max_requests, int):
+                max_requests = TUNABLES["max_requests"][1]
+            _shared = RequestExecutor(max_requests)
+    return _shared
+
+
+def print_summary():
+    """Prints the shared executor's counters to stderr, if S3 had issues."""
+
+    executor = get_executor()
+    if executor.counters["retries"] or executor.counters["throttles"]:
+        print(executor.summary(), file=sys.stderr)
@@ -6,57 +6,78 @@ from __future__ import print_function
 import os
 import re
 import sys
+import json
 import math
-import requests
-from filechunkio import FileChunkIO
-from pkg_resources import safe_name
+import hashlib
+import functools
+import threading
+from io import BytesIO
+from concurrent.futures import CancelledError
 from concurrent.futures import ThreadPoolExecutor
 
 from . import print_dot
 from . import get_settings
 from . import get_bucket_conn
+from .retry import get_executor
+from .retry import print_summary
+from .manifest import update_manifests
+from .index import forget_uploads
+from .utils import write_json
 
 
-def _upload_chunk(bucket, mp_id, part_num, filename, offset, bytes, retries=3):
-    """Uploads a single chunk, with retries."""
+def _upload_chunk(mp, part_num, filename, offset, bytes, callback=print_dot):
+    """Uploads a single chunk, with retries from the shared executor.
 
-    try:
-        for mp in bucket.get_all_multipart_uploads():
-            if mp.id == mp_id:
-                chunk_io = FileChunkIO(
-                    filename,
-                    "rb",
-                    offset=offset,
-                    bytes=bytes,
-                )
-                with chunk_io as fp:
-                    mp.upload_part_from_file(
-                        fp=fp,
-                        part_num=part_num,
-                        cb=print_dot,
-                    )
-                break
-    except Exception as error:
-        if retries:
-            _upload_chunk(bucket, mp_id, part_num, filename, offset, bytes,
-                          retries=retries - 1)
-        else:
-            raise error
+    Args:
+        mp: boto MultiPartUpload object to upload the chunk to
+        part_num: integer part number, starting at 1
+        filename: string path of the file being uploaded
+        offset: integer position of the chunk in the file
+        bytes: integer size of the chunk
+        callback: function called with the progress of the upload, or None
 
+    Returns:
+        the string ETag of the uploaded part
+    """
 
-def upload_file(filename, bucket, s3_config):
-    """Uploads a file by relative path into the connected bucket object."""
+    return get_executor().call(
+        _send_chunk, mp, part_num, filename, offset, bytes, callback,
+    )
 
-    source_size = os.stat(filename).st_size
-    headers = {"Content-Type": "application/octet-stream"}
 
-    chunk_size = 5242880  # 5MB chunks
-    bytes_per_chunk = max(int(math.sqrt(chunk_size) * math.sqrt(source_size)),
-                          chunk_size)
-    num_chunks = int(math.ceil(source_size / float(bytes_per_chunk)))
+def _send_chunk(mp, part_num, filename, offset, bytes, callback):
+    """Makes a single attempt at uploading a chunk."""
+
+    from filechunkio import FileChunkIO
+
+    with FileChunkIO(filename, "rb", offset=offset, bytes=bytes) as fp:
+        part = mp.upload_part_from_file(
+            fp=fp,
+            part_num=part_num,
+            cb=callback,
+        )
+    return part.etag
+
+
+def _completion_xml(part_etags):
+    """Builds the CompleteMultipartUpload body from the uploaded parts."""
+
+    return "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format(
+        "".join(
+            "<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>".format(
+                part_num,
+                part_etags[part_num],
+            ) for part_num in sorted(part_etags)
+        )
+    )
+
+
+def package_key_name(filename):
+    """Determines the S3 key name a file should be uploaded to."""
 
-    # determine the key name from the filename
-    sections = re.split("\.|-|_", os.path.basename(filename))
+    from pkg_resources import safe_name
+
+    sections = re.split("\\.|-|_", os.path.basename(filename))
     base_name = ""
     for section in sections:
         try:
@@ -70,28 +91,487 @@ def upload_file(filename, bucket, s3_config):
         else:
             break
 
-    key_name = "{}/{}".format(safe_name(base_name), os.path.basename(filename))
-    mp = bucket.initiate_multipart_upload(key_name, headers=headers)
+    return "{}/{}".format(safe_name(base_name), os.path.basename(filename))
+
+
+def upload_file(filename, bucket, s3_config, options=None, pool=None,
+                progress=True):
+    """Uploads a file by relative path into the connected bucket object.
+
+    Files smaller than `options.multipart_threshold` are sent in a single
+    PUT, larger files (or any file, without options) as a multipart upload.
+
+    Args:
+        filename: string path of the file to upload
+        bucket: a connected S3 bucket object
+        s3_config: S3Config object, for the ACL to upload with
+        options: parsed NameSpace, with the tunable options filled in
+        pool: ThreadPoolExecutor to send the parts or file with, shared by
+              all the files being uploaded at once. A pool of 4 workers is
+              made for this file if not given
+        progress: boolean to print dots while uploading, otherwise a single
+                  line is printed once the file is uploaded
+
+    Unless `options.force` is set, files identical to the key they would be
+    uploaded to are skipped.
+
+    With `options.resume` set, multipart uploads are journaled under
+    `options.cache_dir` and left in place on errors, to be continued by a
+    later call instead of starting over.
+
+    Returns:
+        the string key name uploaded to
+
+    Raises:
+        IOError if a part of a multipart upload failed, after cancelling
+        the upload, or journaling it to be resumed
+    """
+
+    if pool is None:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            return upload_file(filename, bucket, s3_config, options, pool,
+                               progress)
+
+    source_size = os.stat(filename).st_size
+    headers = {"Content-Type": "application/octet-stream"}
+    key_name = package_key_name(filename)
+    callback = print_dot if progress else None
+    multipart = not options or source_size >= options.multipart_threshold
+
+    if options and not getattr(options, "force", False) and \
+            is_uploaded(filename, bucket, key_name, multipart, pool):
+        print("Skipping {}, it is already uploaded".format(key_name))
+        return key_name
+
+    if progress:
+        print("Uploading {} ...".format(key_name), end="")
+
+    if not multipart:
+        pool.submit(
+            _upload_single,
+            filename,
+            bucket,
+            s3_config,
+            key_name,
+            headers,
+            callback,
+        ).result()
+        _print_result(key_name, progress, "done!")
+        return key_name
+
+    bytes_per_chunk, num_chunks = part_layout(source_size)
+
+    journal = None
+    mp = None
+    part_etags = {}
+    if options and getattr(options, "resume", False):
+        journal = UploadJournal(
+            filename,
+            os.path.join(options.cache_dir, "uploads"),
+        )
+        mp, part_etags = journal.resume(bucket, key_name, bytes_per_chunk)
+
+    if mp is None:
+        mp = get_executor().call(
+            bucket.initiate_multipart_upload,
+            key_name,
+            headers=headers,
+            policy=s3_config.acl,
+        )
+        if journal:
+            journal.start(bucket, key_name, mp.id, bytes_per_chunk)
 
-    print("Uploading {} ...".format(key_name), end="")
-    with ThreadPoolExecutor(max_workers=4) as pool:
+    parts = []
+    for i in range(num_chunks):
+        offset = i * bytes_per_chunk
+        remaining_bytes = source_size - offset
+        bytes = min([bytes_per_chunk, remaining_bytes])
+        part_num = i + 1
+        if part_num in part_etags:
+            continue  # uploaded before being interrupted
+        part = pool.submit(
+            _upload_chunk, mp, part_num, filename, offset, bytes, callback,
+        )
+        if journal:
+            part.add_done_callback(functools.partial(journal.done, part_num))
+        parts.append((part_num, part))
+
+    failures = []
+    for part_num, part in parts:
+        if part.exception() is None:
+            part_etags[part_num] = part.result()
+        else:
+            failures.append((part_num, part.exception()))
+
+    if not failures:
+        get_executor().call(
+            bucket.complete_multipart_upload,
+            key_name,
+            mp.id,
+            _completion_xml(part_etags),
+        )
+        if journal:
+            journal.finish()
+        _print_result(key_name, progress, "done!")
+        return key_name
+    else:
+        if not journal:
+            get_executor().call(mp.cancel_upload)
+        _print_result(key_name, progress, "failed! :(")
+        for part_num, error in failures:
+            print("  part {} of {}: {}".format(part_num, key_name, error),
+                  file=sys.stderr)
+        if journal:
+            print("  {} of {} parts of {} are uploaded, use --resume again "
+                  "to send the rest".format(len(part_etags), num_chunks,
+                                            key_name), file=sys.stderr)
+        raise IOError("{} of {} parts of {} failed to upload".format(
+            len(failures),
+            num_chunks,
+            key_name,
+        ))
+
+
+def upload_stream(stream, key_name, size, bucket, s3_config, options, pool,
+                  buffers, digests=None):
+    """Uploads size bytes read from stream, without writing them to disk.
+
+    Streams smaller than `options.multipart_threshold` are read whole and
+    sent in a single PUT, larger streams as a multipart upload, reading each
+    part while the parts before it are sent. The data is hashed as it is
+    read, and only made visible in the bucket if it matches digests.
+
+    Args:
+        stream: file-like object to read from
+        key_name: string key name to upload to
+        size: integer number of bytes the stream holds
+        bucket: a connected S3 bucket object
+        s3_config: S3Config object, for the ACL to upload with
+        options: parsed NameSpace, with the tunable options filled in
+        pool: ThreadPoolExecutor to send the parts with
+        buffers: threading.Semaphore, acquired for each part read into
+                 memory until it is sent, bounding the memory used
+        digests: dict of hashlib algorithm name to expected hex digest
+
+    Returns:
+        the string key name uploaded to
+
+    Raises:
+        ValueError: if the stream ended early or didn't match digests
+    """
+
+    headers = {"Content-Type": "application/octet-stream"}
+    hashes = dict(
+        (name, hashlib.new(name)) for name in (digests or {})
+        if name in ("md5", "sha1", "sha256", "sha512")
+    )
+
+    def read(bytes):
+        """Reads and hashes exactly bytes from the stream."""
+
+        chunks = []
+        while bytes > 0:
+            chunk = stream.read(min(bytes, 1048576))
+            if not chunk:
+                raise ValueError("{} ended {} bytes early".format(
+                    key_name, bytes,
+                ))
+            for hash_ in hashes.values():
+                hash_.update(chunk)
+            chunks.append(chunk)
+            bytes -= len(chunk)
+        return b"".join(chunks)
+
+    def verify():
+        """Checks the hashes of everything read against digests."""
+
+        for name, hash_ in hashes.items():
+            if hash_.hexdigest() != digests[name]:
+                raise ValueError("{} of {} is {}, expected {}".format(
+                    name, key_name, hash_.hexdigest(), digests[name],
+                ))
+
+    if size < options.multipart_threshold:
+        with buffers:
+            data = read(size)
+            verify()
+            key = bucket.new_key(key_name)
+            get_executor().call(
+                key.set_contents_from_string,
+                data,
+                headers=headers,
+                policy=s3_config.acl,
+            )
+        return key_name
+
+    bytes_per_chunk, num_chunks = part_layout(size)
+    mp = get_executor().call(
+        bucket.initiate_multipart_upload,
+        key_name,
+        headers=headers,
+        policy=s3_config.acl,
+    )
+
+    parts = []
+    try:
         for i in range(num_chunks):
-            offset = i * bytes_per_chunk
-            remaining_bytes = source_size - offset
-            bytes = min([bytes_per_chunk, remaining_bytes])
-            part_num = i + 1
-            pool.submit(_upload_chunk, bucket, mp.id, part_num, filename,
-                        offset, bytes)
-
-    if len(mp.get_all_parts()) == num_chunks:
-        mp.complete_upload()
-        if s3_config.acl:
-            key = bucket.get_key(key_name)
-            key.set_acl(s3_config.acl)
-        print(" done!")
+            buffers.acquire()
+            try:
+                data = read(min(bytes_per_chunk, size - i * bytes_per_chunk))
+                part = pool.submit(_upload_buffer, mp, i + 1, data)
+            except BaseException:
+                buffers.release()
+                raise
+            part.add_done_callback(lambda _: buffers.release())
+            parts.append(part)
+
+        verify()
+        part_etags = dict(
+            (part_num, part.result())
+            for part_num, part in enumerate(parts, 1)
+        )
+        get_executor().call(
+            bucket.complete_multipart_upload,
+            key_name,
+            mp.id,
+            _completion_xml(part_etags),
+        )
+    except BaseException:
+        for part in parts:
+            part.cancel()
+        get_executor().call(mp.cancel_upload)
+        raise
+
+    return key_name
+
+
+def _upload_buffer(mp, part_num, data):
+    """Uploads a part held in memory, returning its ETag."""
+
+    return get_executor().call(_send_buffer, mp, part_num, data)
+
+
+def _send_buffer(mp, part_num, data):
+    """Makes a single attempt at uploading a part held in memory."""
+
+    return mp.upload_part_from_file(fp=BytesIO(data), part_num=part_num).etag
+
+
+class UploadJournal(object):
+    """A multipart upload in progress, recorded to resume it later.
+
+    The journal holds the bucket, key name, upload id, part size and the
+    ETags of the parts uploaded so far. It is named after the file's path,
+    size and mtime, so a file changed since is uploaded from the start.
+    """
+
+    def __init__(self, filename, path):
+        stat = os.stat(filename)
+        self.path = path
+        self.journal = os.path.join(path, "{}.json".format(hashlib.sha1(
+            "{}:{}:{}".format(
+                os.path.abspath(filename),
+                stat.st_size,
+                stat.st_mtime,
+            ).encode("utf-8")
+        ).hexdigest()))
+        self._lock = threading.Lock()
+        self._state = None
+
+    def resume(self, bucket, key_name, part_size):
+        """Reattaches to the journaled upload of this file, if there is one.
+
+        The parts of the upload are listed once, to find the ones which
+        don't need to be sent again.
+
+        Args:
+            bucket: a connected S3 bucket object
+            key_name: string key name being uploaded to
+            part_size: integer number of bytes in each part
+
+        Returns:
+            tuple of a boto MultiPartUpload object, or None if a new upload
+            is needed, and a dict of part number to ETag of uploaded parts
+        """
+
+        from boto.exception import S3ResponseError
+        from boto.s3.multipart import MultiPartUpload
+
+        try:
+            with open(self.journal, "r") as openjournal:
+                state = json.load(openjournal)
+        except (IOError, OSError, ValueError):
+            return None, {}
+
+        expected = {"bucket": bucket.name, "key": key_name,
+                    "part_size": part_size}
+        if any(state.get(attr) != expected[attr] for attr in expected):
+            return None, {}
+
+        mp = MultiPartUpload(bucket)
+        mp.key_name = key_name
+        mp.id = state["upload_id"]
+        try:
+            part_etags = dict((part.part_number, part.etag)
+                              for part in get_executor().call(list, mp))
+        except S3ResponseError:
+            return None, {}  # the upload was completed or aborted since
+
+        self._state = dict(state, parts=part_etags)
+        return mp, part_etags
+
+    def start(self, bucket, key_name, upload_id, part_size):
+        """Starts a new journal for the multipart upload_id."""
+
+        self._state = {
+            "bucket": bucket.name,
+            "key": key_name,
+            "upload_id": upload_id,
+            "part_size": part_size,
+            "parts": {},
+        }
+        try:
+            if not os.path.isdir(self.path):
+                os.makedirs(self.path)
+            write_json(self.journal, self._state)
+        except (IOError, OSError) as error:
+            print("Could not journal upload of {}: {}".format(key_name, error),
+                  file=sys.stderr)
+            self._state = None
+
+    def done(self, part_num, part):
+        """Records the part's ETag, if the part future was uploaded."""
+
+        if part.exception() is not None:
+            return
+
+        with self._lock:
+            if self._state is not None:
+                self._state["parts"][part_num] = part.result()
+                write_json(self.journal, self._state)
+
+    def finish(self):
+        """Drops the journal of a completed upload."""
+
+        with self._lock:
+            self._state = None  # ignore parts reported after completing
+            if os.path.exists(self.journal):
+                os.remove(self.journal)
+
+
+def part_layout(source_size):
+    """Splits a file of source_size bytes into multipart upload parts.
+
+    Returns:
+        tuple of integer bytes per part and number of parts
+    """
+
+    chunk_size = 5242880  # 5MB chunks
+    bytes_per_chunk = max(int(math.sqrt(chunk_size) * math.sqrt(source_size)),
+                          chunk_size)
+    num_chunks = int(math.ceil(source_size / float(bytes_per_chunk)))
+    return bytes_per_chunk, num_chunks
+
+
+def is_uploaded(filename, bucket, key_name, multipart, pool):
+    """Checks if key_name already holds an identical copy of filename.
+
+    One HEAD request is made for the key, the file is only hashed when a
+    key of the same size exists.
+
+    Args:
+        filename: string path of the file to upload
+        bucket: a connected S3 bucket object
+        key_name: string key name the file would be uploaded to
+        multipart: boolean of if the file would be a multipart upload
+        pool: ThreadPoolExecutor to hash the parts of the file with
+
+    Returns:
+        boolean of the key having the ETag the upload would give it
+    """
+
+    from boto.exception import S3ResponseError
+
+    try:
+        key = get_executor().call(bucket.get_key, key_name)
+    except S3ResponseError:
+        return False
+
+    if key is None or key.size != os.stat(filename).st_size:
+        return False
+
+    return key.etag == local_etag(filename, multipart, pool)
+
+
+def local_etag(filename, multipart, pool):
+    """Computes the ETag S3 gives filename when uploaded.
+
+    For a single PUT, that is the MD5 of the file. For a multipart upload it
+    is the MD5 of the parts' MD5 digests, with the number of parts. Each
+    part is hashed in the pool, hashlib releases the GIL while hashing so
+    large files are hashed on as many cores as the pool has workers.
+
+    Args:
+        filename: string path of the file to hash
+        multipart: boolean to give the multipart ETag, using part_layout
+        pool: ThreadPoolExecutor to hash the parts of the file with
+
+    Returns:
+        string ETag, in double quotes like boto's Key.etag
+    """
+
+    source_size = os.stat(filename).st_size
+    if not multipart:
+        return '"{}"'.format(_md5_range(filename, 0, source_size).hexdigest())
+
+    bytes_per_chunk, num_chunks = part_layout(source_size)
+    parts = [pool.submit(
+        _md5_range,
+        filename,
+        i * bytes_per_chunk,
+        min(bytes_per_chunk, source_size - i * bytes_per_chunk),
+    ) for i in range(num_chunks)]
+
+    combined = hashlib.md5(b"".join(part.result().digest() for part in parts))
+    return '"{}-{}"'.format(combined.hexdigest(), num_chunks)
+
+
+def _md5_range(filename, offset, bytes):
+    """Returns the md5 hash object of bytes of filename from offset."""
+
+    md5 = hashlib.md5()
+    with open(filename, "rb") as openfile:
+        openfile.seek(offset)
+        while bytes > 0:
+            data = openfile.read(min(bytes, 1048576))
+            if not data:
+                break
+            md5.update(data)
+            bytes -= len(data)
+    return md5
+
+
+def _print_result(key_name, progress, result):
+    """Ends the progress line for key_name, or prints it whole."""
+
+    if progress:
+        print(" {}".format(result))
     else:
-        mp.cancel_upload()
-        print(" failed! :(")
+        print("Uploading {} ... {}".format(key_name, result))
+
+
+def _upload_single(filename, bucket, s3_config, key_name, headers,
+                   callback=print_dot):
+    """Uploads a whole file in one PUT, with its MD5 and ACL."""
+
+    key = bucket.new_key(key_name)
+    get_executor().call(
+        key.set_contents_from_filename,
+        filename,
+        headers=headers,
+        cb=callback,
+        policy=s3_config.acl,  # boto sends Content-MD5 for us
+    )
 
 
 def update_cloud(pypi):
@@ -104,6 +584,8 @@ def update_cloud(pypi):
         boolean of successfully triggering a refresh of the PyPI index
     """
 
+    import requests
+
     # We have to convert from /pypi/ or /simple/ to /admin/
     base_url = pypi.server
     if base_url.endswith("/"):
@@ -120,25 +602,100 @@ def update_cloud(pypi):
 
 
 def upload_files(settings, bucket):
-    """Uploads all files from settings.items to the bucket provided."""
+    """Uploads all files from settings.items to the bucket provided.
 
-    for file in settings.items:
-        try:
-            upload_file(file, bucket, settings.s3)
-        except Exception as error:
-            print(
-                "Error uploading {}: {}".format(file, error),
-                file=sys.stderr,
-            )
-            break
-    else:
-        update_cloud(settings.pypi)  # this raises on HTTP error
-        print("PyPICloud server at {} updated".format(settings.pypi.server))
+    Up to `jobs` files are uploaded at once, all sending their parts (or
+    whole files) through one pool of `part_workers` threads, so the number
+    of requests in flight stays the same however many files there are.
+    PyPICloud is updated once, after every file has been uploaded.
+    """
+
+    options = settings.parsed
+    jobs = max(min(options.jobs, len(settings.items)), 1)
+
+    uploaded = []
+    failed = threading.Event()
+    with ThreadPoolExecutor(max_workers=max(options.part_workers, 1)) as pool:
+        with ThreadPoolExecutor(max_workers=jobs) as files_pool:
+            uploads = [(file, files_pool.submit(
+                _upload_unless_failed,
+                failed,
+                file,
+                bucket,
+                settings.s3,
+                options,
+                pool,
+                jobs == 1,  # dots from concurrent uploads would interleave
+            )) for file in settings.items]
+
+            for file, upload in uploads:
+                try:
+                    uploaded.append(upload.result())
+                except CancelledError:
+                    continue
+                except Exception as error:
+                    print(
+                        "Error uploading {}: {}".format(file, error),
+                        file=sys.stderr,
+                    )
+                    for _, pending in uploads:
+                        pending.cancel()  # stop any not started yet
+
+    if failed.is_set():
+        return
+
+    finish_uploads(settings, bucket, uploaded)
+
+
+def _upload_unless_failed(failed, filename, *args):
+    """Uploads filename with upload_file(), unless an upload failed already.
+
+    Args:
+        failed: threading.Event, set here when the upload fails
+        filename: string path of the file to upload
+        args: the rest of upload_file()'s arguments
+
+    Raises:
+        CancelledError if failed was set before the upload started
+    """
+
+    if failed.is_set():
+        raise CancelledError()
+
+    try:
+        return upload_file(filename, *args)
+    except Exception:
+        failed.set()
+        raise
+
+
+def finish_uploads(settings, bucket, uploaded):
+    """Updates the index, package manifests and PyPICloud after uploading.
+
+    Args:
+        settings: Settings object, with tunables filled in on `parsed`
+        bucket: a connected S3 bucket object
+        uploaded: list of string key names uploaded, or None for failures
+    """
+
+    forget_uploads(bucket, settings.parsed,
+                   [key_name for key_name in uploaded if key_name])
+    if settings.parsed.manifest_prefix:
+        update_manifests(
+            bucket,
+            settings.parsed.manifest_prefix,
+            [key_name for key_name in uploaded if key_name],
+            settings.s3.acl,
+        )
+    update_cloud(settings.pypi)  # this raises on HTTP error
+    print("PyPICloud server at {} updated".format(settings.pypi.server))
 
 
 def main():
     """Main command line entry point for uploading."""
 
     settings = get_settings(upload=True)
-    bucket = get_bucket_conn(settings.s3)
+    get_executor(settings.parsed)
+    bucket = get_bucket_conn(settings.s3, validate=False)
     upload_files(settings, bucket)
+    print_summary()
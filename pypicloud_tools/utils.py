@@ -1,16 +1,73 @@
 """Pypicloud-tools common utility functions."""
 
 
-from boto.s3.key import Key
-from pip.wheel import Wheel
-from pip.wheel import wheel_ext
-from pip.index import egg_info_matches
-from pkg_resources import safe_name
-from pkg_resources import SetuptoolsVersion
-from pkg_resources import parse_requirements
+import os
+import re
+import json
+import bisect
+import functools
+import threading
+from collections import namedtuple
+from operator import attrgetter
+from collections import OrderedDict
 
 from . import OPERATORS
 from . import SUPPORTED_EXTENSIONS
+from .retry import get_executor
+
+
+# a release file in the bucket, with what was parsed from its key name
+Release = namedtuple("Release", ("key", "project", "version", "type"))
+
+# what parse_filename() finds in a release filename
+ReleaseFile = namedtuple("ReleaseFile", (
+    "name", "version", "build", "python", "abi", "platform", "type",
+))
+
+# how many parsed filenames parse_filename() remembers
+FILENAME_CACHE_SIZE = 10000
+
+# the source archive extensions, longest first so .tar.gz wins over .tar
+_SDIST_EXTENSIONS = "|".join(sorted(
+    (re.escape(ext) for ext in SUPPORTED_EXTENSIONS
+     if ext not in (".whl", ".egg", ".exe", ".msi")),
+    key=len,
+    reverse=True,
+))
+
+# the name is everything up to the first "-" followed by a digit. wheel
+# versions can have "-alpha1" like segments pip's Wheel leaves out, which
+# are kept here, a build tag always starts with a digit
+FILENAME_PATTERNS = (
+    ("wheel", re.compile(
+        r"^(?P<name>.+?)-(?P<version>\d[^-]*(?:-[^\d-][^-]*)*?)"
+        r"(?:-(?P<build>\d[^-]*))?"
+        r"-(?P<python>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$"
+    )),
+    ("egg", re.compile(
+        r"^(?P<name>.+?)-(?P<version>\d[^-]*)"
+        r"(?:-(?P<python>py\d+(?:\.\d+)?))?(?:-(?P<platform>.+))?\.egg$"
+    )),
+    ("wininst", re.compile(
+        r"^(?P<name>.+?)-(?P<version>\d.*?)"
+        r"(?:\.(?P<platform>win32|win-amd64))?"
+        r"(?:-(?P<python>py\d+(?:\.\d+)?))?\.exe$"
+    )),
+    ("msi", re.compile(
+        r"^(?P<name>.+?)-(?P<version>\d.*?)"
+        r"(?:\.(?P<platform>win32|win-amd64))?"
+        r"(?:-(?P<python>py\d+(?:\.\d+)?))?\.msi$"
+    )),
+    ("sdist", re.compile(
+        r"^(?P<name>.+?)-(?P<version>\d.*?)(?:{})$".format(_SDIST_EXTENSIONS)
+    )),
+)
+
+# runs of characters pkg_resources.safe_name() replaces with a "-"
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9.]+")
+
+# runs of characters PEP 503 treats as a single "-" when comparing names
+_NAME_SEPARATORS = re.compile(r"[-_.]+")
 
 
 def parse_package(package):
@@ -26,6 +83,9 @@ def parse_package(package):
     if not package:
         return None
 
+    from pkg_resources import SetuptoolsVersion
+    from pkg_resources import parse_requirements
+
     parsed = list(parse_requirements(package))[0]
     specs = []
     for spec in parsed.specs:
@@ -34,49 +94,259 @@ def parse_package(package):
     return parsed
 
 
-def parse_package_file(file_name, package):
-    """Builds a parsed package requirement object from a filename.
+def canonical_name(name):
+    """Normalizes a project name the way PEP 503 does, for comparisons.
+
+    Both "zope.interface" and "Zope_Interface" are "zope-interface".
+    """
+
+    return _NAME_SEPARATORS.sub("-", name).lower()
+
+
+def memoize(maxsize):
+    """Memoizes a function of one hashable argument in a bounded LRU cache.
+
+    Once the cache holds maxsize results, the least recently used is dropped.
+    The cache is shared by every thread, and kept as the `cache` attribute of
+    the decorated function.
+
+    Args:
+        maxsize: integer number of results to keep
+    """
+
+    def decorator(func):
+        cache = OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def memoized(arg):
+            with lock:
+                if arg in cache:
+                    # re-inserted to make it the most recently used
+                    result = cache[arg] = cache.pop(arg)
+                    return result
+
+            result = func(arg)
+            with lock:
+                cache[arg] = result
+                while len(cache) > maxsize:
+                    cache.popitem(last=False)
+            return result
+
+        memoized.cache = cache
+        return memoized
+    return decorator
+
+
+@memoize(FILENAME_CACHE_SIZE)
+def parse_filename(file_name):
+    """Parses a release filename, without needing pip or pkg_resources.
+
+    The project name is normalized like pkg_resources.safe_name() does, the
+    version is left as a string. Wheels can have a build tag and always have
+    python, abi and platform tags, eggs and windows installers may have
+    python and platform tags. Anything missing is None.
+
+    Args:
+        file_name: string release filename, without the "<package>/" prefix
+
+    Returns:
+        a ReleaseFile object, or None if file_name isn't a release filename
+    """
+
+    for type_, pattern in FILENAME_PATTERNS:
+        match = pattern.match(file_name)
+        if match:
+            break
+    else:
+        return None
+
+    fields = match.groupdict()
+    return ReleaseFile(
+        _UNSAFE_NAME.sub("-", fields["name"]),
+        fields["version"],
+        fields.get("build"),
+        fields.get("python"),
+        fields.get("abi"),
+        fields.get("platform"),
+        type_,
+    )
+
+
+def write_json(path, data):
+    """Atomically replaces the file at path with data as JSON.
+
+    The JSON is written to a temporary file next to path first, so a reader
+    never sees a partly written file.
+    """
+
+    temp_path = "{}.tmp".format(path)
+    with open(temp_path, "w") as openfile:
+        json.dump(data, openfile)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(temp_path, path)
+
+
+def list_keys(bucket, package=None):
+    """Lists the release keys in the bucket, optionally for a single package.
+
+    Only the normalized ``<package>/`` prefix is requested from S3, and the
+    listing follows every result marker, so packages with more than 1000
+    releases are returned in full. Keys are yielded as each page arrives,
+    an interrupted listing is continued after the last key yielded.
+
+    Args:
+        bucket: a connected S3 bucket object
+        package: parsed package object, or None to list every package
+
+    Yields:
+        boto Key objects for each release file found
+    """
+
+    prefix = "" if package is None else "{}/".format(package.project_name)
+    for key in get_executor().listing(bucket, prefix):
+        if key.name.partition("/")[2]:
+            yield key
+
+
+def list_packages(bucket, prefix=""):
+    """Lists the package names in the bucket.
+
+    Only the common ``<package>/`` prefixes are requested from S3, so a
+    single entry per package is transferred rather than every key.
 
     Args:
-        file_name: a string filename or boto Key object
-        package: parsed package requirement object this file is part of
+        bucket: a connected S3 bucket object
+        prefix: string every package name listed starts with
+
+    Yields:
+        string package names, once each, sorted like S3 sorts key names
+    """
+
+    seen = set()
+    for entry in get_executor().listing(bucket, prefix, "/"):
+        name, slash, _ = entry.name.partition("/")
+        if slash and name not in seen:
+            seen.add(name)
+            yield name
+
+
+class ReleaseVersions(object):
+    """A package's releases, sorted once by their parsed version.
+
+    Each version spec selects a range of the sorted versions with a binary
+    search, so the releases matching a package's specs, or the newest of
+    them, are found in O(log n) comparisons per spec.
     """
 
-    if isinstance(file_name, Key):
-        file_name = file_name.name.partition("/")[2]
-
-    if not file_name or package.project_name not in safe_name(file_name):
-        return
-
-    for ext in SUPPORTED_EXTENSIONS:
-        if not file_name.endswith(ext):
-            continue
-        # specifically not using os.path.split to get .tar.gz
-        file_ = file_name.rsplit(ext)[0]
-
-        if ext == wheel_ext:
-            wheel = Wheel(file_name)
-
-            # wheel won't consider -alpha -dev, etc.. in the version
-            ver = wheel.version
-            for tag_group in wheel.file_tags:
-                for tag in tag_group:
-                    try:
-                        ver = SetuptoolsVersion("{}-{}".format(ver, tag))
-                    except:
-                        break
-                break
-
-            return parse_package("{}=={}".format(wheel.name, ver))
-        else:
-            pkg_name = package.project_name
-            firstrun = True
-            while "-" in file_ or firstrun:
-                firstrun = False
-                try:
-                    return parse_package("{}=={}".format(
-                        pkg_name,
-                        egg_info_matches(file_, pkg_name, pkg_name),
-                    ))
-                except Exception:
-                    file_ = file_.rpartition("-")[0]
+    def __init__(self, releases):
+        # a stable sort, releases of the same version keep their order
+        self.releases = sorted(releases, key=attrgetter("version"))
+        self.versions = [release.version for release in self.releases]
+
+    def __len__(self):
+        return len(self.releases)
+
+    def select(self, specs):
+        """Returns the releases matching specs, oldest version first.
+
+        Args:
+            specs: list of (operator, version) tuples, as parse_package()
+                   leaves them on the `specs` attribute
+
+        Returns:
+            list of Release objects
+        """
+
+        return [
+            release for start, end in self._ranges(specs)
+            for release in self.releases[start:end]
+        ]
+
+    def latest(self, specs):
+        """Returns the releases of the newest version matching specs.
+
+        Args:
+            specs: list of (operator, version) tuples, as parse_package()
+                   leaves them on the `specs` attribute
+
+        Returns:
+            list of Release objects, empty if no version matches
+        """
+
+        ranges = self._ranges(specs)
+        if not ranges:
+            return []
+
+        start, end = ranges[-1]
+        start = bisect.bisect_left(self.versions, self.versions[end - 1],
+                                   start, end)
+        return self.releases[start:end]
+
+    def _ranges(self, specs):
+        """Returns the (start, end) index ranges of versions matching specs.
+
+        The ranges are in order and never overlap or are empty.
+        """
+
+        start, end = 0, len(self.versions)
+        excluded = []
+        for compare, version in specs:
+            left = bisect.bisect_left(self.versions, version)
+            right = bisect.bisect_right(self.versions, version)
+            if compare is OPERATORS["=="]:
+                start, end = max(start, left), min(end, right)
+            elif compare is OPERATORS[">="]:
+                start = max(start, left)
+            elif compare is OPERATORS[">"]:
+                start = max(start, right)
+            elif compare is OPERATORS["<="]:
+                end = min(end, right)
+            elif compare is OPERATORS["<"]:
+                end = min(end, left)
+            else:  # !=
+                excluded.append((left, right))
+
+        ranges = [(start, end)]
+        for left, right in sorted(excluded):
+            start, end = ranges.pop()
+            if left > start:
+                ranges.append((start, min(left, end)))
+            ranges.append((max(right, start), end))
+
+        return [(start, end) for start, end in ranges if start < end]
+
+
+def matches_specs(version, specs):
+    """Checks a parsed version against a parsed package's specs."""
+
+    for spec in specs:
+        if not spec[0](version, spec[1]):
+            return False
+    return True
+
+
+def parse_release(key, package):
+    """Parses a release key into a Release record.
+
+    Args:
+        key: boto Key object of the release file
+        package: parsed package requirement object this key is part of
+
+    Returns:
+        a Release object, or None if the key is not a release of package
+    """
+
+    parsed = parse_filename(key.name.partition("/")[2])
+    if not parsed or parsed.name != package.project_name:
+        return None
+
+    from pkg_resources import SetuptoolsVersion
+
+    try:
+        version = SetuptoolsVersion(parsed.version)
+    except Exception:
+        return None
+
+    return Release(key, parsed.name, version, parsed.type)
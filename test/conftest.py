@@ -8,6 +8,37 @@ import pytest
 import tempfile
 
 from boto.s3.key import Key
+from boto.s3.prefix import Prefix
+
+from pypicloud_tools import retry
+
+
+def pytest_addoption(parser):
+    """Adds --benchmark, to also run the wall-clock benchmarks."""
+
+    parser.addoption("--benchmark", action="store_true", default=False,
+                     help="run the tests marked benchmark, timing the tools")
+
+
+def pytest_configure(config):
+    """Registers the benchmark marker."""
+
+    config.addinivalue_line(
+        "markers",
+        "benchmark: wall-clock timing, only run with --benchmark",
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    """Skips the benchmarks unless --benchmark is used."""
+
+    if config.getoption("--benchmark"):
+        return
+
+    skip = pytest.mark.skip(reason="a benchmark, use --benchmark to run it")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
 
 
 class TestFile(object):
@@ -36,6 +67,15 @@ def config_file_cleanup():
             pass
 
 
+@pytest.fixture(autouse=True)
+def request_executor():
+    """Gives each test its own shared executor, which retries right away."""
+
+    retry._shared = retry.RequestExecutor(16, base_delay=0)
+    yield retry._shared
+    retry._shared = None
+
+
 @pytest.fixture
 def key_list():
     """Returns a list of mock objects usable as S3 Key objects."""
@@ -44,6 +84,9 @@ def key_list():
         """Creates a mock S3 Key object."""
         key = mock.Mock(spec=Key)
         key.name = name
+        key.size = len(name)
+        key.etag = '"{:032x}"'.format(abs(hash(name)))
+        key.last_modified = "2015-06-01T12:00:00.000Z"
         return key
 
     return [
@@ -65,8 +108,25 @@ def key_list():
 
 @pytest.fixture
 def bucket_and_keys(key_list):
-    """Returns a mock S3 bucket object with get_all_keys() and key_list."""
+    """Returns a mock S3 bucket object with list() and key_list."""
+
+    def list_keys(prefix="", delimiter="", marker=""):
+        """Mimics a prefix scoped S3 bucket listing."""
+        keys = [key for key in key_list
+                if key.name.startswith(prefix) and key.name > marker]
+        if not delimiter:
+            return keys
+
+        # keys past the delimiter are rolled up into their common prefix
+        listed = []
+        for key in sorted(keys, key=lambda key: key.name):
+            head, found, _ = key.name[len(prefix):].partition(delimiter)
+            if not found:
+                listed.append(key)
+            elif not listed or listed[-1].name != prefix + head + found:
+                listed.append(Prefix(bucket, prefix + head + found))
+        return listed
 
     bucket = mock.Mock()
-    bucket.get_all_keys = mock.Mock(return_value=key_list)
+    bucket.list = mock.Mock(side_effect=list_keys)
     return bucket, key_list
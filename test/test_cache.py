@@ -0,0 +1,142 @@
+"""Verify the download cache stores, confirms and evicts entries."""
+
+
+import os
+import mock
+import pytest
+
+from boto.exception import S3ResponseError
+
+from pypicloud_tools import cache
+
+
+@pytest.fixture
+def cached_key():
+    """Returns a mock key whose conditional GETs report it unchanged."""
+
+    key = mock.Mock()
+    key.bucket.name = "some-bucket"
+    key.name = "mock_pkg/mock_pkg-1.0.tar.gz"
+    key.etag = '"some-etag"'
+    key.size = 10
+    check_key = key.bucket.new_key.return_value
+    check_key.get_contents_as_string.side_effect = S3ResponseError(304, "")
+    return key
+
+
+@pytest.fixture
+def download_cache(tmpdir):
+    """Returns a DownloadCache in a temp directory holding 25 bytes."""
+
+    return cache.DownloadCache(str(tmpdir.join("downloads")), 25)
+
+
+def write_file(path, contents):
+    """Writes contents to the file at path."""
+
+    with open(path, "w") as openfile:
+        openfile.write(contents)
+    return path
+
+
+def test_store_and_fetch(cached_key, download_cache, tmpdir):
+    """A stored key is found again once its ETag is confirmed."""
+
+    assert download_cache.fetch(cached_key) is None
+    download_cache.store(cached_key, write_file(str(tmpdir.join("a")), "1"))
+
+    entry = download_cache.fetch(cached_key)
+    with open(entry) as openentry:
+        assert openentry.read() == "1"
+
+    check_key = cached_key.bucket.new_key.return_value
+    check_key.get_contents_as_string.assert_called_once_with(headers={
+        "If-None-Match": '"some-etag"',
+        "Range": "bytes=0-0",
+    })
+
+
+@pytest.mark.parametrize("status", (403, 404))
+def test_fetch__unreadable_key(status, cached_key, download_cache, tmpdir):
+    """A key removed or forbidden in the bucket is not served from cache."""
+
+    download_cache.store(cached_key, write_file(str(tmpdir.join("a")), "1"))
+    check_key = cached_key.bucket.new_key.return_value
+    check_key.get_contents_as_string.side_effect = S3ResponseError(status, "")
+
+    assert download_cache.fetch(cached_key) is None
+
+
+def test_fetch__changed_key(cached_key, download_cache, tmpdir):
+    """A key with a new ETag is a cache miss and gets the new values."""
+
+    download_cache.store(cached_key, write_file(str(tmpdir.join("a")), "1"))
+    check_key = cached_key.bucket.new_key.return_value
+    check_key.get_contents_as_string.side_effect = None
+    check_key.etag = '"new-etag"'
+    check_key.size = 20
+
+    assert download_cache.fetch(cached_key) is None
+    assert cached_key.etag == '"new-etag"'
+    assert cached_key.size == 20
+
+
+def test_evict__least_recently_used(cached_key, download_cache, tmpdir):
+    """Entries used longest ago are removed once over max_size."""
+
+    entries = []
+    for name in ("a", "b", "c"):
+        cached_key.etag = name
+        download_cache.store(cached_key, write_file(
+            str(tmpdir.join(name)),
+            name * 10,
+        ))
+        entry = download_cache.entry(cached_key)
+        entries.append(entry)
+        os.utime(entry, (len(entries), len(entries)))
+        download_cache.evict()
+
+    assert [os.path.exists(entry) for entry in entries] == [False, True, True]
+
+
+def test_store__too_large(cached_key, download_cache, tmpdir):
+    """Keys larger than the whole cache are not stored."""
+
+    cached_key.size = 26
+    download_cache.store(cached_key, write_file(str(tmpdir.join("a")), "1"))
+    assert not os.path.exists(download_cache.entry(cached_key))
+
+
+def test_place(tmpdir):
+    """Files are hardlinked into place, or copied if that fails."""
+
+    source = write_file(str(tmpdir.join("source")), "contents")
+    destination = write_file(str(tmpdir.join("destination")), "old")
+
+    cache.place(source, destination)
+    assert os.path.samefile(source, destination)
+
+    with mock.patch.object(cache.os, "link", side_effect=OSError):
+        cache.place(source, destination)
+    assert not os.path.samefile(source, destination)
+    with open(destination) as opendest:
+        assert opendest.read() == "contents"
+
+
+def test_open_cache(tmpdir):
+    """The cache is disabled by a download_cache_size of 0."""
+
+    options = mock.Mock()
+    options.cache_dir = str(tmpdir)
+    options.download_cache_size = 0
+    assert cache.open_cache(options) is None
+    assert cache.open_cache(None) is None
+
+    options.download_cache_size = 100
+    download_cache = cache.open_cache(options)
+    assert download_cache.path == str(tmpdir.join("downloads"))
+    assert download_cache.max_size == 100
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", "-rx", "--pdb", __file__])
@@ -1,16 +1,21 @@
 """Ensure the download functions work as expected."""
 
 
+import os
 import sys
+import json
 import mock
 import pytest
+import argparse
 
 if sys.version_info.major == 2:
     import __builtin__ as builtins
 else:
     import builtins
 
+from pypicloud_tools import index
 from pypicloud_tools import download
+from pypicloud_tools.index import find_releases
 from pypicloud_tools.utils import parse_package
 
 
@@ -53,47 +58,85 @@ def test_main():
 
     mock_s = mock.patch.object(download, "get_settings", return_value=settings)
     mock_b = mock.patch.object(download, "get_bucket_conn", return_value=buck)
-    mock_download = mock.patch.object(download, "download_package")
-    mock_parse = mock.patch.object(download, "parse_package")
+    mock_i = mock.patch.object(download, "open_index", return_value=buck)
+    mock_download = mock.patch.object(download, "download_packages",
+                                      return_value=0)
 
     with mock_s as settings_patch:
-        with mock_b as get_bucket_patch:
+        with mock_b as get_bucket_patch, mock_i as index_patch:
             with mock_download as download_patch:
-                with mock_parse as parse_patch:
-                    download.main()
+                download.main()
 
     settings_patch.assert_called_once_with(download=True)
-    get_bucket_patch.assert_called_once_with(settings.s3)
-    parse_patch.assert_called_once_with("faked")
-    download_patch.assert_called_once_with(buck, parse_patch())
+    get_bucket_patch.assert_called_once_with(
+        settings.s3,
+        validate=False,
+    )
+    index_patch.assert_called_once_with(buck, settings)
+    download_patch.assert_called_once_with(buck, ["faked"], settings.parsed)
 
 
-def test_main_buries_errors(capfd):
-    """Any Exception thrown in download_package should be handled."""
+def test_main__exit_status():
+    """The exit status is 1 when any package failed to download."""
 
-    buck = mock.Mock()
     settings = mock.Mock()
-    settings.items = ["faked"]
+    settings.items = ["faked", "broken"]
 
-    mock_s = mock.patch.object(download, "get_settings", return_value=settings)
-    mock_b = mock.patch.object(download, "get_bucket_conn", return_value=buck)
-    d_io = mock.patch.object(download, "download_package", side_effect=IOError)
-    mock_parse = mock.patch.object(download, "parse_package")
+    with mock.patch.object(download, "get_settings", return_value=settings), \
+            mock.patch.object(download, "get_bucket_conn"), \
+            mock.patch.object(download, "open_index"), \
+            mock.patch.object(download, "download_packages", return_value=1):
+        with pytest.raises(SystemExit) as exit_error:
+            download.main()
 
-    with mock_s as settings_patch:
-        with mock_b as get_bucket_patch:
-            with d_io as download_patch:
-                with mock_parse as parse_patch:
-                    download.main()
+    assert exit_error.value.code == 1
 
-    settings_patch.assert_called_once_with(download=True)
-    get_bucket_patch.assert_called_once_with(settings.s3)
-    parse_patch.assert_called_once_with("faked")
-    download_patch.assert_called_once_with(buck, parse_patch())
+
+def test_download_packages(bucket_and_keys, isatty_cleanup):
+    """All packages are resolved first, then written concurrently."""
+
+    bucket, keys = bucket_and_keys
+    download.sys.stdout.isatty = mock.Mock(return_value=True)
+    packages = ["package_one", "package-two==0.0.1", "error-pkg==2.3.4"]
+
+    with mock.patch.object(download, "find_package_key",
+                           wraps=download.find_package_key) as patched_find:
+        with mock.patch.object(download, "write_key") as patched_write:
+            patched_write.side_effect = lambda *_: patched_find.reset_mock()
+            with mock.patch.object(download, "ThreadPoolExecutor",
+                                   wraps=download.ThreadPoolExecutor) as pool:
+                assert download.download_packages(
+                    bucket,
+                    packages,
+                    argparse.Namespace(jobs=3),
+                ) == 1
+
+    pool.assert_called_once_with(max_workers=3)
+    assert not patched_find.called  # reset by writes, after resolving
+    assert sorted(call[0][0].name for call in patched_write.call_args_list) \
+        == sorted([keys[3].name, keys[6].name])
+
+
+def test_download_packages__reports_errors(capfd, bucket_and_keys):
+    """Any error downloading a package is reported without stopping."""
+
+    bucket, keys = bucket_and_keys
+    packages = ["package_one", "package-unknown", "package-two==0.0.1"]
+
+    with mock.patch.object(download, "write_key",
+                           side_effect=[IOError("disk full"), None]):
+        assert download.download_packages(
+            bucket,
+            packages,
+            argparse.Namespace(jobs=4),
+        ) == 2
 
     out, err = capfd.readouterr()
     assert not out
-    assert "Error downloading faked: " in err
+    assert "Error downloading package_one: disk full" in err
+    assert "Error downloading package-unknown: Package package-unknown " \
+        "not found" in err
+    assert "package-two==0.0.1" not in err
 
 
 def test_download_package__specific(bucket_and_keys):
@@ -130,6 +173,28 @@ def test_download_package__not_found(bucket_and_keys):
     assert "Package something==1.2.3 not found" in specific_error.value.args
 
 
+def test_find_package_key__stale_index(bucket_and_keys, tmpdir):
+    """A release missing from the index is looked for in S3 once more."""
+
+    bucket, keys = bucket_and_keys
+    bucket_index = index.BucketIndex(bucket, str(tmpdir.join("idx")), 60)
+    package = parse_package("package-one==1.2.5")
+    bucket_index.update("package-one/")
+
+    new_key = mock.Mock(size=10, etag='"new"',
+                        last_modified=keys[0].last_modified)
+    new_key.name = "package-one/package-one-1.2.5.tar.gz"
+    keys.append(new_key)
+
+    fresh = index.BucketIndex(bucket, str(tmpdir.join("idx")), 60)
+    assert download.find_package_key(fresh, package).name == new_key.name
+    assert bucket.list.call_count == 2
+
+    with pytest.raises(SystemExit):
+        download.find_package_key(fresh, parse_package("package-one==9"))
+    assert bucket.list.call_count == 2  # already refreshed by this run
+
+
 def test_download_package__prefers_wheels(bucket_and_keys):
     """When multiple versions are available, by default prefer wheels."""
 
@@ -171,9 +236,11 @@ def test_download_package__prefer_src(bucket_and_keys, argv_cleanup):
 def test_download_package__too_many_packages(bucket_and_keys):
     """If requesting a package with too many options, raise SystemExit."""
 
-    bucket, keys = bucket_and_keys
+    bucket = bucket_and_keys[0]
+    package = parse_package("error_pkg")
+    releases = list(find_releases(bucket, package))
     with pytest.raises(SystemExit) as exit_error:
-        download.prefer_wheels(keys, parse_package("error_pkg"))
+        download.prefer_wheels(releases, package)
 
     expected = (
         "Found too many results for error-pkg:\n"
@@ -184,7 +251,7 @@ def test_download_package__too_many_packages(bucket_and_keys):
     assert expected in exit_error.value.args
 
     with pytest.raises(SystemExit) as exit_error:
-        download.prefer_wheels(keys, parse_package("error_pkg==2.3.4"))
+        download.prefer_wheels(releases, parse_package("error_pkg==2.3.4"))
 
     expected = (
         "Found too many results for error-pkg==2.3.4:\n"
@@ -203,14 +270,218 @@ def test_write_key__to_file(capfd, isatty_cleanup):
     key.name = "mock_pkg/mock_pkg-1.0.2-dev1.tar.gz"
 
     with mock.patch.object(builtins, "open") as open_patch:
-        download.write_key(key)
+        with mock.patch.object(download.os, "rename") as rename_patch:
+            download.write_key(key)
 
+    open_patch.assert_called_once_with("mock_pkg-1.0.2-dev1.tar.gz.part", "wb")
     key.get_contents_to_file.assert_called_once_with(open_patch().__enter__())
+    rename_patch.assert_called_once_with(
+        "mock_pkg-1.0.2-dev1.tar.gz.part",
+        "mock_pkg-1.0.2-dev1.tar.gz",
+    )
     out, err = capfd.readouterr()
     assert not err
     assert "mock_pkg-1.0.2-dev1.tar.gz" in out
 
 
+def test_write_key__in_ranges(capfd, isatty_cleanup):
+    """Large keys are downloaded in ranges, small ones in a single stream."""
+
+    download.sys.stdout.isatty = mock.Mock(return_value=True)
+    options = argparse.Namespace(
+        range_threshold=100,
+        range_size=50,
+        part_workers=2,
+        download_cache_size=0,
+    )
+    key = mock.Mock()
+    key.name = "mock_pkg/mock_pkg-1.0.2-dev1.tar.gz"
+
+    key.size = 99
+    with mock.patch.object(download, "write_ranges") as patched_ranges:
+        with mock.patch.object(builtins, "open"):
+            with mock.patch.object(download.os, "rename"):
+                download.write_key(key, options)
+    assert not patched_ranges.called
+    assert key.get_contents_to_file.called
+
+    key.size = 100
+    with mock.patch.object(download, "write_ranges") as patched_ranges:
+        download.write_key(key, options)
+    patched_ranges.assert_called_once_with(
+        key,
+        "mock_pkg-1.0.2-dev1.tar.gz",
+        50,
+        2,
+    )
+    out, err = capfd.readouterr()
+    assert "mock_pkg-1.0.2-dev1.tar.gz" in out
+
+
+RANGED_CONTENTS = b"0123456789abcdefghijklmnopqrstuvwxy"
+
+
+@pytest.fixture
+def ranged_key():
+    """Returns a mock key, and a list of the keys used to fetch its ranges."""
+
+    key = mock.Mock()
+    key.name = "mock_pkg/mock_pkg-1.0.tar.gz"
+    key.size = len(RANGED_CONTENTS)
+    key.etag = '"some-etag"'
+    range_keys = []
+
+    def new_key(name):
+        """Creates a mock key which writes the range requested."""
+        range_key = mock.Mock()
+
+        def get_contents(openfile, headers):
+            start, end = headers["Range"][6:].split("-")
+            openfile.write(RANGED_CONTENTS[int(start):int(end) + 1])
+
+        range_key.get_contents_to_file = mock.Mock(side_effect=get_contents)
+        range_keys.append(range_key)
+        return range_key
+
+    key.bucket.new_key = mock.Mock(side_effect=new_key)
+    return key, range_keys
+
+
+def test_write_ranges(config_file, ranged_key):
+    """Each range is fetched on its own key and written at its offset."""
+
+    key, range_keys = ranged_key
+    contents = RANGED_CONTENTS
+    download.write_ranges(key, config_file, 10, 3)
+
+    with open(config_file, "rb") as openfile:
+        assert openfile.read() == contents
+
+    assert len(range_keys) == 4
+    requested = sorted(
+        range_key.get_contents_to_file.call_args[1]["headers"]["Range"]
+        for range_key in range_keys
+    )
+    assert requested == [
+        "bytes=0-9", "bytes=10-19", "bytes=20-29", "bytes=30-34",
+    ]
+    for range_key in range_keys:
+        headers = range_key.get_contents_to_file.call_args[1]["headers"]
+        assert headers["If-Match"] == '"some-etag"'
+
+    assert not os.path.exists("{}.part".format(config_file))
+    assert not os.path.exists("{}.part.json".format(config_file))
+
+
+def test_write_ranges__interrupted(config_file, ranged_key):
+    """A failed range leaves the .part file and journal for a later run."""
+
+    key, range_keys = ranged_key
+    working_key = key.bucket.new_key.side_effect
+
+    def new_key(name):
+        """The third range requested fails."""
+        range_key = working_key(name)
+        if len(range_keys) == 3:
+            range_key.get_contents_to_file.side_effect = IOError("reset")
+        return range_key
+
+    key.bucket.new_key.side_effect = new_key
+
+    with pytest.raises(IOError):
+        download.write_ranges(key, config_file, 10, 1)
+
+    assert not os.path.exists(config_file)
+    with open("{}.part.json".format(config_file)) as openjournal:
+        journal = json.load(openjournal)
+    assert journal["etag"] == '"some-etag"'
+    assert journal["range_size"] == 10
+    assert journal["ranges"] == [[0, 9], [10, 19], [30, 34]]
+
+
+@pytest.mark.parametrize("etag, requested", [
+    ('"some-etag"', ["bytes=20-29"]),
+    ('"other-etag"', ["bytes=0-9", "bytes=10-19", "bytes=20-29",
+                      "bytes=30-34"]),
+], ids=("same etag", "changed etag"))
+def test_write_ranges__resumed(etag, requested, config_file, ranged_key):
+    """Only missing ranges are fetched when the ETag still matches."""
+
+    key, range_keys = ranged_key
+    with open("{}.part".format(config_file), "wb") as openpart:
+        openpart.write(RANGED_CONTENTS[:20] + b"-" * 10 + RANGED_CONTENTS[30:])
+    with open("{}.part.json".format(config_file), "w") as openjournal:
+        json.dump({
+            "etag": etag,
+            "size": key.size,
+            "range_size": 10,
+            "ranges": [[0, 9], [10, 19], [30, 34]],
+        }, openjournal)
+
+    download.write_ranges(key, config_file, 10, 2)
+
+    assert sorted(
+        range_key.get_contents_to_file.call_args[1]["headers"]["Range"]
+        for range_key in range_keys
+    ) == requested
+    with open(config_file, "rb") as openfile:
+        assert openfile.read() == RANGED_CONTENTS
+    assert not os.path.exists("{}.part.json".format(config_file))
+
+
+def test_write_key__cached(capfd, isatty_cleanup):
+    """Cache hits are placed without downloading, misses are stored."""
+
+    download.sys.stdout.isatty = mock.Mock(return_value=True)
+    key = mock.Mock()
+    key.name = "mock_pkg/mock_pkg-1.0.2-dev1.tar.gz"
+    cache = mock.Mock()
+    cache.fetch = mock.Mock(return_value="/cache/entry")
+
+    with mock.patch.object(download, "open_cache", return_value=cache):
+        with mock.patch.object(download, "place") as patched_place:
+            download.write_key(key, "options")
+
+    patched_place.assert_called_once_with(
+        "/cache/entry",
+        "mock_pkg-1.0.2-dev1.tar.gz",
+    )
+    assert not key.get_contents_to_file.called
+    assert not cache.store.called
+
+    key.size = 10
+    cache.fetch = mock.Mock(return_value=None)
+    with mock.patch.object(download, "open_cache", return_value=cache):
+        with mock.patch.object(download, "PartialDownload"):
+            with mock.patch.object(builtins, "open"):
+                download.write_key(key, argparse.Namespace(
+                    range_threshold=100,
+                ))
+
+    assert key.get_contents_to_file.called
+    cache.store.assert_called_once_with(key, "mock_pkg-1.0.2-dev1.tar.gz")
+
+
+def test_write_key__cached_to_stdout(isatty_cleanup, config_file):
+    """Cache hits are copied to stdout when it is being piped."""
+
+    download.sys.stdout.isatty = mock.Mock(return_value=False)
+    with open(config_file, "wb") as opencached:
+        opencached.write(b"cached contents")
+    key = mock.Mock()
+    cache = mock.Mock()
+    cache.fetch = mock.Mock(return_value=config_file)
+    stdout = mock.Mock()
+    stdout.isatty = mock.Mock(return_value=False)
+
+    with mock.patch.object(download, "open_cache", return_value=cache):
+        with mock.patch.object(download.sys, "stdout", stdout):
+            download.write_key(key, "options")
+
+    stdout.buffer.write.assert_called_once_with(b"cached contents")
+    assert not key.get_contents_to_file.called
+
+
 def test_write_key__to_stdout(isatty_cleanup):
     """When sys.stdout is being piped/redicrected, print contents to it."""
 
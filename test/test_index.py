@@ -0,0 +1,217 @@
+"""Verify the local bucket index answers listings and refreshes correctly."""
+
+
+import os
+import mock
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+from pypicloud_tools import index
+from pypicloud_tools.manifest import ManifestBucket
+from pypicloud_tools.utils import parse_package
+
+
+@pytest.fixture
+def bucket_index(bucket_and_keys, tmpdir):
+    """Returns a BucketIndex over the mock bucket, in a temp directory."""
+
+    bucket, keys = bucket_and_keys
+    return index.BucketIndex(bucket, str(tmpdir.join("index.sqlite")), 60)
+
+
+def test_releases__from_index(bucket_index):
+    """Releases are read from S3 once, then answered from the index."""
+
+    package = parse_package("package_two")
+    first = list(bucket_index.releases(package))
+    second = list(bucket_index.releases(package))
+
+    bucket_index.bucket.list.assert_called_once_with(prefix="package-two/")
+    assert [rel.key.name for rel in first] == [rel.key.name for rel in second]
+    assert sorted(str(rel.version) for rel in first) == [
+        "0.0.1", "0.0.1", "0.0.1", "0.0.1.dev1", "0.0.1.dev2",
+    ]
+    assert sorted(rel.type for rel in first) == [
+        "egg", "sdist", "wheel", "wheel", "wheel",
+    ]
+
+
+def test_releases__whole_bucket_is_fresh(bucket_index):
+    """A full listing of the bucket also covers each package prefix."""
+
+    assert len(bucket_index.list()) == 12
+    bucket_index.releases(parse_package("package_one"))
+    bucket_index.bucket.list.assert_called_once_with(prefix="")
+
+
+def test_list__package_prefixes(bucket_index):
+    """Package names come from S3 until the whole bucket is indexed."""
+
+    bucket = bucket_index.bucket
+    names = [prefix.name for prefix in bucket_index.list(delimiter="/")]
+    bucket.list.assert_called_once_with(prefix="", delimiter="/")
+
+    bucket_index.update()
+    bucket.list.reset_mock()
+    indexed = [prefix.name for prefix in bucket_index.list("package-",
+                                                           delimiter="/")]
+
+    assert not bucket.list.called
+    assert names == ["error-pkg/", "package-one/", "package-two/"]
+    assert indexed == ["package-one/", "package-two/"]
+
+
+def test_update__incremental(bucket_and_keys, bucket_index):
+    """Only changed keys are parsed again, removed keys are dropped."""
+
+    bucket, keys = bucket_and_keys
+    package = parse_package("package_one")
+    bucket_index.update("package-one/")
+
+    keys[3].etag = '"changed"'
+    keys.pop(0)
+    with mock.patch.object(index, "parse_release",
+                           wraps=index.parse_release) as patched_parse:
+        bucket_index.update("package-one/")
+
+    patched_parse.assert_called_once_with(keys[2], mock.ANY)
+    releases = list(bucket_index.releases(package))
+    assert [rel.key.name for rel in releases] == [key.name for key in keys[:3]]
+    assert releases[2].key.etag == '"changed"'
+
+
+def test_update__whole_bucket(bucket_and_keys, bucket_index):
+    """Updating the whole bucket drops removed keys of every package."""
+
+    bucket, keys = bucket_and_keys
+    bucket_index.update()
+    indexed = len(bucket_index.list())
+    removed = [keys.pop(10), keys.pop(0)]
+    with mock.patch.object(index, "UPDATE_BATCH", 2):
+        bucket_index.update()
+
+    releases = bucket_index.releases()
+    assert not isinstance(releases, list)  # rows are read as they're used
+    names = [release.key.name for release in releases]
+    assert names
+    assert not set(key.name for key in removed) & set(names)
+    assert len(bucket_index.list()) == indexed - 2
+
+
+def test_forget_uploads(bucket_and_keys, tmpdir):
+    """Packages just uploaded to are refreshed by the next run."""
+
+    bucket = bucket_and_keys[0]
+    bucket.name = "some-bucket"
+    options = mock.Mock(cache_dir=str(tmpdir), index_ttl=60)
+    path = index.index_path(bucket, options)
+    index.forget_uploads(bucket, options, ["package-one/new.tar.gz"])
+    assert not os.path.exists(path)  # no index, nothing to forget
+
+    first = index.BucketIndex(bucket, path, 60)
+    first.update()
+    first.update("package-two/")
+    index.forget_uploads(bucket, options, ["package-one/new.tar.gz"])
+
+    second = index.BucketIndex(bucket, path, 60)
+    assert not second.is_fresh("package-one/")
+    assert second.is_fresh("package-two/")
+
+
+def test_refresh__ignores_ttl(bucket_and_keys, tmpdir):
+    """Using --refresh updates the index even when it would be fresh."""
+
+    bucket = bucket_and_keys[0]
+    path = str(tmpdir.join("index.sqlite"))
+    package = parse_package("package_one")
+    index.BucketIndex(bucket, path, 60).releases(package)
+    index.BucketIndex(bucket, path, 60).releases(package)
+    assert bucket.list.call_count == 1
+
+    index.BucketIndex(bucket, path, 60, refresh=True).releases(package)
+    assert bucket.list.call_count == 2
+
+
+def test_index__from_threads(bucket_index):
+    """The index can be used by threads other than the one opening it."""
+
+    names = []
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for package in ("package-one/", "package-two/"):
+            names.append(pool.submit(bucket_index.list, package))
+    names = [key.name for listing in names for key in listing.result()]
+
+    assert names == [
+        key.name for key in bucket_index.list()
+        if key.name.startswith("package-")
+    ]
+
+
+def test_open_index(bucket_and_keys, tmpdir):
+    """The index is created inside the configured cache_dir."""
+
+    bucket = bucket_and_keys[0]
+    bucket.name = "some-bucket"
+    settings = mock.Mock()
+    settings.parsed.cache_dir = str(tmpdir.join("cache"))
+    settings.parsed.index_ttl = 30
+    settings.parsed.refresh = False
+    settings.parsed.manifest_prefix = None
+
+    bucket_index = index.open_index(bucket, settings)
+
+    assert isinstance(bucket_index, index.BucketIndex)
+    assert bucket_index.ttl == 30
+    assert bucket_index.bucket is bucket
+    assert os.path.isfile(str(tmpdir.join("cache", "some-bucket.sqlite")))
+
+
+@pytest.mark.parametrize("refresh", (True, False))
+def test_open_index__manifests(refresh, bucket_and_keys, tmpdir):
+    """With a manifest_prefix, the index is refreshed from manifests."""
+
+    bucket = bucket_and_keys[0]
+    bucket.name = "some-bucket"
+    settings = mock.Mock()
+    settings.parsed.cache_dir = str(tmpdir)
+    settings.parsed.index_ttl = 30
+    settings.parsed.refresh = refresh
+    settings.parsed.manifest_prefix = ".manifests"
+    settings.parsed.manifest_ttl = 600
+
+    bucket_index = index.open_index(bucket, settings)
+
+    assert isinstance(bucket_index.bucket, ManifestBucket)
+    assert bucket_index.bucket.bucket is bucket
+    assert bucket_index.bucket.read is not refresh
+    assert bucket_index.bucket.max_age == 600
+
+
+def test_open_index__falls_back_to_bucket(bucket_and_keys, tmpdir):
+    """When no index can be created, the bucket is used directly."""
+
+    bucket = bucket_and_keys[0]
+    bucket.name = "some-bucket"
+    not_a_dir = tmpdir.join("file")
+    not_a_dir.write("")
+    settings = mock.Mock()
+    settings.parsed.cache_dir = str(not_a_dir)
+    settings.parsed.manifest_prefix = None
+
+    assert index.open_index(bucket, settings) is bucket
+
+
+def test_find_releases__without_index(bucket_and_keys):
+    """Without an index, releases are parsed from a live listing."""
+
+    bucket, keys = bucket_and_keys
+    releases = list(index.find_releases(bucket, parse_package("package_one")))
+
+    assert [release.key for release in releases] == keys[:4]
+    assert [str(release.version) for release in releases] == [
+        "1.2.3a1", "1.2.3", "1.2.4", "1.2.4.post1",
+    ]
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", "-rx", "--pdb", __file__])
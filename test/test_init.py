@@ -4,6 +4,10 @@
 import os
 import mock
 import pytest
+import threading
+
+import boto
+import boto.s3
 
 import pypicloud_tools
 
@@ -20,16 +24,21 @@ def test_get_bucket_conn():
     mock_bucket = mock.Mock()
     mock_boto.get_bucket = mock.Mock(return_value=mock_bucket)
 
-    with mock.patch.object(pypicloud_tools.boto, "connect_s3",
+    with mock.patch.object(boto, "connect_s3",
                            return_value=mock_boto) as patched_boto:
         bucket = pypicloud_tools.get_bucket_conn(mock_config)
 
-    assert bucket == mock_bucket
+    assert isinstance(bucket, pypicloud_tools.ThreadLocalBucket)
+    assert bucket.local() == mock_bucket
+    assert bucket.name == mock_config.bucket
     patched_boto.assert_called_once_with(
         mock_config.access,
         mock_config.secret,
     )
-    mock_boto.get_bucket.assert_called_once_with(mock_config.bucket)
+    mock_boto.get_bucket.assert_called_once_with(
+        mock_config.bucket,
+        validate=True,
+    )
 
 
 def test_get_bucket_conn__to_region():
@@ -40,13 +49,90 @@ def test_get_bucket_conn__to_region():
     mock_bucket = mock.Mock()
     mock_boto.get_bucket = mock.Mock(return_value=mock_bucket)
 
-    with mock.patch.object(pypicloud_tools.boto.s3, "connect_to_region",
+    with mock.patch.object(boto.s3, "connect_to_region",
                            return_value=mock_boto) as patched_boto:
-        bucket = pypicloud_tools.get_bucket_conn(mock_config)
+        bucket = pypicloud_tools.get_bucket_conn(mock_config, validate=False)
 
-    assert bucket == mock_bucket
+    assert bucket.local() == mock_bucket
     patched_boto.assert_called_once_with(mock_config.region)
-    mock_boto.get_bucket.assert_called_once_with(mock_config.bucket)
+    mock_boto.get_bucket.assert_called_once_with(
+        mock_config.bucket,
+        validate=False,
+    )
+
+
+def test_connect_s3__caches_region_host():
+    """The region's endpoint is only looked up by the first connection."""
+
+    s3_config = pypicloud_tools.S3Config("bucket", None, None, None,
+                                         "eu-west-1")
+    connections = [mock.Mock(host="s3.eu-west-1.amazonaws.com"), mock.Mock()]
+
+    with mock.patch.object(pypicloud_tools, "REGION_HOSTS", {}):
+        with mock.patch.object(boto.s3, "connect_to_region",
+                               side_effect=connections) as patched_boto:
+            assert pypicloud_tools.connect_s3(s3_config) is connections[0]
+            assert pypicloud_tools.connect_s3(s3_config) is connections[1]
+
+    assert patched_boto.call_args_list == [
+        mock.call("eu-west-1"),
+        mock.call("eu-west-1", host="s3.eu-west-1.amazonaws.com"),
+    ]
+
+
+def test_connect_s3__unknown_region():
+    """Regions boto doesn't know of are reported."""
+
+    s3_config = pypicloud_tools.S3Config("bucket", None, None, None, "mars-1")
+    with mock.patch.object(boto.s3, "connect_to_region",
+                           return_value=None):
+        with pytest.raises(SystemExit) as error:
+            pypicloud_tools.connect_s3(s3_config)
+
+    assert "mars-1" in error.value.args[0]
+
+
+def test_thread_local_bucket():
+    """Each thread gets its own connection, which objects handed out use."""
+
+    s3_config = pypicloud_tools.S3Config("bucket", None, None, None, None)
+    connections = []
+
+    def connect(*args):
+        connections.append(mock.Mock())
+        return connections[-1]
+
+    with mock.patch.object(boto, "connect_s3",
+                           side_effect=connect):
+        bucket = pypicloud_tools.ThreadLocalBucket(s3_config, validate=False)
+        thread_buckets = []
+        for _ in range(2):
+            thread = threading.Thread(
+                target=lambda: thread_buckets.append(bucket.local()),
+            )
+            thread.start()
+            thread.join()
+        assert bucket.local() is bucket.local()
+
+    assert len(connections) == 3
+    assert [bucket.local()] + thread_buckets == [
+        conn.get_bucket() for conn in connections
+    ]
+
+    key = bucket.new_key("package/package-1.0.tar.gz")
+    assert key.bucket is bucket
+    assert key.bucket.connection is connections[0].get_bucket().connection
+
+    listed = mock.Mock()
+    bucket.local().list.return_value = [listed]
+    assert list(bucket.list("package/")) == [listed]
+    assert listed.bucket is bucket
+
+    bucket.local().initiate_multipart_upload().bucket = None
+    assert bucket.initiate_multipart_upload("some/key").bucket is bucket
+
+    bucket.local().get_key.return_value = None
+    assert bucket.get_key("missing/key") is None
 
 
 def test_get_bucket_conn__auth_fail():
@@ -186,6 +272,33 @@ def test_settings_from_config__read_errors(config_file, capfd):
     assert not out
 
 
+def test_options_from_config(config_file):
+    """Tunables come from the command line, then config, then defaults."""
+
+    with open(config_file, "w") as openconf:
+        openconf.write("\n".join([
+            "[pypicloud]",
+            "bucket:bucket-name",
+            "index_ttl:120",
+            "cache_dir:/some/cache",
+        ]))
+
+    options = pypicloud_tools.argparse.Namespace(
+        config=[config_file],
+        index_ttl=None,
+    )
+    pypicloud_tools.options_from_config(options)
+
+    assert options.index_ttl == 120
+    assert options.cache_dir == "/some/cache"
+
+    options = pypicloud_tools.argparse.Namespace(config="nope", index_ttl=5)
+    pypicloud_tools.options_from_config(options)
+
+    assert options.index_ttl == 5
+    assert options.cache_dir == pypicloud_tools.CACHE_DIR
+
+
 def test_parse_args__list_package():
     """Ensure the parser is setup correctly for listing a package."""
 
@@ -204,6 +317,13 @@ def test_parse_args__list_package():
         "region": ["mine"],
         "user": False,
         "password": False,
+        "refresh": False,
+        "index_ttl": None,
+        "match": None,
+        "regex": False,
+        "format": "text",
+        "unsorted": False,
+        "latest": None,
         "config": DEFAULT_CONFIG,
     }
     assert vars(options) == expected_options
@@ -213,7 +333,9 @@ def test_parse_args__list_package():
 def test_parse_args__list_all():
     """Ensure the parser is setup correctly for listing all packages."""
 
-    pypicloud_tools.sys.argv = ["list", "--config", "fake.config"]
+    pypicloud_tools.sys.argv = [
+        "list", "--config", "fake.config", "--match", "pkg-*",
+    ]
     options, parser = pypicloud_tools.parse_args(listing=True)
 
     assert isinstance(parser, pypicloud_tools.argparse.ArgumentParser)
@@ -228,6 +350,13 @@ def test_parse_args__list_all():
         "user": False,
         "password": False,
         "region": False,
+        "refresh": False,
+        "index_ttl": None,
+        "match": "pkg-*",
+        "regex": False,
+        "format": "text",
+        "unsorted": False,
+        "latest": None,
         "config": ["fake.config"],
     }
     assert vars(options) == expected_options
@@ -253,6 +382,10 @@ def test_parse_args__upload():
         "user": False,
         "password": False,
         "config": DEFAULT_CONFIG,
+        "jobs": None,
+        "part_workers": None,
+        "force": False,
+        "resume": False,
     }
     assert vars(options) == expected_options
     assert "Upload package(s) to S3, bypassing PyPICloud" in str(parser)
@@ -277,12 +410,36 @@ def test_parse_args__download():
         "region": ["somewhere"],
         "user": False,
         "password": False,
+        "refresh": False,
+        "index_ttl": None,
+        "jobs": None,
+        "part_workers": None,
         "config": DEFAULT_CONFIG,
     }
     assert vars(options) == expected_options
     assert "Download package(s) from S3, bypassing PyPICloud" in str(parser)
 
 
+def test_parse_args__version(capfd):
+    """The installed version is only looked up when --version is used."""
+
+    pypicloud_tools.sys.argv = ["list"]
+    with mock.patch("pkg_resources.get_distribution") as patched_dist:
+        pypicloud_tools.parse_args(listing=True)
+        assert not patched_dist.called
+
+        patched_dist.return_value.version = "1.2.3"
+        pypicloud_tools.sys.argv = ["list", "--version"]
+        with pytest.raises(SystemExit):
+            pypicloud_tools.parse_args(listing=True)
+
+    patched_dist.assert_called_once_with("pypicloud-tools")
+    out, err = capfd.readouterr()
+    assert "pypicloud-tools " in out
+    assert " v1.2.3\n" in out
+    assert "MIT license" in out
+
+
 def test_get_settings__no_args():
     """get_settings() requires one boolean and only one boolean to be True."""
 
@@ -1,11 +1,17 @@
 """Ensure the pypicloud_tools lister functions work as expected."""
 
 
+import csv
+import json
 import mock
 import pytest
 
+from boto.s3.key import Key
+
+from pypicloud_tools import index
 from pypicloud_tools import lister
 from pypicloud_tools.utils import parse_package
+from pypicloud_tools.utils import parse_release
 
 
 def test_main():
@@ -14,20 +20,53 @@ def test_main():
     bucket = mock.Mock()
     settings = mock.Mock()
     settings.items = ["faked"]
+    settings.parsed.format = "text"
+    settings.parsed.unsorted = False
+    settings.parsed.latest = None
 
     mock_s = mock.patch.object(lister, "get_settings", return_value=settings)
     mock_b = mock.patch.object(lister, "get_bucket_conn", return_value=bucket)
+    mock_i = mock.patch.object(lister, "open_index", return_value=bucket)
 
     with mock_s as settings_patch:
-        with mock_b as get_bucket_patch:
+        with mock_b as get_bucket_patch, mock_i as index_patch:
             with mock.patch.object(lister, "list_package") as lister_patch:
                 with mock.patch.object(lister, "parse_package") as parse_patch:
                     lister.main()
 
     settings_patch.assert_called_once_with(listing=True)
-    get_bucket_patch.assert_called_once_with(settings.s3)
+    get_bucket_patch.assert_called_once_with(
+        settings.s3,
+        validate=False,
+    )
+    index_patch.assert_called_once_with(bucket, settings)
     parse_patch.assert_called_once_with("faked")
-    lister_patch.assert_called_once_with(bucket, parse_patch())
+    lister_patch.assert_called_once_with(bucket, parse_patch(), mock.ANY,
+                                         False, None)
+    assert lister_patch.call_args[0][2].fields == lister.RELEASE_FIELDS
+
+
+def test_main__all_packages():
+    """Without packages, the package names are listed with the filter."""
+
+    bucket = mock.Mock()
+    settings = mock.Mock()
+    settings.items = []
+    settings.parsed.match = "pkg-*"
+    settings.parsed.regex = False
+    settings.parsed.format = "text"
+    settings.parsed.latest = None
+
+    mock_s = mock.patch.object(lister, "get_settings", return_value=settings)
+    mock_b = mock.patch.object(lister, "get_bucket_conn", return_value=bucket)
+    mock_i = mock.patch.object(lister, "open_index", return_value=bucket)
+
+    with mock_s, mock_b, mock_i:
+        with mock.patch.object(lister, "list_names") as names_patch:
+            lister.main()
+
+    names_patch.assert_called_once_with(bucket, "pkg-*", False, mock.ANY)
+    assert names_patch.call_args[0][3].fields == lister.NAME_FIELDS
 
 
 def test_main_buries_errors(capfd):
@@ -36,21 +75,31 @@ def test_main_buries_errors(capfd):
     bucket = mock.Mock()
     settings = mock.Mock()
     settings.items = ["faked"]
+    settings.parsed.format = "text"
+    settings.parsed.unsorted = False
+    settings.parsed.latest = None
 
     mock_s = mock.patch.object(lister, "get_settings", return_value=settings)
     mock_b = mock.patch.object(lister, "get_bucket_conn", return_value=bucket)
+    mock_i = mock.patch.object(lister, "open_index", return_value=bucket)
     mock_l = mock.patch.object(lister, "list_package", side_effect=IOError)
 
     with mock_s as settings_patch:
-        with mock_b as get_bucket_patch:
+        with mock_b as get_bucket_patch, mock_i as index_patch:
             with mock_l as lister_patch:
                 with mock.patch.object(lister, "parse_package") as parse_patch:
                     lister.main()
 
     settings_patch.assert_called_once_with(listing=True)
-    get_bucket_patch.assert_called_once_with(settings.s3)
+    get_bucket_patch.assert_called_once_with(
+        settings.s3,
+        validate=False,
+    )
+    index_patch.assert_called_once_with(bucket, settings)
     parse_patch.assert_called_once_with("faked")
-    lister_patch.assert_called_once_with(bucket, parse_patch())
+    lister_patch.assert_called_once_with(bucket, parse_patch(), mock.ANY,
+                                         False, None)
+    assert lister_patch.call_args[0][2].fields == lister.RELEASE_FIELDS
 
     out, err = capfd.readouterr()
     assert not out
@@ -58,7 +107,9 @@ def test_main_buries_errors(capfd):
 
 
 def test_print_versioned__in_order(capfd):
-    releases = [
+    """Releases should be printed newest version first."""
+
+    files = [
         "some_thing-0.0.1-py2.py3-none-any.whl",
         "some_thing-1.2.4.egg",
         "some_thing-1.5.2.dev1.tar.gz",
@@ -75,7 +126,14 @@ def test_print_versioned__in_order(capfd):
         "some-thing==0.0.1 : some_thing-0.0.1-py2.py3-none-any.whl",
     ]
 
-    lister.print_versioned(releases, parse_package("some_thing"))
+    package = parse_package("some_thing")
+    releases = []
+    for file_name in files:
+        key = mock.Mock(spec=Key)
+        key.name = "some-thing/{}".format(file_name)
+        releases.append(parse_release(key, package))
+
+    lister.print_versioned(releases)
 
     out, err = capfd.readouterr()
     assert not err
@@ -89,6 +147,44 @@ def test_list_packages__all_packages(capfd, bucket_and_keys):
     out, err = capfd.readouterr()
     assert not err
     assert "error-pkg\npackage-one\npackage-two" in out
+    bucket_and_keys[0].list.assert_called_once_with(prefix="",
+                                                    delimiter="/")
+
+
+@pytest.mark.parametrize(
+    "pattern, regex, prefix, expected",
+    [
+        ("package-*", False, "package-", ["package-one", "package-two"]),
+        ("*-one", False, "", ["package-one"]),
+        ("pkg$", True, "", ["error-pkg"]),
+        ("-(one|two)", True, "", ["package-one", "package-two"]),
+    ],
+    ids=("glob", "glob without prefix", "regex", "regex search"),
+)
+def test_list_names__filtered(capfd, bucket_and_keys, pattern, regex,
+                              prefix, expected):
+    """Package names can be filtered, with a glob or a regex."""
+
+    bucket = bucket_and_keys[0]
+    lister.list_names(bucket, pattern, regex)
+
+    out, err = capfd.readouterr()
+    assert not err
+    assert out.splitlines() == expected
+    bucket.list.assert_called_once_with(prefix=prefix, delimiter="/")
+
+
+def test_list_names__dedupes(capfd, bucket_and_keys):
+    """A prefix listed again after an interrupted listing is printed once."""
+
+    bucket = bucket_and_keys[0]
+    prefixes = bucket.list(delimiter="/")
+    bucket.list = mock.Mock(return_value=prefixes + prefixes[1:])
+
+    lister.list_names(bucket)
+
+    out, _ = capfd.readouterr()
+    assert out.splitlines() == ["error-pkg", "package-one", "package-two"]
 
 
 def test_list_packages__specific(capfd, bucket_and_keys):
@@ -98,14 +194,12 @@ def test_list_packages__specific(capfd, bucket_and_keys):
     with mock.patch.object(lister, "print_versioned") as patched_print:
         lister.list_package(bucket_and_keys[0], parsed_pkg)
 
-    patched_print.assert_called_once_with(
-        [
-            "package-two-0.0.1-py2.py3-none-any.whl",
-            "package_two-0.0.1.tar.gz",
-            "package-two-0.0.1-py2.7.egg",
-        ],
-        parsed_pkg,
-    )
+    releases = patched_print.call_args[0][0]
+    assert [release.key.name.partition("/")[2] for release in releases] == [
+        "package-two-0.0.1-py2.py3-none-any.whl",
+        "package_two-0.0.1.tar.gz",
+        "package-two-0.0.1-py2.7.egg",
+    ]
 
 
 def test_list_packages__ranges(capfd, bucket_and_keys):
@@ -118,13 +212,128 @@ def test_list_packages__ranges(capfd, bucket_and_keys):
             parsed_pkg,
         )
 
-    patched_print.assert_called_once_with(
-        [
-            "package-one-1.2.3-alpha1-py2.py3-none-any.whl",
-            "package-one-1.2.3-py2.py3-none-any.whl",
-        ],
-        parsed_pkg,
-    )
+    releases = patched_print.call_args[0][0]
+    assert [release.key.name.partition("/")[2] for release in releases] == [
+        "package-one-1.2.3-alpha1-py2.py3-none-any.whl",
+        "package-one-1.2.3-py2.py3-none-any.whl",
+    ]
+
+
+@pytest.mark.parametrize("format_", ("json", "ndjson", "csv"))
+def test_list_package__formats(capfd, bucket_and_keys, format_):
+    """Releases are written with their key details, newest version first."""
+
+    keys = bucket_and_keys[1]
+    writer = lister.release_writer(format_)
+    lister.list_package(bucket_and_keys[0], parse_package("package_one>1.2.3"),
+                        writer)
+    writer.close()
+
+    out, err = capfd.readouterr()
+    assert not err
+    if format_ == "json":
+        records = json.loads(out)
+    elif format_ == "ndjson":
+        records = [json.loads(line) for line in out.splitlines()]
+    else:
+        records = list(csv.DictReader(out.splitlines()))
+        for record in records:
+            record["size"] = int(record["size"])
+
+    assert records == [
+        {
+            "key": key.name,
+            "project": "package-one",
+            "version": version,
+            "type": "wheel",
+            "size": key.size,
+            "last_modified": key.last_modified,
+            "etag": key.etag.strip('"'),
+        } for key, version in ((keys[3], "1.2.4.post1"), (keys[2], "1.2.4"))
+    ]
+
+
+def test_list_package__unsorted(capfd, bucket_and_keys):
+    """Unsorted releases are written in the order they are listed."""
+
+    writer = lister.release_writer("ndjson")
+    lister.list_package(bucket_and_keys[0], parse_package("package_one"),
+                        writer, unsorted=True)
+
+    out, _ = capfd.readouterr()
+    assert [json.loads(line)["version"] for line in out.splitlines()] == [
+        "1.2.3a1", "1.2.3", "1.2.4", "1.2.4.post1",
+    ]
+
+
+def test_record_writer__flushes(bucket_and_keys):
+    """Each item is flushed once written, json is closed after the last."""
+
+    writer = lister.name_writer("json")
+    writer.stream = mock.Mock()
+    lister.list_names(bucket_and_keys[0], "package-*", writer=writer)
+    writer.close()
+
+    calls = writer.stream.write.call_args_list
+    written = "".join(call[0][0] for call in calls)
+    assert json.loads(written) == [{"name": "package-one"},
+                                   {"name": "package-two"}]
+    assert writer.stream.flush.call_count == 3
+
+
+def test_record_writer__empty_json(capfd):
+    """Without any items, json output is still a valid array."""
+
+    lister.name_writer("json").close()
+
+    out, _ = capfd.readouterr()
+    assert json.loads(out) == []
+
+
+@pytest.mark.parametrize("indexed", (False, True), ids=("s3", "index"))
+def test_list_latest(capfd, bucket_and_keys, tmpdir, indexed):
+    """The newest versions of every package come from a single listing."""
+
+    bucket = bucket_and_keys[0]
+    if indexed:
+        bucket = index.BucketIndex(bucket, str(tmpdir.join("index.sqlite")),
+                                   60)
+
+    lister.list_latest(bucket, 2)
+
+    out, err = capfd.readouterr()
+    assert not err
+    expected = [
+        "error-pkg==2.3.4 : error-pkg-2.3.4-py2.py3-none-any.whl",
+        "error-pkg==2.3.4 : error-pkg-2.3.4-py2-none-any.whl",
+        "error-pkg==2.3.4 : error_pkg-2.3.4.tar.gz",
+        "package-one==1.2.4.post1 : "
+        "package-one-1.2.4.post1-py2.py3-none-any.whl",
+        "package-one==1.2.4 : package-one-1.2.4-py2.py3-none-any.whl",
+        "package-two==0.0.1 : package-two-0.0.1-py2.py3-none-any.whl",
+        "package-two==0.0.1 : package_two-0.0.1.tar.gz",
+        "package-two==0.0.1 : package-two-0.0.1-py2.7.egg",
+        "package-two==0.0.1.dev2 : "
+        "package-two-0.0.1.dev2-py2.py3-none-any.whl",
+    ]
+    if indexed:  # the index lists the files of a version by key name
+        assert sorted(out.splitlines()) == sorted(expected)
+    else:
+        assert out.splitlines() == expected
+    bucket_and_keys[0].list.assert_called_once_with(prefix="")
+
+
+def test_list_package__latest(capfd, bucket_and_keys):
+    """Only the newest versions of a package are listed with latest."""
+
+    lister.list_package(bucket_and_keys[0], parse_package("package_one"),
+                        latest=1)
+
+    out, _ = capfd.readouterr()
+    assert out.splitlines() == [
+        "package-one==1.2.4.post1 : "
+        "package-one-1.2.4.post1-py2.py3-none-any.whl",
+    ]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+"""Verify the package manifests are read and written as expected."""
+
+
+import json
+import mock
+import pytest
+import datetime
+
+from boto.exception import S3ResponseError
+
+from pypicloud_tools import manifest
+
+
+@pytest.fixture
+def manifest_bucket(bucket_and_keys):
+    """Returns the mock bucket with string contents for new keys."""
+
+    bucket, keys = bucket_and_keys
+    written = {}
+
+    def new_key(name):
+        """Creates a mock S3 Key backed by the written dict."""
+        key = mock.Mock()
+        key.name = name
+
+        def get_contents():
+            if name not in written:
+                raise S3ResponseError(404, "Not Found")
+            return written[name].encode()
+
+        def set_contents(data, headers=None, policy=None):
+            written[name] = data
+
+        key.get_contents_as_string = mock.Mock(side_effect=get_contents)
+        key.set_contents_from_string = mock.Mock(side_effect=set_contents)
+        return key
+
+    bucket.new_key = mock.Mock(side_effect=new_key)
+    return bucket, keys, written
+
+
+def test_write_and_read_manifest(manifest_bucket):
+    """A written manifest is read back as the same keys."""
+
+    bucket, keys, written = manifest_bucket
+    manifest.write_manifest(bucket, ".manifests/", "package-one", keys[:4])
+
+    contents = json.loads(written[".manifests/package-one.json"])
+    assert contents["format"] == manifest.MANIFEST_FORMAT
+    assert sorted(contents["files"]) == sorted(
+        key.name.partition("/")[2] for key in keys[:4]
+    )
+
+    read = manifest.read_manifest(bucket, ".manifests", "package-one")
+    assert sorted(key.name for key in read) == sorted(
+        key.name for key in keys[:4]
+    )
+    for key in read:
+        original = [orig for orig in keys if orig.name == key.name][0]
+        assert key.etag == original.etag
+        assert key.size == original.size
+        assert key.last_modified == original.last_modified
+
+
+@pytest.mark.parametrize("contents", (None, "not json", '{"format": 0}'))
+def test_read_manifest__missing_or_stale(contents, manifest_bucket):
+    """Missing, broken or old manifests are not used."""
+
+    bucket, keys, written = manifest_bucket
+    if contents is not None:
+        written[".manifests/package-one.json"] = contents
+
+    assert manifest.read_manifest(bucket, ".manifests", "package-one") is None
+
+
+@pytest.mark.parametrize("updated, max_age, fresh", [
+    (datetime.timedelta(minutes=5), 3600, True),
+    (datetime.timedelta(hours=2), 3600, False),
+    (datetime.timedelta(days=30), 0, True),
+    (None, 3600, False),
+], ids=("recent", "old", "no max age", "unknown age"))
+def test_read_manifest__max_age(updated, max_age, fresh, manifest_bucket):
+    """Manifests older than max_age are stale, the bucket may have changed."""
+
+    bucket, keys, written = manifest_bucket
+    manifest.write_manifest(bucket, ".manifests", "package-one", keys[:4])
+    name = ".manifests/package-one.json"
+    contents = json.loads(written[name])
+    if updated is None:
+        del contents["updated"]
+    else:
+        contents["updated"] = (
+            datetime.datetime.utcnow() - updated
+        ).isoformat()
+    written[name] = json.dumps(contents)
+
+    read = manifest.read_manifest(bucket, ".manifests", "package-one",
+                                  max_age)
+    assert (read is not None) is fresh
+
+
+def test_manifest_bucket__stale_manifest(manifest_bucket):
+    """A package with a stale manifest is listed from the bucket instead."""
+
+    bucket, keys, written = manifest_bucket
+    manifest.write_manifest(bucket, ".manifests", "package-one", keys[:2])
+
+    with mock.patch.object(manifest, "manifest_age", return_value=7200):
+        listed = list(manifest.ManifestBucket(
+            bucket,
+            ".manifests",
+            max_age=3600,
+        ).list(prefix="package-one/"))
+
+    assert listed == keys[:4]
+    bucket.list.assert_called_once_with(prefix="package-one/")
+
+
+def test_update_manifests(manifest_bucket):
+    """Each package of the uploaded keys gets its manifest rebuilt once."""
+
+    bucket, keys, written = manifest_bucket
+    manifest.update_manifests(bucket, ".manifests", [
+        "package-one/package-one-1.2.4-py2.py3-none-any.whl",
+        "package-two/package_two-0.0.1.tar.gz",
+        "package-two/package-two-0.0.1-py2.7.egg",
+    ])
+
+    assert sorted(written) == [
+        ".manifests/package-one.json",
+        ".manifests/package-two.json",
+    ]
+    contents = json.loads(written[".manifests/package-two.json"])
+    assert len(contents["files"]) == 5
+    assert bucket.list.call_count == 4  # each package is listed twice
+
+
+def test_update_manifests__concurrent_upload(manifest_bucket):
+    """A key finishing while the manifest is written gets included."""
+
+    bucket, keys, written = manifest_bucket
+    listings = [keys[:3], keys[:4], keys[:4]]
+    bucket.list = mock.Mock(side_effect=lambda prefix: listings.pop(0))
+
+    manifest.update_manifests(bucket, ".manifests", [keys[0].name])
+
+    contents = json.loads(written[".manifests/package-one.json"])
+    assert len(contents["files"]) == 4
+    assert bucket.new_key.call_count == 2  # written twice
+
+
+def test_manifest_bucket__prefers_manifest(manifest_bucket):
+    """Package listings come from the manifest when there is one."""
+
+    bucket, keys, written = manifest_bucket
+    manifest.write_manifest(bucket, ".manifests", "package-one", keys[:2])
+    manifest_bucket = manifest.ManifestBucket(bucket, ".manifests")
+
+    listed = list(manifest_bucket.list(prefix="package-one/"))
+    assert [key.name for key in listed] == [key.name for key in keys[:2]]
+    assert not bucket.list.called
+
+    listed = list(manifest_bucket.list(prefix="package-two/"))
+    assert listed == keys[4:10]
+    bucket.list.assert_called_once_with(prefix="package-two/")
+
+
+def test_manifest_bucket__hides_manifests(manifest_bucket):
+    """The manifests are not listed as packages in the bucket."""
+
+    bucket, keys, written = manifest_bucket
+    manifest_key = mock.Mock()
+    manifest_key.name = ".manifests/package-one.json"
+    keys.append(manifest_key)
+
+    listed = list(manifest.ManifestBucket(bucket, ".manifests").list())
+    assert manifest_key not in listed
+    assert len(listed) == len(keys) - 1
+
+
+def test_manifest_bucket__not_read(manifest_bucket):
+    """When reading manifests is disabled, the bucket is always listed."""
+
+    bucket, keys, written = manifest_bucket
+    manifest.write_manifest(bucket, ".manifests", "package-one", keys[:2])
+    manifest_bucket = manifest.ManifestBucket(bucket, ".manifests", read=False)
+
+    assert list(manifest_bucket.list(prefix="package-one/")) == keys[:4]
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", "-rx", "--pdb", __file__])
@@ -2,10 +2,17 @@
 
 
 import os
+import sys
 import mock
+import time
 import pytest
 import tempfile
+import requests
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+
+from pypicloud_tools import index
 from pypicloud_tools import rehost
 from pypicloud_tools import Settings
 from pypicloud_tools import S3Config
@@ -22,28 +29,453 @@ def test_cleanup_tempdir(include_deps):
     fake_pypi = PyPIConfig("fake_server", "fake_user", "fake_passwd")
     fake_args = mock.Mock()
     fake_args.deps = include_deps
+    fake_args.jobs = 4
+    fake_args.part_workers = 4
+    fake_args.force = False
+    fake_args.stream = False
     fake_settings = Settings(fake_s3, fake_pypi, ["requests"], fake_args)
 
-    with mock.patch.object(rehost.pip, "main") as patched_pip:
-        with mock.patch.object(rehost, "upload_files") as patched_upload:
-            with mock.patch.object(rehost, "get_bucket_conn") as patched_conn:
+    with mock.patch.object(rehost.subprocess, "Popen") as patched_popen:
+        patched_popen.return_value.communicate.return_value = (b"", None)
+        patched_popen.return_value.returncode = 0
+        with mock.patch.object(rehost, "upload_file") as patched_upload:
+            with mock.patch.object(rehost, "get_bucket_conn"), \
+                    mock.patch.object(rehost, "open_index"), \
+                    mock.patch.object(rehost, "upstream_files",
+                                      return_value=[]):
                 with mock.patch.object(rehost, "get_settings",
                                        return_value=fake_settings):
                     rehost.main()
 
     assert len(starting) == len(os.listdir(tempfile.tempdir))
 
-    pip_args = patched_pip.mock_calls[0][1][0]
-    assert pip_args[0] == "install"
-    assert pip_args[1] == "--download"
-    assert pip_args[2].startswith(tempfile.tempdir)
-    assert pip_args[3] == "requests"
+    pip_args = patched_popen.mock_calls[0][1][0]
+    assert pip_args[:5] == [sys.executable, "-m", "pip", "install",
+                            "--download"]
+    assert pip_args[5].startswith(tempfile.tempdir)
+    assert pip_args[6] == "requests"
+
+    # nothing was downloaded, so there is nothing to upload
+    assert not patched_upload.called
+
+
+def fake_pip(fetched):
+    """Returns a subprocess.Popen stand in, "downloading" fetched files.
+
+    Args:
+        fetched: dictionary of {package: [filename, ...]}
+    """
+
+    def popen(args, **kwargs):
+        process = mock.Mock()
+        download_dir, package = args[-2:]
+        if package in fetched:
+            for file_ in fetched[package]:
+                open(os.path.join(download_dir, file_), "w").close()
+            process.returncode = 0
+        else:
+            process.returncode = 1
+        process.communicate.return_value = (b"no such package", None)
+        return process
+
+    return popen
+
+
+def test_fetch_package__keeps_first_copy(tmpdir):
+    """Files already in the storage dir are kept, not replaced."""
+
+    storage_dir = str(tmpdir)
+    shared = os.path.join(storage_dir, "six-1.10.0-py2.py3-none-any.whl")
+    with open(shared, "w") as open_shared:
+        open_shared.write("first")
+
+    fetched = {"pkg": ["pkg-1.0.tar.gz", "six-1.10.0-py2.py3-none-any.whl"]}
+    with mock.patch.object(rehost.subprocess, "Popen",
+                           side_effect=fake_pip(fetched)):
+        files = rehost.fetch_package("pkg", storage_dir)
+
+    assert sorted(files) == fetched["pkg"]
+    assert sorted(os.listdir(storage_dir)) == fetched["pkg"]
+    with open(shared) as open_shared:
+        assert open_shared.read() == "first"
+
+
+def run_pipeline(packages, storage_dir, hosted=None, deps=True, jobs=2):
+    """Runs a RehostPipeline for packages, with the uploads mocked out.
+
+    Returns:
+        tuple of the pipeline and the mocked upload_file
+    """
+
+    options = mock.Mock(jobs=jobs, part_workers=2, deps=deps,
+                        upstream_url="https://pypi/pypi")
+    settings = Settings(None, None, packages, options)
+    if hosted is None:
+        hosted = mock.Mock()
+        hosted.is_released.return_value = False
+        hosted.missing.side_effect = lambda paths: paths
+
+    with mock.patch.object(rehost, "upload_file",
+                           side_effect=lambda path, *args: path) as upload, \
+            mock.patch.object(rehost, "finish_uploads"):
+        pipeline = rehost.RehostPipeline(settings, "bucket", hosted,
+                                         storage_dir)
+        pipeline.run()
+    return pipeline, upload
+
+
+def test_pipeline(capfd):
+    """Packages are fetched once each, sharing a copy of dependencies."""
+
+    fetched = {
+        "Flask==0.9": ["Flask-0.9.tar.gz", "Jinja2-2.7.3.tar.gz"],
+        "Jinja2": ["Jinja2-2.7.3.tar.gz", "MarkupSafe-0.23.tar.gz"],
+    }
+    packages = ["Flask==0.9", "Jinja2", "Flask==0.9", "missing"]
+
+    with rehost.TempDir() as storage:
+        with mock.patch.object(rehost.subprocess, "Popen",
+                               side_effect=fake_pip(fetched)) as patched, \
+                mock.patch.object(rehost, "_file_size", return_value=10):
+            pipeline, upload = run_pipeline(packages, storage.dir)
+
+        assert sorted(os.listdir(storage.dir)) == [
+            "Flask-0.9.tar.gz",
+            "Jinja2-2.7.3.tar.gz",
+            "MarkupSafe-0.23.tar.gz",
+        ]
+        uploaded = sorted(
+            os.path.basename(call[0][0]) for call in upload.call_args_list
+        )
+
+    assert patched.call_count == 3
+    assert uploaded == [
+        "Flask-0.9.tar.gz",
+        "Jinja2-2.7.3.tar.gz",
+        "MarkupSafe-0.23.tar.gz",
+    ]
+    assert pipeline.errors == 1
+    assert [stats.items for stats in pipeline.stats] == [3, 2, 3]
+    assert pipeline.stats[2].bytes == 30
+
+    out, err = capfd.readouterr()
+    assert "Fetched Flask==0.9: Flask-0.9.tar.gz, Jinja2-2.7.3.tar.gz" in out
+    assert "Error fetching missing: pip exited with 1:\nno such package" \
+        in err
+    assert "fetch: 3 packages" in out
+    assert "upload: 3 files, 0.0 MB" in out
+    assert "queue depth" in out
+
+
+def test_pipeline__requested_only(tmpdir):
+    """Without --deps, only the requested package's files are uploaded."""
+
+    fetched = {"Flask==0.9": ["Flask-0.9.tar.gz", "Jinja2-2.7.3.tar.gz"]}
+    with mock.patch.object(rehost.subprocess, "Popen",
+                           side_effect=fake_pip(fetched)), \
+            mock.patch.object(rehost, "_file_size", return_value=10):
+        pipeline, upload = run_pipeline(["Flask==0.9"], str(tmpdir),
+                                        deps=False)
+
+    upload.assert_called_once_with(str(tmpdir.join("Flask-0.9.tar.gz")),
+                                   "bucket", None, pipeline.options, mock.ANY,
+                                   False)
+
+
+def test_pipeline__fetches_concurrently():
+    """Up to jobs packages are fetched at the same time."""
+
+    lock = threading.Lock()
+    running = [0, 0]  # now, most at once
+
+    def fetch(package, storage_dir):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        time.sleep(0.05)
+        with lock:
+            running[0] -= 1
+        return ["{}-1.0.tar.gz".format(package)]
+
+    with mock.patch.object(rehost, "fetch_package", side_effect=fetch):
+        pipeline, _ = run_pipeline(list("abcdef"), "somewhere", jobs=3)
+
+    assert running[1] == 3
+    assert pipeline.errors == 6  # the files fetched are empty
+
+
+def test_pipeline__overlaps_stages():
+    """A package's files are uploaded while later packages are fetched."""
+
+    events = []
+
+    def fetch(package, storage_dir):
+        events.append("fetched " + package)
+        time.sleep(0.05)
+        return ["{}-1.0.tar.gz".format(package)]
+
+    def upload(path, *args):
+        events.append("uploaded " + os.path.basename(path))
+        return path
+
+    with mock.patch.object(rehost, "fetch_package", side_effect=fetch), \
+            mock.patch.object(rehost, "_file_size", return_value=10):
+        with mock.patch.object(rehost, "upload_file", side_effect=upload):
+            options = mock.Mock(jobs=1, part_workers=1, deps=True)
+            hosted = mock.Mock()
+            hosted.is_released.return_value = False
+            hosted.missing.side_effect = lambda paths: paths
+            with mock.patch.object(rehost, "finish_uploads") as finish:
+                rehost.RehostPipeline(
+                    Settings(None, None, list("abc"), options),
+                    "bucket",
+                    hosted,
+                    "somewhere",
+                ).run()
+
+    assert events.index("uploaded a-1.0.tar.gz") < events.index("fetched c")
+    assert sorted(finish.call_args[0][2]) == [
+        os.path.join("somewhere", "{}-1.0.tar.gz".format(package))
+        for package in "abc"
+    ]
+
+
+def test_pipeline__upload_error(capfd):
+    """Once an upload fails, the rest are skipped and PyPICloud left alone."""
+
+    options = mock.Mock(jobs=1, part_workers=1, deps=True)
+    hosted = mock.Mock()
+    hosted.is_released.return_value = False
+    hosted.missing.side_effect = lambda paths: paths
+
+    def fetch(package, storage_dir):
+        return [package + "-1.zip"]
+
+    with mock.patch.object(rehost, "fetch_package", side_effect=fetch), \
+            mock.patch.object(rehost, "_file_size", return_value=10), \
+            mock.patch.object(rehost, "upload_file",
+                              side_effect=IOError("denied")) as upload, \
+            mock.patch.object(rehost, "finish_uploads") as finish:
+        pipeline = rehost.RehostPipeline(
+            Settings(None, None, ["a", "b", "c"], options),
+            "bucket",
+            hosted,
+            "somewhere",
+        )
+        assert pipeline.run() == 1
+
+    assert upload.call_count == 1
+    assert not finish.called
+    assert "Error uploading somewhere/a-1.zip: denied" in capfd.readouterr()[1]
+
+
+UPSTREAM = {"releases": {
+    "1.0": [{"filename": "pkg-1.0.tar.gz", "size": 10}],
+    "2.0": [
+        {"filename": "pkg-2.0.tar.gz", "size": 20},
+        {"filename": "pkg-2.0-py2.py3-none-any.whl", "size": 21},
+    ],
+    "2.1b1": [{"filename": "pkg-2.1b1.tar.gz", "size": 30}],
+    "2.2": [{"filename": "pkg-2.2.tar.gz", "size": 40, "yanked": True}],
+    "not a version": [{"filename": "pkg-nope.tar.gz", "size": 50}],
+}}
+
+
+@pytest.mark.parametrize("package, expected", [
+    ("pkg", [("pkg-2.0.tar.gz", 20), ("pkg-2.0-py2.py3-none-any.whl", 21)]),
+    ("pkg<2", [("pkg-1.0.tar.gz", 10)]),
+    ("pkg>=2.1b1", [("pkg-2.1b1.tar.gz", 30)]),
+    ("pkg>3", []),
+], ids=("newest", "older", "pre-release", "none"))
+def test_upstream_files(package, expected):
+    """The newest matching release is found, like pip would pick it."""
+
+    response = mock.Mock()
+    response.json.return_value = UPSTREAM
+    with mock.patch.object(requests, "get",
+                           return_value=response) as patched_get:
+        assert rehost.upstream_files(package, "https://pypi/pypi/") == expected
+
+    patched_get.assert_called_once_with("https://pypi/pypi/pkg/json",
+                                        timeout=30)
 
-    # items should be empty here because we've mocked downloading anything
+
+def test_upstream_files__unreachable():
+    """When PyPI can't be asked, nothing is known to be released."""
+
+    with mock.patch.object(requests, "get", side_effect=IOError("down")):
+        assert rehost.upstream_files("pkg", "https://pypi/pypi") == []
+
+
+def test_hosted_files__is_released(bucket_and_keys):
+    """A release is hosted when a file of it is in the bucket."""
+
+    bucket, keys = bucket_and_keys
+    wheel = keys[6].name.partition("/")[2]
+    hosted = rehost.HostedFiles(bucket)
+
+    with mock.patch.object(rehost, "upstream_files", side_effect=[
+        [(wheel, keys[6].size), ("package_two-0.0.1.pdf", 99)],
+        [("package_two-0.0.1.pdf", 99)],
+        [(wheel, keys[6].size + 1)],
+        [],
+    ]):
+        assert hosted.is_released("package_two", "https://pypi/pypi")
+        assert not hosted.is_released("package_two", "https://pypi/pypi")
+        assert not hosted.is_released("package_two", "https://pypi/pypi")
+        assert not hosted.is_released("package_two", "https://pypi/pypi")
+
+    assert hosted.skipped == [1, keys[6].size]
+    bucket.list.assert_called_once_with(prefix="package-two/")
+
+
+def test_hosted_files__is_released_one_wheel(bucket_and_keys):
+    """A release with many files is hosted once the one pip chose is."""
+
+    bucket, keys = bucket_and_keys
+    wheel = keys[6].name.partition("/")[2]
+    hosted = rehost.HostedFiles(bucket)
+
+    with mock.patch.object(rehost, "upstream_files", return_value=[
+        ("package_two-0.0.1.zip", 99),
+        ("package_two-0.0.1-cp27-cp27mu-manylinux1_x86_64.whl", 99),
+        ("package_two-0.0.1-cp36-cp36m-win_amd64.whl", 99),
+        (wheel, keys[6].size),
+    ]):
+        assert hosted.is_released("package_two", "https://pypi/pypi")
+
+    assert hosted.skipped == [1, keys[6].size]
+
+
+def test_hosted_files__index_from_threads(bucket_and_keys, tmpdir):
+    """The bucket index can be checked from the pipeline's threads."""
+
+    bucket, keys = bucket_and_keys
+    hosted = rehost.HostedFiles(
+        index.BucketIndex(bucket, str(tmpdir.join("index.sqlite")), 60),
+    )
+    files = [(key.name.partition("/")[2], key.size) for key in keys[6:9]]
+
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        found = list(pool.map(lambda file_: hosted.is_hosted(*file_), files))
+
+    assert found == [True, True, True]
+
+
+def test_hosted_files__missing(bucket_and_keys, tmpdir):
+    """Files already uploaded are skipped, unless forced."""
+
+    bucket, keys = bucket_and_keys
+    paths = []
+    for key in keys[6:8]:
+        path = tmpdir.join(key.name.partition("/")[2])
+        path.write("x" * key.size)
+        paths.append(str(path))
+    changed = tmpdir.join("package-one-1.2.4-py2.py3-none-any.whl")
+    changed.write("changed")
+    paths.append(str(changed))
+
+    hosted = rehost.HostedFiles(bucket)
+    assert hosted.missing(paths) == [str(changed)]
+    assert hosted.summary() == (
+        "Skipped 2 file(s), {} bytes, already in the bucket. "
+        "Transferred 1 file(s), 7 bytes."
+    ).format(keys[6].size + keys[7].size)
+
+    assert rehost.HostedFiles(bucket, force=True).missing(paths) == paths
+
+
+def test_pipeline__skips_hosted(capfd):
+    """Packages already released in the bucket aren't fetched."""
+
+    hosted = mock.Mock()
+    hosted.is_released.side_effect = lambda package, url: package == "old"
+    hosted.missing.side_effect = lambda paths: paths
+
+    with mock.patch.object(rehost, "fetch_package",
+                           return_value=["new-1.0.tar.gz"]) as patched_fetch, \
+            mock.patch.object(rehost, "_file_size", return_value=10):
+        run_pipeline(["old", "new"], "somewhere", hosted, deps=False)
+
+    patched_fetch.assert_called_once_with("new", "somewhere")
+    hosted.is_released.assert_any_call("old", "https://pypi/pypi")
+    out, _ = capfd.readouterr()
+    assert "Skipping old, it is already in the bucket" in out
+    assert "Fetched new: new-1.0.tar.gz" in out
+
+
+def test_pipeline__deps_always_fetched():
+    """With --deps, hosted packages are fetched for their dependencies."""
+
+    hosted = mock.Mock()
+    hosted.missing.side_effect = lambda paths: paths
+
+    with mock.patch.object(rehost, "fetch_package",
+                           return_value=["old-1.0.tar.gz"]) as patched_fetch, \
+            mock.patch.object(rehost, "_file_size", return_value=10):
+        run_pipeline(["old"], "somewhere", hosted, deps=True)
+
+    patched_fetch.assert_called_once_with("old", "somewhere")
+    assert not hosted.is_released.called
+
+
+def test_stream_packages(bucket_and_keys, capfd):
+    """Release files not in the bucket are copied, then PyPICloud updated."""
+
+    bucket, keys = bucket_and_keys
+    options = mock.Mock(jobs=2, part_workers=2, upstream_url="https://pypi")
+    settings = Settings(None, None, ["package_two", "nope"], options)
+    hosted = rehost.HostedFiles(bucket)
+    files = {
+        "package_two": [
+            {"filename": "package-two-0.0.1-py2.7.egg", "size": keys[8].size},
+            {"filename": "package_two-0.0.1.zip", "size": 100},
+            {"filename": "package_two-0.0.1.pdf", "size": 100},
+        ],
+        "nope": [],
+    }
+
+    with mock.patch.object(rehost, "upstream_release",
+                           side_effect=lambda package, url: files[package]), \
+            mock.patch.object(rehost, "stream_file",
+                              return_value="package-two/zip") as patched, \
+            mock.patch.object(rehost, "finish_uploads") as patched_finish:
+        assert rehost.stream_packages(settings, bucket, hosted) == 1
+
+    assert patched.call_count == 1
+    assert patched.call_args[0][0] == files["package_two"][1]
+    assert not patched_finish.called  # a package failed
+    assert hosted.skipped == [1, keys[8].size]
+    assert hosted.transferred == [1, 100]
+
+    out, err = capfd.readouterr()
+    assert "Skipping package-two-0.0.1-py2.7.egg" in out
+    assert "Copied package_two-0.0.1.zip from PyPI" in out
+    assert "Error rehosting nope: no release found on PyPI" in err
+
+
+def test_stream_file():
+    """The response from PyPI is streamed into the upload, then closed."""
+
+    response = mock.Mock()
+    file_ = {
+        "filename": "package_two-0.0.1.zip",
+        "size": 100,
+        "url": "https://files/package_two-0.0.1.zip",
+        "digests": {"sha256": "abc"},
+    }
+    options = mock.Mock()
+
+    with mock.patch.object(requests, "get", return_value=response) as get, \
+            mock.patch.object(rehost, "upload_stream") as patched_upload:
+        rehost.stream_file(file_, "bucket", "s3", options, "pool", "buffers")
+
+    get.assert_called_once_with(file_["url"], stream=True, timeout=30)
     patched_upload.assert_called_once_with(
-        Settings(fake_s3, fake_pypi, [], fake_args),
-        patched_conn(),
+        response.raw, "package-two/package_two-0.0.1.zip", 100, "bucket",
+        "s3", options, "pool", "buffers", {"sha256": "abc"},
     )
+    response.close.assert_called_once_with()
 
 
 def test_rehost_filters():
@@ -87,5 +519,48 @@ def test_rehost_filters():
         )
 
 
+def test_find_downloaded__index():
+    """Names are matched exactly, picking every file of the newest version."""
+
+    files = [
+        "Flask_SQLAlchemy-2.0-py2.py3-none-any.whl",
+        "Flask-0.10.1.tar.gz",
+        "flask-0.10.1-py2.py3-none-any.whl",
+        "Flask-0.9.tar.gz",
+        "Flask-SQLAlchemy-1.0.tar.gz",
+        "pyflask-3.0.tar.gz",
+    ]
+
+    with mock.patch.object(rehost.os, "listdir") as patched_listdir:
+        found = rehost.find_downloaded(
+            ["flask", "Flask-SQLAlchemy<3", "Flask<0.10", "nope"],
+            "storage",
+            files,
+        )
+
+    assert not patched_listdir.called
+    assert found == [os.path.join("storage", file_) for file_ in (
+        "Flask-0.10.1.tar.gz",
+        "flask-0.10.1-py2.py3-none-any.whl",
+        "Flask_SQLAlchemy-2.0-py2.py3-none-any.whl",
+        "Flask-0.9.tar.gz",
+    )]
+
+
+def test_find_downloaded__dotted_name():
+    """Dotted names match files written with underscores, and vice versa."""
+
+    files = [
+        "zope_interface-5.4.0-cp37-cp37m-manylinux1_x86_64.whl",
+        "zope.event-4.5.0.tar.gz",
+    ]
+
+    assert rehost.find_downloaded(
+        ["zope.interface", "zope_event"],
+        "storage",
+        files,
+    ) == [os.path.join("storage", file_) for file_ in files]
+
+
 if __name__ == "__main__":
     pytest.main(["-v", "-rx", "--pdb", __file__])
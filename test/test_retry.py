@@ -0,0 +1,232 @@
+"""Verify the shared request executor retries and adapts its concurrency."""
+
+
+import mock
+import errno
+import socket
+import pytest
+import argparse
+
+import boto
+from boto.s3.bucket import Bucket
+from boto.resultset import ResultSet
+from boto.exception import S3ResponseError
+
+from pypicloud_tools import retry
+from pypicloud_tools import S3Config
+from pypicloud_tools import get_bucket_conn
+from pypicloud_tools.manifest import ManifestBucket
+
+
+THROTTLED = S3ResponseError(503, "Slow Down")
+RESET = IOError(errno.ECONNRESET, "Connection reset by peer")
+
+
+@pytest.mark.parametrize("error, retryable, throttle", [
+    (THROTTLED, True, True),
+    (S3ResponseError(500, "Internal Error"), True, False),
+    (S3ResponseError(400, "Bad Request", "<Code>RequestTimeout</Code>"),
+     True, False),
+    (RESET, True, False),
+    (socket.timeout("timed out"), True, False),
+    (S3ResponseError(403, "Forbidden"), False, False),
+    (S3ResponseError(404, "Not Found"), False, False),
+    (IOError(errno.ENOENT, "No such file or directory"), False, False),
+    (ValueError("nope"), False, False),
+], ids=("slowdown", "500", "timeout", "reset", "socket timeout", "403",
+        "404", "missing file", "other"))
+def test_classification(error, retryable, throttle):
+    """Only errors from S3 being busy or the connection failing retry."""
+
+    assert retry.is_retryable(error) is retryable
+    assert retry.is_throttle(error) is throttle
+
+
+def test_call__retries(request_executor):
+    """Retryable errors are retried, with the backoff between them."""
+
+    func = mock.Mock(side_effect=[RESET, THROTTLED, "result"])
+
+    with mock.patch.object(retry.time, "sleep") as patched_sleep:
+        assert request_executor.call(func, 1, two=2) == "result"
+
+    assert func.call_count == 3
+    func.assert_called_with(1, two=2)
+    assert patched_sleep.call_count == 2
+    assert request_executor.counters == {
+        "requests": 3,
+        "retries": 2,
+        "throttles": 1,
+        "failures": 0,
+    }
+
+
+def test_call__runs_out_of_retries(request_executor):
+    """The last error is raised once the retries run out."""
+
+    func = mock.Mock(side_effect=RESET)
+
+    with pytest.raises(IOError):
+        request_executor.call(func)
+
+    assert func.call_count == request_executor.retries + 1
+    assert request_executor.counters["failures"] == 1
+
+
+def test_backoff():
+    """Delays grow exponentially, with jitter, up to max_delay."""
+
+    executor = retry.RequestExecutor(4, base_delay=1, max_delay=5)
+
+    with mock.patch.object(retry.random, "uniform",
+                           side_effect=lambda low, high: high) as patched:
+        assert [executor.backoff(attempt) for attempt in range(5)] == [
+            1, 2, 4, 5, 5,
+        ]
+
+    assert all(call[0][0] == 0 for call in patched.call_args_list)
+
+
+def test_aimd_limit(request_executor):
+    """Throttles halve the limit, which grows by one again on success."""
+
+    request_executor.limit = 8
+    request_executor.retries = 0
+    for _ in range(2):
+        with pytest.raises(S3ResponseError):
+            request_executor.call(mock.Mock(side_effect=THROTTLED))
+    assert request_executor.limit == 2
+
+    for _ in range(2):
+        request_executor.call(mock.Mock())
+    assert request_executor.limit == 3
+
+    for _ in range(200):
+        request_executor.call(mock.Mock())
+    assert request_executor.limit == request_executor.max_requests
+
+
+def test_listing__continues_after_errors(request_executor, bucket_and_keys):
+    """A page which fails is requested again after the last key yielded."""
+
+    keys = bucket_and_keys[1]
+    bucket = mock.Mock(spec=Bucket)
+    pages = [keys[:3], RESET, keys[3:]]
+
+    def get_all_keys(**kwargs):
+        page = pages.pop(0)
+        if isinstance(page, Exception):
+            raise page
+        result = ResultSet()
+        result.extend(page)
+        result.is_truncated = bool(pages)
+        return result
+
+    bucket.get_all_keys = mock.Mock(side_effect=get_all_keys)
+
+    assert list(request_executor.listing(bucket, "package")) == keys
+    assert bucket.get_all_keys.call_args_list == [
+        mock.call(prefix="package"),
+        mock.call(prefix="package", marker=keys[2].name),
+        mock.call(prefix="package", marker=keys[2].name),
+    ]
+    assert request_executor.counters["retries"] == 1
+
+
+def test_listing__stand_ins_not_retried(request_executor):
+    """Stand ins are listed once, only the bucket they wrap is retried."""
+
+    bucket = mock.Mock(spec=Bucket)
+    bucket.get_all_keys.side_effect = THROTTLED
+    stand_in = ManifestBucket(bucket, "manifests", read=False)
+
+    with pytest.raises(S3ResponseError):
+        list(request_executor.listing(stand_in, "package/"))
+
+    attempts = request_executor.retries + 1
+    assert bucket.get_all_keys.call_count == attempts
+    assert request_executor.counters["requests"] == attempts
+    assert request_executor.counters["retries"] == attempts - 1
+    assert request_executor.counters["throttles"] == attempts
+
+
+def test_listing__pages_through_limit(request_executor, bucket_and_keys):
+    """A boto Bucket is listed a page per request, under the limit."""
+
+    keys = bucket_and_keys[1]
+    bucket = mock.Mock(spec=Bucket)
+    pages = [THROTTLED, keys[:5], keys[5:]]
+
+    def get_all_keys(**kwargs):
+        page = pages.pop(0)
+        if isinstance(page, Exception):
+            raise page
+        result = ResultSet()
+        result.extend(page)
+        result.is_truncated = bool(pages)
+        return result
+
+    bucket.get_all_keys = mock.Mock(side_effect=get_all_keys)
+
+    with mock.patch.object(request_executor, "_acquire",
+                           wraps=request_executor._acquire) as acquire:
+        assert list(request_executor.listing(bucket, "package")) == keys
+
+    assert bucket.get_all_keys.call_args_list == [
+        mock.call(prefix="package"),
+        mock.call(prefix="package"),
+        mock.call(prefix="package", marker=keys[4].name),
+    ]
+    assert acquire.call_count == 3
+    assert request_executor.counters["requests"] == 3
+    assert request_executor.counters["throttles"] == 1
+    assert not bucket.list.called
+
+
+def test_listing__thread_local_bucket(request_executor, bucket_and_keys):
+    """The bucket from get_bucket_conn is listed a page per request too."""
+
+    keys = bucket_and_keys[1]
+    page = ResultSet()
+    page.extend(keys)
+    page.is_truncated = False
+    boto_bucket = mock.Mock(spec=Bucket)
+    boto_bucket.get_all_keys.return_value = page
+    s3_config = S3Config("bucket", None, None, None, None)
+
+    with mock.patch.object(boto, "connect_s3") as connect:
+        connect.return_value.get_bucket.return_value = boto_bucket
+        bucket = get_bucket_conn(s3_config)
+        assert list(request_executor.listing(bucket, "package")) == keys
+
+    boto_bucket.get_all_keys.assert_called_once_with(prefix="package")
+    assert not boto_bucket.list.called
+    assert request_executor.counters["requests"] == 1
+    assert all(key.bucket is bucket for key in keys)
+
+
+def test_get_executor():
+    """The shared executor is made on first use, from the options."""
+
+    retry._shared = None
+    executor = retry.get_executor(argparse.Namespace(max_requests=3))
+
+    assert executor.max_requests == 3
+    assert retry.get_executor() is executor
+    assert retry.get_executor(argparse.Namespace(max_requests=5)) is executor
+
+
+@pytest.mark.parametrize("retries, printed", [(0, False), (1, True)])
+def test_print_summary(retries, printed, request_executor, capfd):
+    """The counters are only printed when S3 had issues."""
+
+    request_executor.counters["retries"] = retries
+    retry.print_summary()
+
+    out, err = capfd.readouterr()
+    assert not out
+    assert ("retried: {}".format(retries) in err) is printed
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", "-rx", "--pdb", __file__])
@@ -0,0 +1,120 @@
+"""Startup checks, guarding what the command line tools import to start."""
+
+
+import sys
+import json
+import pytest
+import subprocess
+
+from pypicloud_tools import index
+
+
+# modules which are slow to import, and not needed by the calls below
+SLOW_MODULES = ("pip", "pkg_resources", "boto", "requests", "filechunkio")
+
+# upper bounds in seconds for the benchmarks, run with --benchmark
+HELP_BUDGET = 1.0
+CACHED_LIST_BUDGET = 2.0
+
+RUN_LIST = """
+import sys, time, json
+started = time.time()
+sys.argv = {argv!r}
+from pypicloud_tools.lister import main
+try:
+    main()
+except SystemExit:
+    pass
+sys.stderr.write("\\n" + json.dumps({{
+    "elapsed": time.time() - started,
+    "modules": [mod for mod in {slow!r} if mod in sys.modules],
+}}))
+"""
+
+
+def run_list(*args):
+    """Runs `list` with args in a new interpreter.
+
+    Returns:
+        tuple of stdout, seconds taken and the slow modules imported
+    """
+
+    code = RUN_LIST.format(argv=["list"] + list(args), slow=SLOW_MODULES)
+    process = subprocess.Popen(
+        [sys.executable, "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    out, err = process.communicate()
+    result = json.loads(err.decode().splitlines()[-1])
+    return out.decode(), result["elapsed"], result["modules"]
+
+
+def test_list_help():
+    """Showing the help imports none of the slow modules."""
+
+    out, _, modules = run_list("--help")
+
+    assert "List package(s) from S3" in out
+    assert modules == []
+
+
+@pytest.mark.benchmark
+def test_list_help__benchmark():
+    """Showing the help is quick."""
+
+    assert run_list("--help")[1] < HELP_BUDGET
+
+
+@pytest.fixture
+def cached_config(bucket_and_keys, tmpdir):
+    """Returns the path of a config using a fresh index of package-one."""
+
+    bucket = bucket_and_keys[0]
+    cache_dir = tmpdir.join("cache")
+    cache_dir.ensure(dir=True)
+    index.BucketIndex(
+        bucket,
+        str(cache_dir.join("some-bucket.sqlite")),
+        3600,
+    ).update("package-one/")
+
+    config = tmpdir.join("pypirc")
+    config.write("\n".join((
+        "[pypicloud]",
+        "bucket:some-bucket",
+        "access:fake-access",
+        "secret:fake-secret",
+        "cache_dir:{}".format(cache_dir),
+        "index_ttl:3600",
+    )))
+    return str(config)
+
+
+def test_list__cached(cached_config):
+    """Listing a package from a fresh index doesn't need pip or S3."""
+
+    out, _, modules = run_list("--config", cached_config, "package_one")
+
+    assert out.splitlines() == [
+        "package-one==1.2.4.post1 : "
+        "package-one-1.2.4.post1-py2.py3-none-any.whl",
+        "package-one==1.2.4 : package-one-1.2.4-py2.py3-none-any.whl",
+        "package-one==1.2.3 : package-one-1.2.3-py2.py3-none-any.whl",
+        "package-one==1.2.3a1 : "
+        "package-one-1.2.3-alpha1-py2.py3-none-any.whl",
+    ]
+    assert "pip" not in modules
+    assert "requests" not in modules
+
+
+@pytest.mark.benchmark
+def test_list__cached_benchmark(cached_config):
+    """Listing a package from a fresh index is quick."""
+
+    assert run_list("--config", cached_config, "package_one")[1] < \
+        CACHED_LIST_BUDGET
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", "-rx", "--pdb", __file__])
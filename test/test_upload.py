@@ -1,20 +1,33 @@
 """Tests to ensure the pypicloud_tools upload functions work as expected."""
 
 
+import io
 import os
 import mock
+import time
+import errno
 import pytest
+import hashlib
+import requests
+import threading
+
+from boto.exception import S3ResponseError
+from concurrent.futures import ThreadPoolExecutor
 
 import pypicloud_tools
 from pypicloud_tools import upload
 
 
-def test_main(capfd):
+def test_main(tmpdir, capfd):
     """Mock all calls, ensure the command line entry point flow."""
 
     bucket = mock.Mock()
     settings = mock.Mock()
     settings.items = ["faked"]
+    settings.parsed.manifest_prefix = None
+    settings.parsed.jobs = 4
+    settings.parsed.part_workers = 4
+    settings.parsed.cache_dir = str(tmpdir)
 
     mock_s = mock.patch.object(upload, "get_settings", return_value=settings)
     mock_b = mock.patch.object(upload, "get_bucket_conn", return_value=bucket)
@@ -25,9 +38,19 @@ def test_main(capfd):
                     upload.main()
 
     settings_patch.assert_called_once_with(upload=True)
-    bucket_patch.assert_called_once_with(settings.s3)
+    bucket_patch.assert_called_once_with(
+        settings.s3,
+        validate=False,
+    )
     cloud_patch.assert_called_once_with(settings.pypi)
-    upload_patch.assert_called_once_with("faked", bucket, settings.s3)
+    upload_patch.assert_called_once_with(
+        "faked",
+        bucket,
+        settings.s3,
+        settings.parsed,
+        mock.ANY,  # the shared part pool
+        True,      # a single file shows its progress
+    )
     out, err = capfd.readouterr()
     assert not err
     assert "PyPICloud server at {} updated".format(settings.pypi.server) in out
@@ -39,6 +62,9 @@ def test_main__buries_error(capfd):
     bucket = mock.Mock()
     settings = mock.Mock()
     settings.items = ["faked"]
+    settings.parsed.manifest_prefix = None
+    settings.parsed.jobs = 4
+    settings.parsed.part_workers = 4
 
     with mock.patch.object(upload, "get_settings", return_value=settings):
         with mock.patch.object(upload, "get_bucket_conn", return_value=bucket):
@@ -52,6 +78,128 @@ def test_main__buries_error(capfd):
     assert not cloud_patch.called
 
 
+def test_upload_files__updates_manifests(tmpdir):
+    """With a manifest_prefix, manifests are updated after all uploads."""
+
+    bucket = mock.Mock()
+    settings = mock.Mock()
+    settings.items = ["one", "two", "three"]
+    settings.parsed.manifest_prefix = ".manifests"
+    settings.parsed.jobs = 1
+    settings.parsed.part_workers = 4
+    settings.parsed.cache_dir = str(tmpdir)
+
+    uploaded = ["pkg/pkg-1.0.tar.gz", None, "pkg/pkg-1.0.egg"]
+    with mock.patch.object(upload, "upload_file", side_effect=uploaded):
+        with mock.patch.object(upload, "update_manifests") as manifest_patch:
+            with mock.patch.object(upload, "update_cloud"), \
+                    mock.patch.object(upload, "forget_uploads") as forget:
+                upload.upload_files(settings, bucket)
+
+    forget.assert_called_once_with(
+        bucket,
+        settings.parsed,
+        ["pkg/pkg-1.0.tar.gz", "pkg/pkg-1.0.egg"],
+    )
+
+    manifest_patch.assert_called_once_with(
+        bucket,
+        ".manifests",
+        ["pkg/pkg-1.0.tar.gz", "pkg/pkg-1.0.egg"],
+        settings.s3.acl,
+    )
+
+
+def test_upload_files__concurrent(tmpdir, capfd):
+    """Files are uploaded at once, sharing a pool, then PyPICloud updated."""
+
+    bucket = mock.Mock()
+    settings = mock.Mock()
+    settings.items = ["file-{}".format(num) for num in range(6)]
+    settings.parsed.manifest_prefix = None
+    settings.parsed.jobs = 3
+    settings.parsed.part_workers = 2
+    settings.parsed.cache_dir = str(tmpdir)
+
+    lock = threading.Lock()
+    active = []
+    most_active = []
+
+    def fake_upload(filename, *args):
+        with lock:
+            active.append(filename)
+            most_active.append(len(active))
+        time.sleep(0.05)
+        with lock:
+            active.remove(filename)
+        return filename
+
+    with mock.patch.object(upload, "upload_file",
+                           side_effect=fake_upload) as upload_patch:
+        with mock.patch.object(upload, "update_cloud") as cloud_patch:
+            upload.upload_files(settings, bucket)
+
+    assert upload_patch.call_count == 6
+    assert max(most_active) == 3
+    pools = set(call[0][4] for call in upload_patch.call_args_list)
+    assert len(pools) == 1
+    assert pools.pop()._max_workers == 2
+    assert all(call[0][5] is False for call in upload_patch.call_args_list)
+    cloud_patch.assert_called_once_with(settings.pypi)
+    out, err = capfd.readouterr()
+    assert not err
+
+
+def test_upload_files__error_cancels_pending(capfd):
+    """After an error, files not started are skipped, PyPICloud untouched."""
+
+    bucket = mock.Mock()
+    settings = mock.Mock()
+    settings.items = ["one", "two", "three"]
+    settings.parsed.jobs = 1
+    settings.parsed.part_workers = 4
+
+    def upload_file(filename, *args):
+        if filename == "one":
+            raise IOError("reset")
+        return "pkg/{}".format(filename)
+
+    with mock.patch.object(upload, "upload_file",
+                           side_effect=upload_file) as upload_patch:
+        with mock.patch.object(upload, "update_cloud") as cloud_patch:
+            upload.upload_files(settings, bucket)
+
+    out, err = capfd.readouterr()
+    assert "Error uploading one: reset" in err
+    upload_patch.assert_called_once_with("one", bucket, settings.s3,
+                                         settings.parsed, mock.ANY, True)
+    assert not cloud_patch.called
+
+
+def test_upload_files__part_failure(tmpdir, capfd):
+    """A multipart upload with a failed part leaves PyPICloud untouched."""
+
+    filename = str(tmpdir.join("pkg-1.0.tar.gz"))
+    with open(filename, "w") as openfile:
+        openfile.write("some content")
+    settings = mock.Mock()
+    settings.items = [filename]
+    settings.parsed.jobs = 1
+    settings.parsed.part_workers = 1
+    settings.parsed.force = True
+    settings.parsed.resume = False
+    settings.parsed.multipart_threshold = 0
+
+    with mock.patch.object(upload, "_upload_chunk",
+                           side_effect=IOError("403 Forbidden")), \
+            mock.patch.object(upload, "update_cloud") as cloud_patch:
+        upload.upload_files(settings, mock.Mock())
+
+    assert not cloud_patch.called
+    assert "Error uploading {}: 1 of 1 parts".format(filename) in \
+        capfd.readouterr()[1]
+
+
 def test_update_cloud():
     """Ensure the proper request calls are used to update the PyPICloud API."""
 
@@ -60,10 +208,10 @@ def test_update_cloud():
     mock_auth = mock.Mock()
     pypi = pypicloud_tools.PyPIConfig("http://fake/pypi/", "joe", "hunter2")
 
-    auth_mock = mock.patch.object(upload.requests.auth, "HTTPBasicAuth",
+    auth_mock = mock.patch.object(requests.auth, "HTTPBasicAuth",
                                   return_value=mock_auth)
 
-    get_mock = mock.patch.object(upload.requests, "get", return_value=mock_get)
+    get_mock = mock.patch.object(requests, "get", return_value=mock_get)
 
     with auth_mock as auth_patch:
         with get_mock as get_patch:
@@ -81,10 +229,7 @@ def test_upload_file(capfd, config_file):
     """Verify the calls made to upload a file to S3."""
 
     bucket = mock.Mock()
-    bucket_key = mock.Mock()
-    bucket.get_key = mock.Mock(return_value=bucket_key)
     mock_multipart = mock.Mock()
-    mock_multipart.get_all_parts = mock.Mock(return_value=["one"])
     bucket.initiate_multipart_upload = mock.Mock(return_value=mock_multipart)
 
     s3_config = mock.Mock()
@@ -92,7 +237,8 @@ def test_upload_file(capfd, config_file):
     with open(config_file, "w") as openfile:
         openfile.write(file_contents)
 
-    with mock.patch.object(upload, "_upload_chunk") as patched_chunk_uploader:
+    with mock.patch.object(upload, "_upload_chunk",
+                           return_value='"part-etag"') as patched_chunk:
         upload.upload_file(config_file, bucket, s3_config)
 
     out, err = capfd.readouterr()
@@ -105,22 +251,67 @@ def test_upload_file(capfd, config_file):
     assert "Uploading {} ...".format(expected_name) in out
     assert "done!" in out
     assert "failed!" not in out
-    mock_multipart.complete_upload.assert_called_once_with()
-    bucket.get_key.assert_called_once_with(expected_name)
-    bucket_key.set_acl.assert_called_once_with(s3_config.acl)
-    patched_chunk_uploader.assert_called_once_with(
-        bucket,
-        mock_multipart.id,   # multipart upload id
+    bucket.complete_multipart_upload.assert_called_once_with(
+        expected_name,
+        mock_multipart.id,
+        (
+            "<CompleteMultipartUpload><Part><PartNumber>1</PartNumber>"
+            "<ETag>\"part-etag\"</ETag></Part></CompleteMultipartUpload>"
+        ),
+    )
+    assert not mock_multipart.get_all_parts.called
+    assert not bucket.get_key.called  # the ACL is sent when initiating
+    patched_chunk.assert_called_once_with(
+        mock_multipart,      # multipart upload
         1,                   # 50MB chunk number this is
         config_file,         # file to send
         0,                   # start of file
         len(file_contents),  # to the end of file
+        upload.print_dot,    # progress callback
     )
     bucket.initiate_multipart_upload.assert_called_once_with(
-        expected_name, headers={"Content-Type": "application/octet-stream"}
+        expected_name,
+        headers={"Content-Type": "application/octet-stream"},
+        policy=s3_config.acl,
     )
 
 
+@pytest.mark.parametrize("threshold, single", [
+    (33, True),
+    (32, False),
+], ids=("below threshold", "at threshold"))
+def test_upload_file__single_put(threshold, single, capfd, config_file):
+    """Files below the multipart threshold are sent in a single PUT."""
+
+    bucket = mock.Mock()
+    bucket.initiate_multipart_upload().get_all_parts.return_value = ["one"]
+    bucket.initiate_multipart_upload.reset_mock()
+    s3_config = mock.Mock()
+    options = mock.Mock()
+    options.multipart_threshold = threshold
+    options.resume = False
+    with open(config_file, "w") as openfile:
+        openfile.write("some content inside this file...")
+
+    with mock.patch.object(upload, "_upload_chunk"):
+        key_name = upload.upload_file(config_file, bucket, s3_config, options)
+
+    assert key_name == upload.package_key_name(config_file)
+    assert bucket.initiate_multipart_upload.called is not single
+    if single:
+        bucket.new_key.assert_called_once_with(key_name)
+        bucket.new_key().set_contents_from_filename.assert_called_once_with(
+            config_file,
+            headers={"Content-Type": "application/octet-stream"},
+            cb=upload.print_dot,
+            policy=s3_config.acl,
+        )
+        assert not bucket.get_key.called  # the ACL is sent with the PUT
+        out, err = capfd.readouterr()
+        assert "Uploading {} ...".format(key_name) in out
+        assert "done!" in out
+
+
 def test_upload_file__failure(capfd, config_file):
     """Ensure the multipart upload is cancelled on error."""
 
@@ -133,10 +324,7 @@ def test_upload_file__failure(capfd, config_file):
         os.path.basename(config_file),
     ])
     bucket = mock.Mock()
-    bucket_key = mock.Mock()
-    bucket.get_key = mock.Mock(return_value=bucket_key)
     mock_multipart = mock.Mock()
-    mock_multipart.get_all_parts = mock.Mock(return_value=[])
     bucket.initiate_multipart_upload = mock.Mock(return_value=mock_multipart)
 
     s3_config = mock.Mock()
@@ -144,39 +332,213 @@ def test_upload_file__failure(capfd, config_file):
     with open(config_file, "w") as openfile:
         openfile.write(file_contents)
 
-    with mock.patch.object(upload, "_upload_chunk") as patched_chunk_uploader:
-        upload.upload_file(config_file, bucket, s3_config)
+    with mock.patch.object(upload, "_upload_chunk",
+                           side_effect=IOError("reset")) as patched_chunk:
+        with pytest.raises(IOError) as error:
+            upload.upload_file(config_file, bucket, s3_config)
+
+    assert str(error.value) == "1 of 1 parts of {} failed to upload".format(
+        expected_name,
+    )
 
     out, err = capfd.readouterr()
 
     assert "Uploading {} ...".format(expected_name) in out
     assert "done!" not in out
     assert "failed! :(" in out
+    assert "part 1 of {}: reset".format(expected_name) in err
     mock_multipart.cancel_upload.assert_called_once_with()
-    patched_chunk_uploader.assert_called_once_with(
-        bucket,
-        mock_multipart.id,   # multipart upload id
+    assert not bucket.complete_multipart_upload.called
+    patched_chunk.assert_called_once_with(
+        mock_multipart,      # multipart upload
         1,                   # 5MB chunk number this is
         config_file,         # file to send
         0,                   # start of file
         len(file_contents),  # to the end of file
+        upload.print_dot,    # progress callback
     )
     bucket.initiate_multipart_upload.assert_called_once_with(
-        expected_name, headers={"Content-Type": "application/octet-stream"}
+        expected_name,
+        headers={"Content-Type": "application/octet-stream"},
+        policy=s3_config.acl,
+    )
+
+
+@pytest.fixture
+def resume_options(tmpdir):
+    """Returns options with resuming enabled, and a 2 part file to upload."""
+
+    options = mock.Mock()
+    options.multipart_threshold = 0
+    options.resume = True
+    options.cache_dir = str(tmpdir.join("cache"))
+    filename = str(tmpdir.join("package_one-1.2.3.tar.gz"))
+    with open(filename, "wb") as openfile:
+        openfile.truncate(5242881)  # just over a single 5MB part
+    return options, filename
+
+
+def test_upload_file__resume(resume_options, capfd):
+    """A failed upload is journaled, then continued with the missing parts."""
+
+    options, filename = resume_options
+    bucket = mock.Mock()
+    bucket.name = "some-bucket"
+    bucket.initiate_multipart_upload().id = "upload-id"
+    bucket.initiate_multipart_upload.reset_mock()
+    s3_config = mock.Mock()
+
+    def first_attempt(mp, part_num, *args):
+        if part_num == 2:
+            raise IOError("reset")
+        return '"etag-1"'
+
+    with mock.patch.object(upload, "_upload_chunk", side_effect=first_attempt):
+        with pytest.raises(IOError):
+            upload.upload_file(filename, bucket, s3_config, options)
+
+    out, err = capfd.readouterr()
+    assert "1 of 2 parts" in err
+    assert not bucket.initiate_multipart_upload().cancel_upload.called
+    journals = os.listdir(os.path.join(options.cache_dir, "uploads"))
+    assert len(journals) == 1
+
+    bucket.initiate_multipart_upload.reset_mock()
+    uploaded = mock.Mock(part_number=1, etag='"etag-1"')
+    mock_mp = mock.MagicMock()
+    mock_mp.__iter__.return_value = [uploaded]
+    mock_mp.id = "upload-id"
+    with mock.patch("boto.s3.multipart.MultiPartUpload",
+                    return_value=mock_mp) as patched_mp:
+        with mock.patch.object(upload, "_upload_chunk",
+                               return_value='"etag-2"') as patched_chunk:
+            key_name = upload.upload_file(filename, bucket, s3_config, options)
+
+    assert key_name == "package-one/package_one-1.2.3.tar.gz"
+    patched_mp.assert_called_once_with(bucket)
+    assert mock_mp.key_name == key_name
+    assert not bucket.initiate_multipart_upload.called
+    patched_chunk.assert_called_once_with(
+        mock_mp, 2, filename, 5242880, 1, mock.ANY,
+    )
+    bucket.complete_multipart_upload.assert_called_once_with(
+        key_name,
+        "upload-id",
+        upload._completion_xml({1: '"etag-1"', 2: '"etag-2"'}),
+    )
+    assert not os.listdir(os.path.join(options.cache_dir, "uploads"))
+
+
+def test_upload_file__resume_aborted(resume_options):
+    """When the journaled upload is gone from S3, a new one is started."""
+
+    options, filename = resume_options
+    bucket = mock.Mock()
+    bucket.name = "some-bucket"
+    journal = upload.UploadJournal(
+        filename,
+        os.path.join(options.cache_dir, "uploads"),
     )
+    journal.start(bucket, upload.package_key_name(filename), "old-id", 5242880)
+    bucket.initiate_multipart_upload().id = "new-id"
+    bucket.initiate_multipart_upload.reset_mock()
+
+    mock_mp = mock.MagicMock()
+    mock_mp.__iter__.side_effect = S3ResponseError(404, "NoSuchUpload")
+    with mock.patch("boto.s3.multipart.MultiPartUpload", return_value=mock_mp):
+        with mock.patch.object(upload, "_upload_chunk") as patched_chunk:
+            upload.upload_file(filename, bucket, mock.Mock(), options)
+
+    assert bucket.initiate_multipart_upload.call_count == 1
+    assert patched_chunk.call_count == 2
+
+
+def test_upload_journal__file_changed(resume_options):
+    """A journal is only found again for the same file size and mtime."""
+
+    options, filename = resume_options
+    path = os.path.join(options.cache_dir, "uploads")
+    journal = upload.UploadJournal(filename, path).journal
+    assert upload.UploadJournal(filename, path).journal == journal
+
+    with open(filename, "ab") as openfile:
+        openfile.write(b"more")
+    assert upload.UploadJournal(filename, path).journal != journal
+
+
+def test_local_etag(resume_options):
+    """ETags are computed as S3 does for single and multipart uploads."""
+
+    options, filename = resume_options
+    with open(filename, "rb") as openfile:
+        contents = openfile.read()
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        single = upload.local_etag(filename, False, pool)
+        multipart = upload.local_etag(filename, True, pool)
+
+    assert single == '"{}"'.format(hashlib.md5(contents).hexdigest())
+    assert multipart == '"{}-2"'.format(hashlib.md5(
+        hashlib.md5(contents[:5242880]).digest() +
+        hashlib.md5(contents[5242880:]).digest()
+    ).hexdigest())
+
+
+@pytest.mark.parametrize("key_size, etag, uploaded", [
+    (8, '"{}"'.format(hashlib.md5(b"contents").hexdigest()), True),
+    (8, '"some-other-etag"', False),
+    (9, '"{}"'.format(hashlib.md5(b"contents").hexdigest()), False),
+    (None, None, False),
+], ids=("identical", "changed", "other size", "missing"))
+def test_upload_file__skips_identical(key_size, etag, uploaded, capfd,
+                                      config_file):
+    """Files already uploaded with the same contents are not sent again."""
+
+    with open(config_file, "wb") as openfile:
+        openfile.write(b"contents")
+    bucket = mock.Mock()
+    if key_size is None:
+        bucket.get_key.return_value = None
+    else:
+        bucket.get_key.return_value = mock.Mock(size=key_size, etag=etag)
+    options = mock.Mock(multipart_threshold=100, force=False)
+
+    with mock.patch.object(upload, "_upload_single") as patched_single:
+        key_name = upload.upload_file(config_file, bucket, mock.Mock(),
+                                      options)
+
+    assert key_name == upload.package_key_name(config_file)
+    bucket.get_key.assert_called_once_with(key_name)
+    assert patched_single.called is not uploaded
+    out, err = capfd.readouterr()
+    assert ("Skipping {}".format(key_name) in out) is uploaded
+
+
+def test_upload_file__force(config_file):
+    """With --force, the key is not looked up before uploading."""
+
+    with open(config_file, "wb") as openfile:
+        openfile.write(b"contents")
+    bucket = mock.Mock()
+    options = mock.Mock(multipart_threshold=100, force=True)
+
+    with mock.patch.object(upload, "_upload_single") as patched_single:
+        upload.upload_file(config_file, bucket, mock.Mock(), options)
+
+    assert not bucket.get_key.called
+    assert patched_single.called
 
 
 def test_upload_chunk():
     """Ensure the chunk uploader is working as expected."""
 
-    bucket = mock.Mock()
     mp_upload = mock.Mock()
-    mp_upload.id = 1234
-    bucket.get_all_multipart_uploads = mock.Mock(return_value=[mp_upload])
+    mp_upload.upload_part_from_file().etag = '"part-etag"'
 
-    with mock.patch.object(upload, "FileChunkIO") as patched_filechunkio:
-        upload._upload_chunk(bucket, 1234, 1, "some-fake-file", 0, 50)
+    with mock.patch("filechunkio.FileChunkIO") as patched_filechunkio:
+        etag = upload._upload_chunk(mp_upload, 1, "some-fake-file", 0, 50)
 
+    assert etag == '"part-etag"'
     patched_filechunkio.assert_called_once_with(
         "some-fake-file",
         "rb",
@@ -184,25 +546,154 @@ def test_upload_chunk():
         bytes=50,
     )
 
-    mp_upload.upload_part_from_file.assert_called_once_with(
+    mp_upload.upload_part_from_file.assert_called_with(
         fp=patched_filechunkio().__enter__(), part_num=1, cb=upload.print_dot
     )
 
 
-def test_upload_chunks__errors():
-    """It should try up to three additional times to upload each chunk."""
+def test_upload_chunks__errors(request_executor):
+    """Chunks are retried by the shared executor on connection errors."""
 
-    bucket = mock.Mock()
+    reset = IOError(errno.ECONNRESET, "Connection reset by peer")
     mp_upload = mock.Mock()
-    mp_upload.id = 1234
-    mp_upload.upload_part_from_file = mock.Mock(side_effect=IOError)
-    bucket.get_all_multipart_uploads = mock.Mock(return_value=[mp_upload])
+    mp_upload.upload_part_from_file = mock.Mock(side_effect=reset)
 
-    with mock.patch.object(upload, "FileChunkIO"):
+    with mock.patch("filechunkio.FileChunkIO") as patched_filechunkio:
         with pytest.raises(IOError):
-            upload._upload_chunk(bucket, 1234, 1, "some-fake-file", 0, 50)
+            upload._upload_chunk(mp_upload, 1, "some-fake-file", 0, 50)
+
+    retries = request_executor.retries
+    assert mp_upload.upload_part_from_file.call_count == retries + 1
+    assert patched_filechunkio.call_count == retries + 1  # reopened each time
+    assert request_executor.counters["failures"] == 1
 
-    assert bucket.get_all_multipart_uploads.call_count == 4
+
+def test_upload_chunks__not_retryable():
+    """Errors which won't go away by retrying are raised right away."""
+
+    mp_upload = mock.Mock()
+    mp_upload.upload_part_from_file = mock.Mock(
+        side_effect=S3ResponseError(403, "Forbidden"),
+    )
+
+    with mock.patch("filechunkio.FileChunkIO"):
+        with pytest.raises(S3ResponseError):
+            upload._upload_chunk(mp_upload, 1, "some-fake-file", 0, 50)
+
+    assert mp_upload.upload_part_from_file.call_count == 1
+
+
+def stream_options(threshold):
+    """Returns the options for upload_stream, with a multipart threshold."""
+
+    options = mock.Mock()
+    options.multipart_threshold = threshold
+    return options
+
+
+def digests_of(data):
+    """Returns the md5 and sha256 hex digests of data, like PyPI lists."""
+
+    return {
+        "md5": hashlib.md5(data).hexdigest(),
+        "sha256": hashlib.sha256(data).hexdigest(),
+    }
+
+
+def test_upload_stream__single_put():
+    """Small streams are read whole, verified, then sent in a single PUT."""
+
+    data = b"some package"
+    bucket = mock.Mock()
+    s3_config = pypicloud_tools.S3Config("bucket", None, None, "private",
+                                         None)
+
+    assert upload.upload_stream(
+        io.BytesIO(data), "pkg/pkg-1.0.tar.gz", len(data), bucket, s3_config,
+        stream_options(1024), None, threading.Semaphore(1), digests_of(data),
+    ) == "pkg/pkg-1.0.tar.gz"
+
+    bucket.new_key.assert_called_once_with("pkg/pkg-1.0.tar.gz")
+    bucket.new_key().set_contents_from_string.assert_called_once_with(
+        data,
+        headers={"Content-Type": "application/octet-stream"},
+        policy="private",
+    )
+
+
+@pytest.mark.parametrize("size, error", [
+    (12, "sha256 of pkg/pkg-1.0.tar.gz is "),
+    (20, "pkg/pkg-1.0.tar.gz ended 8 bytes early"),
+], ids=("digest", "short"))
+def test_upload_stream__not_verified(size, error):
+    """Nothing is sent unless the stream is whole and matches its digests."""
+
+    bucket = mock.Mock()
+    with pytest.raises(ValueError) as raised:
+        upload.upload_stream(
+            io.BytesIO(b"some package"), "pkg/pkg-1.0.tar.gz", size, bucket,
+            mock.Mock(), stream_options(1024), None, threading.Semaphore(1),
+            {"sha256": "0" * 64},
+        )
+
+    assert error in str(raised.value)
+    assert not bucket.new_key().set_contents_from_string.called
+
+
+def test_upload_stream__multipart():
+    """Large streams are sent in parts, holding a bounded number of them."""
+
+    data = os.urandom(5242880 * 2 + 1024)
+    bucket = mock.Mock()
+    mp = bucket.initiate_multipart_upload()
+    buffers = threading.Semaphore(2)
+
+    received = {}
+
+    def upload_part_from_file(fp, part_num):
+        received[part_num] = fp.read()
+        return mock.Mock(etag='"etag{}"'.format(part_num))
+
+    mp.upload_part_from_file.side_effect = upload_part_from_file
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        upload.upload_stream(
+            io.BytesIO(data), "pkg/pkg-1.0.tar.gz", len(data), bucket,
+            mock.Mock(), stream_options(5242880), pool, buffers,
+            digests_of(data),
+        )
+
+    assert b"".join(received[num] for num in sorted(received)) == data
+    assert len(received) == upload.part_layout(len(data))[1]
+    bucket.complete_multipart_upload.assert_called_once_with(
+        "pkg/pkg-1.0.tar.gz",
+        mp.id,
+        upload._completion_xml(dict(
+            (num, '"etag{}"'.format(num)) for num in received
+        )),
+    )
+    assert not mp.cancel_upload.called
+    assert buffers.acquire(False) and buffers.acquire(False)  # all released
+
+
+def test_upload_stream__multipart_not_verified():
+    """A multipart upload not matching its digests is cancelled."""
+
+    data = os.urandom(5242880 * 2)
+    bucket = mock.Mock()
+    mp = bucket.initiate_multipart_upload()
+    mp.upload_part_from_file.return_value.etag = '"etag"'
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        with pytest.raises(ValueError):
+            upload.upload_stream(
+                io.BytesIO(data), "pkg/pkg-1.0.tar.gz", len(data), bucket,
+                mock.Mock(), stream_options(5242880), pool,
+                threading.Semaphore(2), {"md5": "0" * 32},
+            )
+
+    mp.cancel_upload.assert_called_once_with()
+    assert not bucket.complete_multipart_upload.called
 
 
 if __name__ == "__main__":
@@ -1,8 +1,24 @@
+import json
+import mock
+import time
 import pytest
+
+from boto.s3.key import Key
 from pkg_resources import SetuptoolsVersion
 
 from pypicloud_tools import OPERATORS
+from pypicloud_tools.utils import memoize
+from pypicloud_tools.utils import list_keys
+from pypicloud_tools.utils import ReleaseFile
+from pypicloud_tools.utils import ReleaseVersions
 from pypicloud_tools.utils import parse_package
+from pypicloud_tools.utils import parse_release
+from pypicloud_tools.utils import parse_filename
+from pypicloud_tools.utils import write_json
+
+
+# upper bound in seconds for parsing 100k filenames, run with --benchmark
+PARSE_BUDGET = 5.0
 
 
 @pytest.mark.parametrize(
@@ -38,5 +54,193 @@ def test_parse_package__empty_string():
     assert parse_package("") is None
 
 
+def test_list_keys__prefix_scoped(bucket_and_keys):
+    """Only the package's normalized prefix should be requested from S3."""
+
+    bucket, keys = bucket_and_keys
+    found = list(list_keys(bucket, parse_package("package_two")))
+
+    bucket.list.assert_called_once_with(prefix="package-two/")
+    assert found == keys[4:9]  # skips the bare "package-two/" key
+
+
+def test_list_keys__all_packages(bucket_and_keys):
+    """Without a package, every release key in the bucket is listed."""
+
+    bucket, keys = bucket_and_keys
+    found = list(list_keys(bucket))
+
+    bucket.list.assert_called_once_with(prefix="")
+    assert found == keys[:9] + keys[10:]
+
+
+@pytest.mark.parametrize(
+    "file_name, expected",
+    [
+        (
+            "package_one-1.2.3-py2.py3-none-any.whl",
+            ("package-one", "1.2.3", None, "py2.py3", "none", "any", "wheel"),
+        ),
+        (
+            "package-one-1.2.3-alpha1-py2.py3-none-any.whl",
+            ("package-one", "1.2.3-alpha1", None, "py2.py3", "none", "any",
+             "wheel"),
+        ),
+        (
+            "foo-1.0-2-cp27-cp27mu-manylinux1_x86_64.whl",
+            ("foo", "1.0", "2", "cp27", "cp27mu", "manylinux1_x86_64",
+             "wheel"),
+        ),
+        (
+            "foo-1.0-py2.7-linux-x86_64.egg",
+            ("foo", "1.0", None, "py2.7", None, "linux-x86_64", "egg"),
+        ),
+        (
+            "foo-1.0.win-amd64-py3.4.exe",
+            ("foo", "1.0", None, "py3.4", None, "win-amd64", "wininst"),
+        ),
+        (
+            "foo-1.0.win32.msi",
+            ("foo", "1.0", None, None, None, "win32", "msi"),
+        ),
+        (
+            "Foo_Bar-2.0rc1.tar.gz",
+            ("Foo-Bar", "2.0rc1", None, None, None, None, "sdist"),
+        ),
+        ("foo-1.0.tar.gz.asc", None),
+        ("foo.tar.gz", None),
+    ],
+    ids=("wheel", "wheel pre-release", "wheel build", "egg", "wininst", "msi",
+         "sdist", "signature", "no version"),
+)
+def test_parse_filename(file_name, expected):
+    """Release filenames are split into their name, version and tags."""
+
+    parsed = parse_filename(file_name)
+
+    if expected is None:
+        assert parsed is None
+    else:
+        assert parsed == ReleaseFile(*expected)
+
+
+def test_memoize__bounded():
+    """Only the most recently used results are kept."""
+
+    calls = []
+
+    @memoize(2)
+    def double(value):
+        calls.append(value)
+        return value * 2
+
+    assert [double(1), double(2), double(1), double(3)] == [2, 4, 2, 6]
+    assert list(double.cache) == [1, 3]
+    assert double(1) == 2
+    assert double(2) == 4
+    assert calls == [1, 2, 3, 2]
+
+
+def test_parse_release__other_project(key_list):
+    """Keys of another project under the same prefix are not releases."""
+
+    assert parse_release(key_list[0], parse_package("package")) is None
+    release = parse_release(key_list[0], parse_package("package-one"))
+    assert release.project == "package-one"
+    assert release.version == SetuptoolsVersion("1.2.3a1")
+    assert release.type == "wheel"
+
+
+def test_write_json(tmpdir):
+    """The file is replaced whole, without leaving the temporary file."""
+
+    path = tmpdir.join("state.json")
+    path.write("old")
+    write_json(str(path), {"parts": [1, 2]})
+
+    assert json.loads(path.read()) == {"parts": [1, 2]}
+    assert tmpdir.listdir() == [path]
+
+
+@pytest.mark.benchmark
+def test_parse_filename__benchmark():
+    """Parsing 100k filenames, the last 10k of them again, stays quick."""
+
+    templates = (
+        "package-{}-1.{}-py2.py3-none-any.whl",
+        "package_{}-1.{}.tar.gz",
+        "package-{}-1.{}-py2.7.egg",
+        "package-{}-1.{}.win32-py2.7.exe",
+    )
+    names = [
+        templates[i % len(templates)].format(i % 1000, i)
+        for i in range(90000)
+    ]
+    names.extend(names[-10000:])  # all still in the cache
+
+    started = time.time()
+    for name in names:
+        assert parse_filename(name)
+    assert time.time() - started < PARSE_BUDGET
+
+
+@pytest.fixture
+def release_versions():
+    """Returns ReleaseVersions for some releases, given out of order."""
+
+    package = parse_package("pkg")
+    files = [
+        "pkg-1.0.tar.gz",
+        "pkg-2.0-py2.py3-none-any.whl",
+        "pkg-1.0-py2.py3-none-any.whl",
+        "pkg-0.9.tar.gz",
+        "pkg-2.0.tar.gz",
+        "pkg-1.5rc1.tar.gz",
+        "pkg-1.5.tar.gz",
+    ]
+    releases = []
+    for file_name in files:
+        key = mock.Mock(spec=Key)
+        key.name = "pkg/{}".format(file_name)
+        releases.append(parse_release(key, package))
+    return ReleaseVersions(releases)
+
+
+@pytest.mark.parametrize(
+    "specs",
+    ["", "==1.0", "!=1.0", ">1.0", ">=1.0", "<1.5", "<=1.5", ">0.9,<2.0",
+     ">=1.0,!=1.5,!=2.0", "!=0.9,!=2.0", "==1.0,!=1.0", ">2.0", "==3.0"],
+)
+def test_release_versions__select(release_versions, specs):
+    """Selecting ranges of the sorted versions matches comparing each."""
+
+    package = parse_package("pkg{}".format(specs))
+    expected = [
+        release for release in release_versions.releases
+        if all(spec[0](release.version, spec[1]) for spec in package.specs)
+    ]
+
+    assert release_versions.select(package.specs) == expected
+    assert release_versions.latest(package.specs) == [
+        release for release in expected
+        if expected and release.version == expected[-1].version
+    ]
+
+
+def test_release_versions__sorted(release_versions):
+    """Releases of the same version keep their order."""
+
+    assert [release.key.name for release in release_versions.releases] == [
+        "pkg/pkg-0.9.tar.gz",
+        "pkg/pkg-1.0.tar.gz",
+        "pkg/pkg-1.0-py2.py3-none-any.whl",
+        "pkg/pkg-1.5rc1.tar.gz",
+        "pkg/pkg-1.5.tar.gz",
+        "pkg/pkg-2.0-py2.py3-none-any.whl",
+        "pkg/pkg-2.0.tar.gz",
+    ]
+    assert len(release_versions) == 7
+
+
 if __name__ == "__main__":
     pytest.main(["-v", "-rx", "--pdb", __file__])